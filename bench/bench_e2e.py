@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+# Сквозной нагрузочный бенчмарк parser.py без сети: локальные заглушки трекеров, Atom-ленты и TorAPI с задержкой, ошибками 503 и ответами 429.
+# Страницы разделов строятся из сохраненных страниц bench/fixtures (настоящая разметка и вес), в них подставляются синтетические ID тем.
+# Для каждого размера раздела запускает `parser.py --all --pages N` отдельным процессом (через RUTRACKER_BASE_URL, PORNOLAB_BASE_URL,
+# RUTRACKER_RSS_URL и TORAPI_BASE_URL) и выводит страниц/сек, тем/сек, пиковый RSS процесса и время сохранения.
+# --workers и --rps перебирают лимиты parser.py (MAX_WORKERS_*, *_MAX_RPS через окружение) - для подбора перед развертыванием.
+# Запуск: python bench/bench_e2e.py [--sizes 2,10,40] [--workers 8:5,16:10] [--rps 8:50,16:100] [--latency-ms 20] [--error-rate 0.02] [--throttle-rate 0.02] [--json results.json]
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from aiohttp import web
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+import parser as hh_parser
+
+FIXTURES_DIR = os.path.join(BENCH_DIR, "fixtures")
+LISTING_FIXTURES = {1605: "rutracker_f1605_p1.html", 886: "rutracker_f886_p3.html", 1823: "pornolab_f1823_p1.html"} # forum_id -> страница-образец раздела
+TOPIC_ID_BASE = 9_000_000 # Синтетические ID раздела f: от TOPIC_ID_BASE + f * 100_000 вниз
+FEED_ENTRIES = 50 # Записей в Atom-ленте (последние темы раздела)
+GENRES = ("Action", "RPG", "Стратегия", "Приключения", "Гонки", "Симулятор")
+DESCRIPTION = "Описание раздачи для нагрузочного теста. " * 15 # ~600 символов, как у типичной раздачи
+
+def forum_top_id(forum_id): return TOPIC_ID_BASE + forum_id * 100_000
+
+class ListingTemplate:
+    """Сохраненная страница раздела, в которой ID тем заменяются на синтетические ID нужной страницы."""
+    def __init__(self, forum_id, filename):
+        source_key = next(key for key, config in hh_parser.SOURCES.items() if config['forum_id'] == forum_id and 'rss_url' not in config)
+        with open(os.path.join(FIXTURES_DIR, filename), 'rb') as f: self.html = f.read().decode('windows-1251')
+        fixture_ids = hh_parser.extract_ids_from_html(self.html, source_key, 1, filename) # По убыванию, как на трекере
+        self.slots = {topic_id: slot for slot, topic_id in enumerate(fixture_ids)}; self.topics_per_page = len(fixture_ids); self.top_id = forum_top_id(forum_id)
+        self.pattern = re.compile(r'([?&]t=)(%s)\b' % '|'.join(fixture_ids))
+
+    def render(self, page_index):
+        first = page_index * self.topics_per_page
+        return self.pattern.sub(lambda m: f"{m.group(1)}{self.top_id - first - self.slots[m.group(2)]}", self.html).encode('windows-1251')
+
+# --- Заглушки: трекеры, лента, TorAPI ---
+@web.middleware
+async def inject_faults(request, handler):
+    """Задержка (равномерно 0.5..1.5 от заданной) и случайные 429/503 для любого запроса."""
+    config = request.app['config']; stats = request.app['stats']
+    if config.latency_ms: await asyncio.sleep(random.uniform(0.5, 1.5) * config.latency_ms / 1000)
+    roll = random.random()
+    if roll < config.throttle_rate: stats['429'] += 1; return web.Response(status=429, headers={"Retry-After": "0.5"})
+    if roll < config.throttle_rate + config.error_rate: stats['503'] += 1; return web.Response(status=503)
+    return await handler(request)
+
+async def handle_listing(request):
+    forum_id = int(request.query.get('f', 0)); template = request.app['listings'].get(forum_id)
+    page_index = int(request.query.get('start', 0)) // hh_parser.ITEMS_PER_PAGE_TRACKER
+    if template is None or page_index >= request.app['config'].pages: return web.Response(body=b"<html><body></body></html>", content_type='text/html', charset='windows-1251')
+    request.app['stats']['pages'] += 1
+    return web.Response(body=template.render(page_index), content_type='text/html', charset='windows-1251')
+
+async def handle_feed(request):
+    forum_id = int(request.match_info['forum_id']); top_id = forum_top_id(forum_id); now = time.time()
+    entries = []
+    for i in range(FEED_ENTRIES):
+        updated = time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime(now - i * 600))
+        entries.append(f'<entry><title>Тема {top_id - i}</title><link rel="alternate" href="https://rutracker.org/forum/viewtopic.php?t={top_id - i}"/>'
+                       f'<author><name>bench</name></author><published>{updated}</published><updated>{updated}</updated></entry>')
+    body = f'<?xml version="1.0" encoding="UTF-8"?><feed xmlns="http://www.w3.org/2005/Atom"><title>Форум {forum_id}</title>{"".join(entries)}</feed>'
+    return web.Response(text=body, content_type='application/atom+xml', charset='utf-8')
+
+async def handle_torapi(request):
+    provider = request.match_info['provider']; topic_id = request.query.get('query', '0'); rng = random.Random(topic_id)
+    request.app['stats']['torapi'] += 1
+    details = {"Name": f"Тестовая раздача {topic_id} [Nintendo Switch]", "Url": f"https://rutracker.org/forum/viewtopic.php?t={topic_id}", "Poster": "",
+               "Magnet": f"magnet:?xt=urn:btih:{hashlib.sha1(topic_id.encode()).hexdigest()}", "Year": str(rng.randint(2000, 2025)), "Type": rng.choice(GENRES),
+               "Voice": rng.choice(("Русский", "Английский", "-")), "Lang": rng.choice(("Русский", "Английский")), "Age": "-", "Multiplayer": rng.choice(("Нет", "Да", "неизвестно")),
+               "Description": DESCRIPTION}
+    if provider == 'pornolab': details.update(Seeds=str(rng.randint(0, 500)), Peers=str(rng.randint(0, 100)), Size=f"{rng.randint(1, 40)}.{rng.randint(0, 9)}\xa0GB", Video="MP4")
+    return web.json_response([details])
+
+def free_port():
+    with socket.socket() as sock: sock.bind(('127.0.0.1', 0)); return sock.getsockname()[1]
+
+class StandInServers:
+    """Заглушки в отдельном потоке со своим циклом событий. Трекер, pornolab, лента и TorAPI слушают разные порты: у parser.py у каждого хоста свой лимитер."""
+    def __init__(self, config):
+        self.app = web.Application(middlewares=[inject_faults])
+        self.app['config'] = config; self.app['stats'] = {}; self.app['listings'] = {forum_id: ListingTemplate(forum_id, filename) for forum_id, filename in LISTING_FIXTURES.items()}
+        self.app.router.add_get('/forum/viewforum.php', handle_listing); self.app.router.add_get('/atom/f/{forum_id}.atom', handle_feed); self.app.router.add_get('/api/search/id/{provider}', handle_torapi)
+        self.ports = {role: free_port() for role in ('rutracker', 'pornolab', 'feed', 'torapi')}
+        self._ready = threading.Event(); self._loop = None; self._stop = None; self._thread = threading.Thread(target=lambda: asyncio.run(self._serve()), name="stand-ins", daemon=True)
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop(); self._stop = asyncio.Event()
+        runner = web.AppRunner(self.app, access_log=None); await runner.setup()
+        for port in self.ports.values(): await web.TCPSite(runner, '127.0.0.1', port).start()
+        self._ready.set(); await self._stop.wait(); await runner.cleanup()
+
+    def __enter__(self): self._thread.start(); self._ready.wait(); return self
+    def __exit__(self, *exc): self._loop.call_soon_threadsafe(self._stop.set); self._thread.join()
+
+    def reset_stats(self): self.app['stats'].update({'pages': 0, 'torapi': 0, '429': 0, '503': 0})
+
+    def parser_env(self, workers, rps):
+        """Окружение parser.py, направляющее все источники на заглушки; workers и rps - пары (трекер, TorAPI)."""
+        base = "http://127.0.0.1:{}".format
+        return dict(os.environ, TORAPI_BASE_URL=base(self.ports['torapi']), RUTRACKER_BASE_URL=f"{base(self.ports['rutracker'])}/forum/",
+                    PORNOLAB_BASE_URL=f"{base(self.ports['pornolab'])}/forum/", RUTRACKER_RSS_URL=f"{base(self.ports['feed'])}/atom/f/{{forum_id}}.atom",
+                    MAX_WORKERS_ID_FETCH=str(workers[0]), MAX_WORKERS_TORAPI=str(workers[1]), TRACKER_MAX_RPS=str(rps[0]), TORAPI_MAX_RPS=str(rps[1]))
+
+# --- Прогон parser.py и разбор метрик ---
+def run_parser(pages, data_dir, env):
+    """Запускает `parser.py --all --pages N` отдельным процессом. Возвращает (код возврата, секунды, пиковый RSS в МБ или None).
+
+    Пиковый RSS берется из rusage именно этого процесса (os.wait4); где wait4 нет (Windows), он не измеряется.
+    """
+    cmd = [sys.executable, os.path.join(ROOT_DIR, "parser.py"), "--all", "--pages", str(pages), "--no-browser", "--data-dir", data_dir, "--metrics-file", os.path.join(data_dir, "metrics.json")]
+    started = time.perf_counter()
+    with open(os.path.join(data_dir, "parser.log"), 'w', encoding='utf-8') as log:
+        process = subprocess.Popen(cmd, env=env, stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+        if not hasattr(os, 'wait4'): return process.wait(), time.perf_counter() - started, None
+        _, status, usage = os.wait4(process.pid, 0); process.returncode = os.waitstatus_to_exitcode(status)
+    peak_mb = usage.ru_maxrss / (1048576 if sys.platform == 'darwin' else 1024) # macOS - байты, Linux - КБ
+    return process.returncode, time.perf_counter() - started, peak_mb
+
+def parse_limit_pairs(value, defaults, cast):
+    """Список пар (трекер, TorAPI) из строки "8:5,16:10"; пропущенная половина пары ("16" или "16:") берется из defaults. Пустая строка - только defaults."""
+    if not value: return [defaults]
+    pairs = []
+    for item in value.split(','):
+        tracker, _, torapi = item.partition(':')
+        pairs.append((cast(tracker) if tracker else defaults[0], cast(torapi) if torapi else defaults[1]))
+    return pairs
+
+def metric_values(snapshot, kind, name, field='value', **labels):
+    """Значения метрики из JSON-снимка METRICS.write() (серии, у которых совпадают указанные метки)."""
+    return [item[field] for item in snapshot.get(kind, []) if item['name'] == name and all(item['labels'].get(k) == v for k, v in labels.items())]
+
+def summarize(pages, workers, rps, returncode, wall_seconds, peak_mb, snapshot, stats):
+    """Строка результатов: пропускная способность считается по длительности стадий (источники работают одновременно - берется самая долгая)."""
+    pages_scanned = sum(metric_values(snapshot, "counters", "pages_scanned_total")); topics_new = sum(metric_values(snapshot, "counters", "topics_new_total"))
+    scan_seconds = max(metric_values(snapshot, "histograms", "stage_duration_seconds", field='sum', stage="scan"), default=0)
+    pipeline_seconds = max(metric_values(snapshot, "histograms", "stage_duration_seconds", field='sum', stage="pipeline"), default=0)
+    save_seconds = sum(metric_values(snapshot, "histograms", "store_write_seconds", field='sum')) + sum(metric_values(snapshot, "histograms", "export_seconds", field='sum'))
+    return {"pages_per_source": pages, "workers": list(workers), "rps": list(rps), "returncode": returncode, "wall_seconds": round(wall_seconds, 3), "pages_scanned": pages_scanned, "topics_new": topics_new,
+            "topics_failed": sum(metric_values(snapshot, "counters", "topics_failed_total")), "pages_per_second": round(pages_scanned / scan_seconds, 2) if scan_seconds else 0.0,
+            "topics_per_second": round(topics_new / pipeline_seconds, 2) if pipeline_seconds else 0.0, "peak_rss_mb": round(peak_mb, 1) if peak_mb is not None else None,
+            "save_seconds": round(save_seconds, 3), "injected_429": stats['429'], "injected_503": stats['503']}
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Сквозной бенчмарк parser.py на локальных заглушках трекеров, Atom-ленты и TorAPI.")
+    arg_parser.add_argument("--sizes", default="2,10,40", help="Размеры разделов в страницах на источник, через запятую.")
+    arg_parser.add_argument("--workers", default="", help="Стартовые окна (трекер:TorAPI) через запятую, например 8:5,16:10. По умолчанию - как в parser.py.")
+    arg_parser.add_argument("--rps", default="", help="Потолки запросов/сек (трекер:TorAPI) через запятую, например 8:50,16:100. По умолчанию - как в parser.py.")
+    arg_parser.add_argument("--latency-ms", type=float, default=20.0, help="Средняя задержка ответа заглушек, мс.")
+    arg_parser.add_argument("--error-rate", type=float, default=0.02, help="Доля ответов 503.")
+    arg_parser.add_argument("--throttle-rate", type=float, default=0.02, help="Доля ответов 429 (Retry-After: 0.5).")
+    arg_parser.add_argument("--json", default=None, metavar="PATH", help="Сохранить результаты в JSON (для сравнения между версиями).")
+    arg_parser.add_argument("--keep", action="store_true", help="Не удалять каталоги данных прогонов (там parser.log и metrics.json).")
+    args = arg_parser.parse_args()
+    logging.disable(logging.CRITICAL) # Логи парсера при импорте мешают таблице
+
+    worker_pairs = parse_limit_pairs(args.workers, (hh_parser.MAX_WORKERS_ID_FETCH, hh_parser.MAX_WORKERS_TORAPI), int)
+    rps_pairs = parse_limit_pairs(args.rps, (hh_parser.TRACKER_MAX_RPS, hh_parser.TORAPI_MAX_RPS), float)
+    results = []
+    print(f"{'Стр./ист.':>9} {'Окна':>7} {'RPS':>9} {'Тем':>6} {'Ошиб.':>5} {'Время, с':>8} {'Стр./с':>7} {'Тем/с':>7} {'RSS, МБ':>8} {'Сохр., с':>8} {'429/503':>8}  Результат")
+    with StandInServers(args) as servers:
+        for pages, workers, rps in itertools.product((int(size) for size in args.sizes.split(',')), worker_pairs, rps_pairs):
+            args.pages = pages; servers.reset_stats(); data_dir = tempfile.mkdtemp(prefix=f"hh_bench_{pages}_")
+            returncode, wall_seconds, peak_mb = run_parser(pages, data_dir, servers.parser_env(workers, rps))
+            try:
+                with open(os.path.join(data_dir, "metrics.json"), encoding='utf-8') as f: snapshot = json.load(f)
+            except (OSError, json.JSONDecodeError): snapshot = {}
+            row = summarize(pages, workers, rps, returncode, wall_seconds, peak_mb, snapshot, servers.app['stats']); results.append(row)
+            rss = f"{row['peak_rss_mb']:.1f}" if row['peak_rss_mb'] is not None else "н/д"
+            print(f"{pages:>9} {f'{workers[0]}:{workers[1]}':>7} {f'{rps[0]:g}:{rps[1]:g}':>9} {row['topics_new']:>6} {row['topics_failed']:>5} {row['wall_seconds']:>8.2f} {row['pages_per_second']:>7.1f} {row['topics_per_second']:>7.1f} {rss:>8} {row['save_seconds']:>8.2f} "
+                  f"{row['injected_429']:>4}/{row['injected_503']:<3}  {'OK' if returncode == 0 else f'ОШИБКА (код {returncode}, см. {data_dir}/parser.log)'}")
+            if args.keep or returncode != 0: print(f"    данные: {data_dir}")
+            else: shutil.rmtree(data_dir, ignore_errors=True)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f: json.dump({"latency_ms": args.latency_ms, "error_rate": args.error_rate, "throttle_rate": args.throttle_rate, "runs": results}, f, ensure_ascii=False, indent=2)
+    sys.exit(0 if all(row['returncode'] == 0 for row in results) else 1)
+
+if __name__ == "__main__":
+    main()
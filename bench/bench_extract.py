@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# Бенчмарк извлечения ID тем и пагинации по сохраненным страницам из bench/fixtures.
+# Сравнивает быстрый путь parser.py (lxml + XPath) с прежним каскадом BeautifulSoup и проверяет совпадение результатов.
+# Запуск: python bench/bench_extract.py [--iterations 200]  (для эталона нужен beautifulsoup4)
+import argparse
+import logging
+import os
+import re
+import sys
+import time
+
+from bs4 import BeautifulSoup
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+import parser as hh_parser
+
+FIXTURES_DIR = os.path.join(BENCH_DIR, "fixtures")
+FIXTURES = [ # (файл, источник, ожидаемое кол-во страниц)
+    ("rutracker_f1605_p1.html", "rutracker", 231),
+    ("rutracker_f886_p3.html", "rutracker_886", 412),
+    ("pornolab_f1823_p1.html", "pornolab", 88),
+]
+
+# --- Эталон: прежний каскад BeautifulSoup (как в parser.py до перехода на lxml) ---
+def legacy_extract_ids(html, source_key):
+    ids_on_page = set()
+    soup = BeautifulSoup(html, 'lxml')
+    topic_table = None
+    topic_links = []
+    if source_key in ['rutracker', 'rutracker_886']:
+        topic_table = (soup.find('table', class_='vf-table vf-tor forumline forum') or soup.find('table', class_='forumline', id='tor-tbl') or
+                       soup.find('table', id='tor-tbl') or soup.find('table', class_='forumline') or soup.find('table', class_='forum'))
+        if topic_table:
+            topic_links = (topic_table.select('a.torTopic.bold.tt-text[href*="t="]') or topic_table.select('a.torTopic[href*="t="]') or
+                           topic_table.select('a.tt-text[href*="t="]') or topic_table.select('a.topictitle[href*="t="]'))
+    elif source_key == 'pornolab':
+        topic_table = soup.find('table', class_='topic_list') or soup.find('table', class_='forumline')
+        if topic_table: topic_links = topic_table.select('a.topictitle[href*="t="]')
+    for link_tag in topic_links:
+        match = re.search(r'[?&]t=(\d+)', link_tag.get('href', ''))
+        if match: ids_on_page.add(match.group(1))
+    return sorted(ids_on_page, key=int, reverse=True)
+
+def legacy_total_pages(html):
+    soup = BeautifulSoup(html, 'lxml')
+    pagination_container = soup.find('div', id='pagination') or soup.find('div', class_='nav-top') or soup.find('td', class_='nav', align='right') or soup.find('td', class_='nav') or soup.find('p', class_='pagination')
+    if not pagination_container: return 1 if soup.select_one('a.topictitle, a.torTopic') else 0
+    all_links = pagination_container.find_all('a')
+    if not all_links: return 1 if soup.select_one('a.topictitle, a.torTopic') else 0
+    max_page_num = 1; found_page_number = False
+    for link in all_links:
+        link_text = link.get_text(strip=True)
+        if link_text.isdigit(): max_page_num = max(max_page_num, int(link_text)); found_page_number = True
+    if not found_page_number and max_page_num == 1: return 1 if soup.select_one('a.topictitle, a.torTopic') else 0
+    last_start = 0; last_page_link = None
+    if len(pagination_links := pagination_container.find_all('a', class_='pg')) > 0:
+        maybe_last = pagination_links[-1]
+        if maybe_last.get_text(strip=True).isdigit(): last_page_link = maybe_last
+        elif len(pagination_links) > 1 and pagination_links[-2].get_text(strip=True).isdigit(): last_page_link = pagination_links[-2]
+    if last_page_link and last_page_link.has_attr('href'):
+        match = re.search(r'[?&]start=(\d+)', last_page_link['href'])
+        if match: last_start = int(match.group(1))
+    return max(max_page_num, (last_start // hh_parser.ITEMS_PER_PAGE_TRACKER) + 1)
+
+def timed(fn, iterations):
+    """Среднее время одного вызова fn в миллисекундах."""
+    start = time.perf_counter()
+    for _ in range(iterations): fn()
+    return (time.perf_counter() - start) * 1000 / iterations
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Бенчмарк извлечения ID тем: lxml/XPath против BeautifulSoup.")
+    arg_parser.add_argument("--iterations", type=int, default=200)
+    args = arg_parser.parse_args()
+    logging.disable(logging.CRITICAL) # Логи парсера мешают замерам
+
+    all_ok = True
+    print(f"{'Фикстура':<28} {'ID':>4} {'Стр.':>5} {'bs4, мс':>9} {'lxml, мс':>9} {'Ускор.':>7}  Результат")
+    for filename, source_key, expected_pages in FIXTURES:
+        with open(os.path.join(FIXTURES_DIR, filename), 'rb') as f: html = f.read().decode('windows-1251')
+        fast_ids = hh_parser.extract_ids_from_html(html, source_key, 1, filename); fast_pages = hh_parser.parse_total_pages(html, source_key)
+        legacy_ids = legacy_extract_ids(html, source_key); legacy_pages = legacy_total_pages(html)
+        ok = fast_ids == legacy_ids and fast_pages == legacy_pages == expected_pages and len(fast_ids) > 0
+        all_ok &= ok
+        legacy_ms = timed(lambda: (legacy_extract_ids(html, source_key), legacy_total_pages(html)), args.iterations)
+        fast_ms = timed(lambda: (hh_parser.extract_ids_from_html(html, source_key, 1, filename), hh_parser.parse_total_pages(html, source_key)), args.iterations)
+        print(f"{filename:<28} {len(fast_ids):>4} {fast_pages:>5} {legacy_ms:>9.2f} {fast_ms:>9.2f} {legacy_ms / fast_ms:>6.1f}x  {'OK' if ok else 'РАСХОЖДЕНИЕ'}")
+        if not ok: print(f"    lxml: {len(fast_ids)} ID, {fast_pages} стр.; bs4: {len(legacy_ids)} ID, {legacy_pages} стр.; ожидалось стр.: {expected_pages}")
+    sys.exit(0 if all_ok else 1)
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
-import requests
-from bs4 import BeautifulSoup
+import asyncio
+import aiohttp
+from lxml import etree
 import json
 import logging
 import os
@@ -9,24 +10,43 @@ from urllib.parse import urljoin, urlparse, parse_qs
 import subprocess
 import webbrowser
 import sys
-import threading
-from queue import Queue
 import re
-import concurrent.futures
 import math
 import random
+import argparse
+import io
+import contextlib
+import cProfile
+import pstats
+import signal
+import threading
+import sqlite3
+import shutil
+import hashlib
+import itertools
+import heapq
+import zlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import xml.etree.ElementTree as ET # Для парсинга RSS/Atom
+import email.utils # Даты RFC 822 в лентах RSS 2.0
+import mimetypes
+try: from PIL import Image # Необязательно: уменьшение постеров для --thumbnails (без Pillow сохраняются исходные файлы)
+except ImportError: Image = None
 from datetime import datetime, timezone # Для работы с датами RSS
 
 load_dotenv()
 
 # --- Настройки ---
+RUTRACKER_BASE_URL = os.environ.get("RUTRACKER_BASE_URL", "https://rutracker.org/forum/") # Переопределение адресов - для локальных заглушек (bench/bench_e2e.py)
+PORNOLAB_BASE_URL = os.environ.get("PORNOLAB_BASE_URL", "https://pornolab.net/forum/")
+RUTRACKER_RSS_URL = os.environ.get("RUTRACKER_RSS_URL", "https://feed.rutracker.cc/atom/f/{forum_id}.atom")
 SOURCES = {
-    "rutracker": { "forum_id": 1605, "base_url": "https://rutracker.org/forum/", "provider_name": "rutracker", "output_json": "data.json", "open_browser": True },
-    "rutracker_886": { "forum_id": 886, "base_url": "https://rutracker.org/forum/", "provider_name": "rutracker", "output_json": "data_886.json", "open_browser": True },
-    "pornolab": { "forum_id": 1823, "base_url": "https://pornolab.net/forum/", "provider_name": "pornolab", "output_json": "pornolab_data.json", "open_browser": False },
-    "rutracker_rss": { "forum_id": 1605, "base_url": "https://rutracker.org/forum/", "rss_url": "https://feed.rutracker.cc/atom/f/{forum_id}.atom", "provider_name": "rutracker", "output_json": "rss_data.json", "open_browser": False }
+    "rutracker": { "forum_id": 1605, "base_url": RUTRACKER_BASE_URL, "provider_name": "rutracker", "output_json": "data.json", "open_browser": True, "cache_ttl": 300, "refresh_interval": 1800 },
+    "rutracker_886": { "forum_id": 886, "base_url": RUTRACKER_BASE_URL, "provider_name": "rutracker", "output_json": "data_886.json", "open_browser": True, "cache_ttl": 300, "refresh_interval": 3600 },
+    "pornolab": { "forum_id": 1823, "base_url": PORNOLAB_BASE_URL, "provider_name": "pornolab", "output_json": "pornolab_data.json", "open_browser": False, "cache_ttl": 600, "refresh_interval": 3600 },
+    "rutracker_rss": { "forum_id": 1605, "base_url": RUTRACKER_BASE_URL, "rss_url": RUTRACKER_RSS_URL, "rss_forum_ids": [1605], "torapi_enrich": False, "provider_name": "rutracker", "output_json": "rss_data.json", "open_browser": False, "cache_ttl": 900, "refresh_interval": 900 }
 }
 ITEMS_PER_PAGE_TRACKER = 50
 HEADERS = {
@@ -42,73 +62,632 @@ HEADERS = {
     'Sec-Fetch-Site': 'same-origin',
 }
 COOKIES = {}
-PLACEHOLDER_POSTER = "https://via.placeholder.com/160x240.png?text=RSS" # Заглушка для RSS
+PLACEHOLDER_POSTER = "/placeholder.svg" # Заглушка для RSS и записей без постера (public/placeholder.svg)
+REMOTE_PLACEHOLDER_PREFIX = "https://via.placeholder.com/" # Прежняя внешняя заглушка: с --thumbnails заменяется локальной
 RUTRACKER_DOWNLOAD_BASE_URL = "https://rutracker.org/forum/"
 PORNOLAB_DOWNLOAD_BASE_URL = "https://pornolab.net/forum/"
-TORAPI_BASE_URL = "http://localhost:8443"
+TORAPI_BASE_URL = os.environ.get("TORAPI_BASE_URL", "http://localhost:8443")
 TORAPI_REQUEST_TIMEOUT = 30
 TRACKER_PAGE_REQUEST_TIMEOUT = 45
 RSS_REQUEST_TIMEOUT = 25
-MAX_WORKERS_ID_FETCH = 8
-MAX_WORKERS_TORAPI = 5
-WORKER_SLEEP_MIN = 0.3
-WORKER_SLEEP_MAX = 1.0
+RSS_PARSE_CHUNK_SIZE = 64 * 1024 # Порция текста ленты для потокового разбора (XMLPullParser)
+RSS_FEED_FIELDS = ('title', 'link', 'forum_id', 'author', 'published', 'updated') # Поля записи, которые дает сама лента (при обогащении TorAPI не затираются)
+MAX_WORKERS_ID_FETCH = int(os.environ.get("MAX_WORKERS_ID_FETCH", 8)) # Стартовое окно одновременных запросов к одному трекеру (на хост), дальше подстраивается AIMD
+MAX_WORKERS_TORAPI = int(os.environ.get("MAX_WORKERS_TORAPI", 5)) # Стартовое окно одновременных запросов к TorAPI
+TRACKER_MAX_RPS = float(os.environ.get("TRACKER_MAX_RPS", 8.0)) # Потолок запросов/сек к одному хосту трекера (token bucket стартует с половины)
+TORAPI_MAX_RPS = float(os.environ.get("TORAPI_MAX_RPS", 50.0)) # Потолок запросов/сек к TorAPI (лимиты переопределяются окружением - для подбора в bench/bench_e2e.py)
+HTTP_POOL_LIMIT = 200 # Общий размер пула keep-alive соединений aiohttp
+HTTP_KEEPALIVE_TIMEOUT = 60
+AIMD_MAX_CONCURRENCY_FACTOR = 4 # Окно может вырасти до стартового * factor
+AIMD_LATENCY_FACTOR = 3.0 # Задержка (EWMA) выше минимальной в N раз - признак перегрузки
+AIMD_LATENCY_SLACK = 0.5 # ...но не меньше, чем минимальная + N сек (чтобы не реагировать на шум быстрых хостов)
+AIMD_RATE_STEP = 0.02 # Аддитивный прирост темпа на каждый здоровый ответ (доля от потолка запросов/сек)
+AIMD_MIN_RATE_SHARE = 0.05 # Темп не опускается ниже этой доли от потолка
+AIMD_DECREASE_COOLDOWN = 2.0 # Не чаще одного снижения за N сек (одна перегрузка - одно снижение)
+HTTP_MAX_RETRIES = 3 # Повторы при 429, 5xx, таймаутах и обрывах соединения
+HTTP_BACKOFF_BASE = 1.0
+HTTP_BACKOFF_MAX = 30.0
 BACKEND_SERVER_PORT = int(os.environ.get('BACKEND_PORT', 3000))
+CRAWL_STATE_FILE = "crawl_state.json" # High-water mark (макс. ID) по каждому источнику
+INCREMENTAL_MAX_PAGES = 50 # Потолок страниц для инкрементального режима
+INCREMENTAL_STOP_AFTER_KNOWN_PAGES = 1 # Сколько подряд "известных" страниц нужно для остановки
+PIPELINE_QUEUE_SIZE = 200 # Емкость очередей конвейера (ID -> TorAPI, записи -> писатель); сканер ждет, если воркеры не успевают
+PIPELINE_BATCH_SIZE = 50 # Писатель сохраняет записи в хранилище пакетами по N (частичный результат переживает падение)
+REFRESH_BUDGET_PER_RUN = 200 # Сколько устаревших сохраненных записей перезапрашивать у TorAPI за одно обновление источника (0 - не обновлять)
+DEFAULT_REFRESH_INTERVAL = 3600 # Интервал обновления в режиме --daemon, если у источника не задан "refresh_interval" (сек)
+HTTP_CACHE_FILE = "http_cache.sqlite" # Дисковый кэш ответов трекеров и RSS (условные запросы)
+HTTP_CACHE_MAX_BYTES = 200 * 1024 * 1024 # Лимит размера кэша, сверх него - вытеснение LRU
+TORAPI_CACHE_FILE = "torapi_cache.sqlite" # Кэш ответов TorAPI по (provider, topic_id)
+TORAPI_DETAIL_TTL = 30 * 24 * 3600 # TTL "стабильных" полей (название, описание, постер...)
+TORAPI_FIELD_TTL = {"Seeds": 6 * 3600, "Peers": 6 * 3600, "Size": 7 * 24 * 3600} # Быстро меняющиеся поля
+TORAPI_NOT_FOUND_TTL = 24 * 3600 # Сколько помнить ответ "No matches"
+TORAPI_SOURCE_FIELDS = {"pornolab": ("Seeds", "Peers", "Size")} # Какие быстро меняющиеся поля нужны источнику
+THUMBS_DIR = os.path.join("public", "thumbs") # Локальные миниатюры постеров (--thumbnails), server.js раздает их как /thumbs/<sha256>.<ext>
+THUMBS_URL_PREFIX = "/thumbs/"
+THUMBS_INDEX_FILE = "thumbs_cache.sqlite" # Индекс URL постера -> файл миниатюры
+THUMBS_MAX_BYTES = 500 * 1024 * 1024 # Лимит размера каталога миниатюр, сверх него - вытеснение LRU
+THUMBNAIL_SIZE = (320, 480) # Потолок размера миниатюры: плитка 160x240 с запасом для HiDPI
+THUMBNAIL_JPEG_QUALITY = 80
+POSTER_REQUEST_TIMEOUT = 30
+POSTER_MAX_BYTES = 15 * 1024 * 1024 # Ответ больше - не постер, не сохраняем
+POSTER_WORKERS = 4 # Корутин стадии миниатюр на источник (реальную параллельность на хост картинок ограничивает лимитер)
+THUMBNAIL_BACKFILL_PER_RUN = 300 # Сколько сохраненных записей с удаленным постером догружать за обновление источника (0 - только новые и обновленные)
+THUMBNAIL_FAILURE_TTL = 24 * 3600 # Постер, который не загрузился, догрузка не пробует повторно N сек
+DATA_STORE_FILE = "parser_data.sqlite" # Основное хранилище записей; JSON-файлы источников - экспорт для server.js
+SERVING_DIR = "serving" # Каталог страниц-шардов для server.js (рядом с JSON-файлами): serving/<source>/manifest.json
+SERVING_SHARD_SIZE = 100 # Записей в одном шарде; страница API читает ceil(limit / N) + 1 шардов максимум
+SERVING_SHARD_ORDER = "oldest_first" # Шард 0 - самые старые темы: новые темы меняют только последние шарды
+SEARCH_INDEX_VERSION = 2 # Версия правил токенизации; при увеличении индекс в хранилище перестраивается
+SEARCH_TEXT_FIELDS = ("title", "genre") # Поля для полнотекстового поиска
+SEARCH_FACET_FIELDS = ("year", "genre", "voice_lang", "text_lang", "has_multiplayer") # Фасеты (термы "facet=value"), счетчики считаются при выгрузке
+SEARCH_FIELD_ALIASES = {"genre": ("genre", "Type")} # Поле индекса -> поля записи по порядку: у pornolab жанр лежит в "Type"
+SEARCH_TOKEN_RE = re.compile(r'[^\W_]+') # Слова из букв и цифр любого алфавита
+SEARCH_CARD_FIELDS = ("topic_id", "title", "poster_url", "poster_remote_url", "year", "genre", "has_multiplayer") # Поля плитки сетки: выдача поиска не читает шарды
+METRICS_PREFIX = "hh_" # Префикс имен метрик в формате Prometheus
+PROFILE_TOP_N = 25 # Сколько строк статистики cProfile выводить в лог при --profile
+METRICS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0) # Границы корзин гистограмм длительностей (сек)
+METRICS_STAGE_BUCKETS = (1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1200.0, 1800.0, 3600.0, 7200.0) # Стадии и задания источников идут минутами
+METRICS_HISTOGRAM_BUCKETS = {"stage_duration_seconds": METRICS_STAGE_BUCKETS, "export_seconds": METRICS_STAGE_BUCKETS} # Свои корзины гистограмм (остальные - METRICS_BUCKETS)
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(threadName)s] %(levelname)s - %(message)s')
 
-session = requests.Session()
-session.headers.update(HEADERS)
-if COOKIES: session.cookies.update(COOKIES)
+HttpResult = namedtuple('HttpResult', 'status charset body headers')
 
-def fetch_html(url, session_obj, timeout, specific_cookies=None):
-    """Загружает HTML контент страницы с использованием сессии и специфичных кук."""
-    current_cookies = session_obj.cookies.copy()
-    if specific_cookies: current_cookies.update(specific_cookies)
-    try:
-        response = session_obj.get(url, timeout=timeout, cookies=current_cookies)
-        response.raise_for_status()
-        response.encoding = response.apparent_encoding or 'windows-1251'
-        return response.text
-    except requests.exceptions.Timeout: logging.error(f"Таймаут при запросе {url}"); return None
-    except requests.exceptions.RequestException as e: logging.error(f"Ошибка сети при загрузке {url}: {e}"); return None
+class Metrics:
+    """Счетчики, gauge-максимумы и гистограммы прогона (потокобезопасно, без внешних зависимостей).
+
+    Имена и метки в духе Prometheus; экспорт - текстовый формат Prometheus (для textfile collector) или JSON-снимок.
+    """
+    def __init__(self, buckets=METRICS_BUCKETS, histogram_buckets=None):
+        self.buckets = tuple(buckets); self.histogram_buckets = dict(METRICS_HISTOGRAM_BUCKETS if histogram_buckets is None else histogram_buckets)
+        self.started_at = time.time(); self._lock = threading.Lock()
+        self.counters = {}; self.gauges = {}; self.histograms = {} # (name, ((label, value), ...)) -> значение / [счетчики корзин, sum, count, границы корзин]
+
+    @staticmethod
+    def _key(name, labels): return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock: self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge_max(self, name, value, **labels):
+        """Запоминает максимум (например, глубину очереди)."""
+        key = self._key(name, labels)
+        with self._lock: self.gauges[key] = max(self.gauges.get(key, value), value)
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None: bounds = tuple(self.histogram_buckets.get(name, self.buckets)); hist = self.histograms[key] = [[0] * len(bounds), 0.0, 0, bounds]
+            for i, bound in enumerate(hist[3]):
+                if value <= bound: hist[0][i] += 1; break
+            hist[1] += value; hist[2] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Контекстный менеджер: наблюдает длительность блока (сек) в гистограмме name."""
+        started = time.perf_counter()
+        try: yield
+        finally: self.observe(name, time.perf_counter() - started, **labels)
+
+    def counter_value(self, name, **labels):
+        """Сумма счетчика по всем сериям, подходящим под заданные метки."""
+        with self._lock: return sum(v for (n, lbls), v in self.counters.items() if n == name and all((k, str(val)) in lbls for k, val in labels.items()))
+
+    @staticmethod
+    def _quantile(hist, q):
+        """Оценка квантиля по корзинам (верхняя граница корзины, где накопилась доля q); None - квантиль выше последней границы (в JSON - null)."""
+        target = q * hist[2]; cumulative = 0
+        for bound, count in zip(hist[3], hist[0]):
+            cumulative += count
+            if cumulative >= target: return bound
+        return None
+
+    def snapshot(self):
+        """JSON-совместимый снимок всех метрик."""
+        with self._lock:
+            hists = [{"name": n, "labels": dict(l), "count": h[2], "sum": round(h[1], 6), "p50": self._quantile(h, 0.5), "p95": self._quantile(h, 0.95),
+                      "buckets": {str(b): c for b, c in zip(h[3], h[0])}} for (n, l), h in sorted(self.histograms.items())]
+            return {"started_at": datetime.fromtimestamp(self.started_at, timezone.utc).isoformat(timespec='seconds'), "uptime_seconds": round(time.time() - self.started_at, 3),
+                    "counters": [{"name": n, "labels": dict(l), "value": v} for (n, l), v in sorted(self.counters.items())],
+                    "gauges": [{"name": n, "labels": dict(l), "value": v} for (n, l), v in sorted(self.gauges.items())], "histograms": hists}
+
+    @staticmethod
+    def _fmt_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs: return ""
+        escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in pairs) + "}"
+
+    def to_prometheus(self):
+        """Текстовый формат Prometheus (exposition format 0.0.4), имена с префиксом METRICS_PREFIX."""
+        lines = []; typed = set()
+        with self._lock:
+            for kind, series in (("counter", self.counters), ("gauge", self.gauges)):
+                for (name, labels), value in sorted(series.items()):
+                    full_name = METRICS_PREFIX + name
+                    if full_name not in typed: typed.add(full_name); lines.append(f"# TYPE {full_name} {kind}")
+                    lines.append(f"{full_name}{self._fmt_labels(labels)} {value}")
+            for (name, labels), (counts, total, count, bounds) in sorted(self.histograms.items()):
+                full_name = METRICS_PREFIX + name
+                if full_name not in typed: typed.add(full_name); lines.append(f"# TYPE {full_name} histogram")
+                cumulative = 0
+                for bound, bucket_count in zip(bounds, counts):
+                    cumulative += bucket_count; lines.append(f"{full_name}_bucket{self._fmt_labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{full_name}_bucket{self._fmt_labels(labels, [('le', '+Inf')])} {count}")
+                lines.append(f"{full_name}_sum{self._fmt_labels(labels)} {total:.6f}"); lines.append(f"{full_name}_count{self._fmt_labels(labels)} {count}")
+        lines.append(f"# TYPE {METRICS_PREFIX}uptime_seconds gauge"); lines.append(f"{METRICS_PREFIX}uptime_seconds {time.time() - self.started_at:.3f}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Атомарно записывает метрики: *.json - JSON-снимок, иначе текстовый формат Prometheus (*.prom)."""
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                if path.endswith('.json'): json.dump(self.snapshot(), f, ensure_ascii=False, indent=2)
+                else: f.write(self.to_prometheus())
+            os.replace(tmp_path, path); logging.info(f"Метрики записаны в {path}")
+        except OSError as e: logging.error(f"Ошибка записи метрик {path}: {e}")
+
+    def log_summary(self):
+        """Короткая сводка в лог: где прошло время (хосты, разбор, запись) и что найдено по источникам."""
+        snapshot = self.snapshot()
+        top_bound = lambda hist: f">{list(hist['buckets'])[-1]}" # Квантиль выше последней корзины
+        for hist in snapshot["histograms"]:
+            if hist["count"]: logging.info(f"[Метрики] {hist['name']} {hist['labels']}: n={hist['count']}, сумма {hist['sum']:.2f} сек, p50{'<=' + str(hist['p50']) if hist['p50'] is not None else top_bound(hist)}, p95{'<=' + str(hist['p95']) if hist['p95'] is not None else top_bound(hist)}")
+        for counter in snapshot["counters"]:
+            if counter["name"].startswith(("topics_", "http_cache_", "torapi_cache_", "http_retries_", "http_response_bytes_")): logging.info(f"[Метрики] {counter['name']} {counter['labels']}: {counter['value']}")
+
+METRICS = Metrics() # Общие метрики процесса (все источники и движки)
+
+def endpoint_label(url):
+    """Метка эндпоинта для метрик: путь без числовых сегментов (ID тем не раздувают число серий)."""
+    return re.sub(r'/\d+(?=/|$)', '/{id}', urlparse(url).path) or "/"
+
+class HttpCache:
+    """Дисковый кэш HTTP-ответов (SQLite): тело, ETag/Last-Modified и сохраненный результат разбора, вытеснение LRU по размеру."""
+    def __init__(self, path=HTTP_CACHE_FILE, max_bytes=HTTP_CACHE_MAX_BYTES):
+        self.path = path; self.max_bytes = max_bytes; self.hits = 0; self.revalidated = 0; self.misses = 0
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS responses (cache_key TEXT PRIMARY KEY, url TEXT, etag TEXT, last_modified TEXT, charset TEXT,
+                             body BLOB, parsed TEXT, size INTEGER, fetched_at REAL, accessed_at REAL)""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses(accessed_at)")
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(url, cookies=None):
+        """Ключ кэша: URL + куки источника (разные куки - разные ответы трекера)."""
+        cookie_part = json.dumps(sorted((cookies or {}).items()), ensure_ascii=False)
+        return hashlib.sha1(f"{url}\n{cookie_part}".encode('utf-8')).hexdigest()
+
+    def get(self, cache_key):
+        row = self.conn.execute("SELECT etag, last_modified, charset, body, fetched_at FROM responses WHERE cache_key = ?", (cache_key,)).fetchone()
+        if row is None: return None
+        self.conn.execute("UPDATE responses SET accessed_at = ? WHERE cache_key = ?", (time.time(), cache_key)); self.conn.commit()
+        return {'etag': row[0], 'last_modified': row[1], 'charset': row[2], 'body': zlib.decompress(row[3]), 'fetched_at': row[4]}
+
+    def put(self, cache_key, url, etag, last_modified, charset, body):
+        """Сохраняет новый ответ (сбрасывает сохраненный результат разбора) и вытесняет старые записи при переполнении."""
+        packed = zlib.compress(body); now = time.time()
+        self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, NULL, ?, ?, ?)", (cache_key, url, etag, last_modified, charset, packed, len(packed), now, now))
+        self.conn.commit(); self.evict()
+
+    def mark_validated(self, cache_key):
+        """Ответ 304: запись снова свежая."""
+        self.conn.execute("UPDATE responses SET fetched_at = ? WHERE cache_key = ?", (time.time(), cache_key)); self.conn.commit()
+
+    def get_parsed(self, cache_key):
+        row = self.conn.execute("SELECT parsed FROM responses WHERE cache_key = ?", (cache_key,)).fetchone()
+        return json.loads(row[0]) if row and row[0] is not None else None
+
+    def set_parsed(self, cache_key, parsed):
+        self.conn.execute("UPDATE responses SET parsed = ? WHERE cache_key = ?", (json.dumps(parsed, ensure_ascii=False), cache_key)); self.conn.commit()
+
+    def evict(self):
+        """Удаляет давно не использованные записи, пока кэш не уложится в 90% лимита."""
+        total_size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total_size <= self.max_bytes: return
+        target = self.max_bytes * 0.9; removed = 0
+        for cache_key, size in self.conn.execute("SELECT cache_key, size FROM responses ORDER BY accessed_at").fetchall():
+            if total_size <= target: break
+            self.conn.execute("DELETE FROM responses WHERE cache_key = ?", (cache_key,)); total_size -= size; removed += 1
+        self.conn.commit(); logging.info(f"HTTP-кэш: вытеснено {removed} записей (LRU), размер {total_size / 1048576:.1f} МБ")
+
+    def close(self):
+        logging.info(f"HTTP-кэш: свежих попаданий {self.hits}, подтверждено 304: {self.revalidated}, загружено заново: {self.misses}")
+        self.conn.close()
+
+class TorApiDetailCache:
+    """Постоянный кэш ответов TorAPI (SQLite) по (provider, topic_id) с TTL по полям и объединением одновременных запросов одного ID."""
+    def __init__(self, path=TORAPI_CACHE_FILE):
+        self.path = path; self.hits = 0; self.fetched = 0; self.coalesced = 0; self._inflight = {}
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL"); self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS details (provider TEXT NOT NULL, topic_id INTEGER NOT NULL, response TEXT NOT NULL, found INTEGER NOT NULL,
+                             fetched_at REAL NOT NULL, PRIMARY KEY (provider, topic_id)) WITHOUT ROWID""")
+        self.conn.commit()
+
+    @staticmethod
+    def ttl_for_source(source_key):
+        """TTL записи для источника: минимум из TTL полей, которые источник использует."""
+        return min([TORAPI_DETAIL_TTL] + [TORAPI_FIELD_TTL.get(field, TORAPI_DETAIL_TTL) for field in TORAPI_SOURCE_FIELDS.get(source_key, ())])
+
+    def get(self, provider, topic_id, ttl):
+        """Сохраненный ответ TorAPI, если он еще свежий (для "не найдено" - TORAPI_NOT_FOUND_TTL), иначе None."""
+        row = self.conn.execute("SELECT response, found, fetched_at FROM details WHERE provider = ? AND topic_id = ?", (provider, int(topic_id))).fetchone()
+        if row is None: return None
+        age = time.time() - row[2]
+        return json.loads(row[0]) if age < (ttl if row[1] else min(ttl, TORAPI_NOT_FOUND_TTL)) else None
+
+    def put(self, provider, topic_id, response, found):
+        self.conn.execute("INSERT OR REPLACE INTO details VALUES (?, ?, ?, ?, ?)", (provider, int(topic_id), json.dumps(response, ensure_ascii=False), int(found), time.time()))
+        self.conn.commit() # Сразу на диск: при падении посреди прогона уже полученные детали не теряются
+
+    async def get_or_fetch(self, provider, topic_id, ttl, fetch_fn, force=False):
+        """Ответ из кэша или через fetch_fn(); одновременные запросы одного (provider, topic_id) ждут один общий вызов."""
+        key = (provider, int(topic_id))
+        if not force and (cached := self.get(provider, topic_id, ttl)) is not None: self.hits += 1; METRICS.inc("torapi_cache_requests_total", result="hit"); return cached
+        if key in self._inflight: self.coalesced += 1; METRICS.inc("torapi_cache_requests_total", result="coalesced"); return await asyncio.shield(self._inflight[key])
+        task = asyncio.ensure_future(fetch_fn()); self._inflight[key] = task
+        try: response = await asyncio.shield(task)
+        finally: self._inflight.pop(key, None)
+        self.fetched += 1; METRICS.inc("torapi_cache_requests_total", result="fetched")
+        if isinstance(response, list) and response and isinstance(response[0], dict): self.put(provider, topic_id, response, True)
+        elif isinstance(response, dict) and response.get(provider, {}).get("Result", "").startswith("No matches"): self.put(provider, topic_id, response, False)
+        return response
+
+    def close(self):
+        logging.info(f"Кэш TorAPI: из кэша {self.hits}, запрошено {self.fetched}, объединено одновременных запросов {self.coalesced}")
+        self.conn.close()
+
+def make_thumbnail(image_bytes, content_type):
+    """Уменьшает постер до THUMBNAIL_SIZE (JPEG), если есть Pillow; иначе или для нераспознанного формата - исходные байты. Возвращает (bytes, расширение)."""
+    if Image is not None:
+        try:
+            with Image.open(io.BytesIO(image_bytes)) as image:
+                image.thumbnail(THUMBNAIL_SIZE); output = io.BytesIO()
+                image.convert('RGB').save(output, 'JPEG', quality=THUMBNAIL_JPEG_QUALITY, optimize=True)
+                return output.getvalue(), '.jpg'
+        except Exception as e: logging.debug(f"Pillow не смог обработать постер ({content_type}): {e}")
+    return image_bytes, mimetypes.guess_extension(content_type) or '.img'
+
+class PosterThumbnailCache:
+    """Локальные миниатюры постеров: файлы по sha256 содержимого в THUMBS_DIR, индекс URL -> файл (SQLite), вытеснение LRU по размеру и объединение одновременных загрузок одного URL."""
+    def __init__(self, thumbs_dir=THUMBS_DIR, index_path=THUMBS_INDEX_FILE, max_bytes=THUMBS_MAX_BYTES, backfill_per_run=THUMBNAIL_BACKFILL_PER_RUN):
+        self.thumbs_dir = thumbs_dir; self.max_bytes = max_bytes; self.backfill_per_run = backfill_per_run; self.hits = 0; self.fetched = 0; self.failed = 0; self._inflight = {}
+        os.makedirs(thumbs_dir, exist_ok=True)
+        self.conn = sqlite3.connect(index_path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS posters (url TEXT PRIMARY KEY, file TEXT NOT NULL, size INTEGER NOT NULL, used_at REAL NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS posters_file ON posters(file)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS failures (url TEXT PRIMARY KEY, failed_at REAL NOT NULL)")
+        self.conn.commit()
+        if Image is None: logging.info("Pillow не установлен: постеры сохраняются без уменьшения (pip install Pillow).")
+
+    def lookup(self, url):
+        """Имя файла миниатюры для URL, если файл на месте (с отметкой использования для LRU), иначе None."""
+        row = self.conn.execute("SELECT file FROM posters WHERE url = ?", (url,)).fetchone()
+        if row is None: return None
+        if not os.path.exists(os.path.join(self.thumbs_dir, row[0])): self.conn.execute("DELETE FROM posters WHERE file = ?", (row[0],)); self.conn.commit(); return None
+        self.conn.execute("UPDATE posters SET used_at = ? WHERE file = ?", (time.time(), row[0])); self.conn.commit()
+        return row[0]
+
+    async def fetch(self, engine, url):
+        """Загружает постер через движок (лимит на хост хостинга картинок), уменьшает и сохраняет под именем sha256. Возвращает имя файла или None."""
+        try:
+            result = await engine.get(url, POSTER_REQUEST_TIMEOUT, endpoint="poster")
+            content_type = result.headers.get('Content-Type', '').split(';')[0].strip().lower()
+            if not content_type.startswith('image/') or len(result.body) > POSTER_MAX_BYTES: raise ValueError(f"не постер ({content_type or 'без Content-Type'}, {len(result.body)} байт)")
+            data, extension = await asyncio.to_thread(make_thumbnail, result.body, content_type)
+        except (asyncio.TimeoutError, aiohttp.ClientError, ValueError) as e:
+            self.failed += 1; METRICS.inc("thumbnail_requests_total", result="failed"); logging.warning(f"Постер не загружен ({url}): {e}")
+            self.conn.execute("INSERT OR REPLACE INTO failures VALUES (?, ?)", (url, time.time())); self.conn.commit(); return None
+        file_name = f"{hashlib.sha256(data).hexdigest()}{extension}"; file_path = os.path.join(self.thumbs_dir, file_name); is_new_file = not os.path.exists(file_path)
+        if is_new_file:
+            with open(f"{file_path}.tmp", 'wb') as f: f.write(data)
+            os.replace(f"{file_path}.tmp", file_path)
+        self.conn.execute("INSERT OR REPLACE INTO posters VALUES (?, ?, ?, ?)", (url, file_name, len(data), time.time())); self.conn.execute("DELETE FROM failures WHERE url = ?", (url,)); self.conn.commit()
+        self.fetched += 1; METRICS.inc("thumbnail_requests_total", result="fetched"); METRICS.inc("thumbnail_bytes_total", len(data))
+        if is_new_file: self.evict()
+        return file_name
+
+    def stored_files(self):
+        """Имена файлов миниатюр, которые есть в индексе (вытесненные из него удалены)."""
+        return {file_name for (file_name,) in self.conn.execute("SELECT DISTINCT file FROM posters")}
+
+    def touch(self, file_names):
+        """Отмечает использование файлов, на которые ссылаются записи: file_names - от новых тем к старым, новые получают более позднее used_at.
+
+        Сетка открывается с новых тем, поэтому LRU вытесняет сначала миниатюры старых тем, а файлы без ссылок из записей - раньше всех.
+        """
+        now = time.time()
+        self.conn.executemany("UPDATE posters SET used_at = ? WHERE file = ?", [(now - rank * 1e-6, file_name) for rank, file_name in enumerate(dict.fromkeys(file_names))]); self.conn.commit()
+
+    def failed_recently(self, url):
+        """True, если постер не загрузился меньше THUMBNAIL_FAILURE_TTL сек назад (догрузка его пропускает)."""
+        return self.conn.execute("SELECT 1 FROM failures WHERE url = ? AND failed_at > ?", (url, time.time() - THUMBNAIL_FAILURE_TTL)).fetchone() is not None
+
+    async def localize(self, engine, record):
+        """Подменяет poster_url записи на локальную миниатюру, исходный адрес сохраняет в poster_remote_url. Если постер не загрузился, запись не меняется."""
+        remote_url = record.get('poster_url') or ''
+        if remote_url.startswith(REMOTE_PLACEHOLDER_PREFIX): record['poster_url'] = PLACEHOLDER_POSTER; return record
+        if not remote_url.startswith(('http://', 'https://')): return record # Уже локальный файл или заглушка
+        if (file_name := self.lookup(remote_url)) is not None: self.hits += 1; METRICS.inc("thumbnail_requests_total", result="hit")
+        elif remote_url in self._inflight: METRICS.inc("thumbnail_requests_total", result="coalesced"); file_name = await asyncio.shield(self._inflight[remote_url])
+        else:
+            task = asyncio.ensure_future(self.fetch(engine, remote_url)); self._inflight[remote_url] = task
+            try: file_name = await asyncio.shield(task)
+            finally: self._inflight.pop(remote_url, None)
+        if file_name: record['poster_remote_url'] = remote_url; record['poster_url'] = f"{THUMBS_URL_PREFIX}{file_name}"
+        return record
+
+    def evict(self):
+        """Удаляет файлы давно не использованных миниатюр, пока каталог не уложится в 90% лимита (записи со ссылкой на них восстанавливает догрузка PosterStage)."""
+        files = self.conn.execute("SELECT file, MAX(size), MAX(used_at) AS used FROM posters GROUP BY file ORDER BY used").fetchall()
+        total_size = sum(row[1] for row in files)
+        if total_size <= self.max_bytes: return
+        target = self.max_bytes * 0.9; removed = 0
+        for file_name, size, _ in files:
+            if total_size <= target: break
+            with contextlib.suppress(FileNotFoundError): os.remove(os.path.join(self.thumbs_dir, file_name))
+            self.conn.execute("DELETE FROM posters WHERE file = ?", (file_name,)); total_size -= size; removed += 1
+        self.conn.commit(); logging.info(f"Миниатюры: вытеснено {removed} файлов (LRU), размер {total_size / 1048576:.1f} МБ")
+
+    def close(self):
+        logging.info(f"Миниатюры постеров: из кэша {self.hits}, загружено {self.fetched}, ошибок {self.failed}")
+        self.conn.close()
+
+class AdaptiveHostLimiter:
+    """Лимитер одного хоста: token bucket (запросов/сек) + окно одновременных запросов, которое подстраивается по схеме AIMD.
+
+    Здоровые ответы аддитивно расширяют окно и темп; 429 мультипликативно сужает окно и темп, 5xx/таймауты и рост задержки - окно.
+    """
+    def __init__(self, host, max_rate, concurrency):
+        self.host = host; self.max_rate = max_rate; self.rate = max_rate / 2; self.tokens = 1.0; self.last_refill = time.monotonic()
+        self.concurrency = float(concurrency); self.max_concurrency = concurrency * AIMD_MAX_CONCURRENCY_FACTOR; self.in_flight = 0
+        self.latency_ewma = None; self.min_latency = None; self.last_decrease = 0.0
+        self._slots = asyncio.Condition(); self._token_lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.last_refill) * self.rate); self.last_refill = now
+
+    async def acquire(self):
+        """Ждет свободное место в окне и токен в корзине."""
+        async with self._slots:
+            await self._slots.wait_for(lambda: self.in_flight < max(1, int(self.concurrency)))
+            self.in_flight += 1
+        try:
+            async with self._token_lock:
+                self._refill()
+                if self.tokens < 1: await asyncio.sleep((1 - self.tokens) / self.rate); self._refill()
+                self.tokens -= 1
+        except BaseException:
+            async with self._slots: self.in_flight -= 1; self._slots.notify_all()
+            raise
+
+    def _decrease(self, factor, reason, include_rate=True):
+        now = time.monotonic()
+        if now - self.last_decrease < AIMD_DECREASE_COOLDOWN: return
+        self.last_decrease = now; self.concurrency = max(1.0, self.concurrency * factor)
+        if include_rate: self.rate = max(self.max_rate * AIMD_MIN_RATE_SHARE, self.rate * factor)
+        logging.warning(f"[{self.host}] {reason}: окно {self.concurrency:.1f}, темп {self.rate:.1f} запр/сек")
+
+    async def release(self, outcome, latency):
+        """Возвращает место в окне и подстраивает лимиты. outcome: 'ok' | 'throttled' (429) | 'error' (5xx, таймаут, обрыв)."""
+        async with self._slots:
+            self.in_flight -= 1
+            if outcome == 'ok':
+                self.min_latency = latency if self.min_latency is None else min(self.min_latency, latency)
+                self.latency_ewma = latency if self.latency_ewma is None else 0.8 * self.latency_ewma + 0.2 * latency
+                if self.latency_ewma > max(self.min_latency * AIMD_LATENCY_FACTOR, self.min_latency + AIMD_LATENCY_SLACK): self._decrease(0.8, "Рост задержки", include_rate=False)
+                else:
+                    self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+                    self.rate = min(self.max_rate, self.rate + self.max_rate * AIMD_RATE_STEP)
+            elif outcome == 'throttled': self._decrease(0.5, "429 Too Many Requests") # Явный сигнал: снижаем и окно, и темп
+            else: self._decrease(0.5, "Ошибка/таймаут", include_rate=False)
+            self._slots.notify_all()
+
+def parse_retry_after(value):
+    """Retry-After в секундах (поддерживается только числовая форма)."""
+    try: return min(float(value), HTTP_BACKOFF_MAX * 2) if value else None
+    except ValueError: return None
+
+class AsyncHttpEngine:
+    """Общий asyncio-движок: пул keep-alive соединений aiohttp и адаптивный лимитер (темп + окно) для каждого хоста."""
+    def __init__(self, host_settings=None, default_settings=(TRACKER_MAX_RPS, MAX_WORKERS_ID_FETCH), pool_limit=HTTP_POOL_LIMIT, http_cache=None, detail_cache=None, thumbnail_cache=None):
+        self.host_settings = dict(host_settings or {}); self.default_settings = default_settings; self.pool_limit = pool_limit
+        self.http_cache = http_cache; self.detail_cache = detail_cache; self.thumbnail_cache = thumbnail_cache; self.session = None; self._limiters = {}
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.pool_limit, limit_per_host=0, ttl_dns_cache=300, keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT)
+        self.session = aiohttp.ClientSession(connector=connector, headers=HEADERS, cookies=COOKIES or None)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.session.close()
+        if self.http_cache is not None: self.http_cache.close()
+        if self.detail_cache is not None: self.detail_cache.close()
+        if self.thumbnail_cache is not None: self.thumbnail_cache.close()
+
+    def limiter_for(self, url):
+        """Возвращает лимитер хоста из URL (создается при первом обращении с настройками (max_rps, окно))."""
+        host = urlparse(url).netloc
+        if host not in self._limiters: self._limiters[host] = AdaptiveHostLimiter(host, *self.host_settings.get(host, self.default_settings))
+        return self._limiters[host]
+
+    async def get(self, url, timeout, cookies=None, headers=None, endpoint=None):
+        """GET-запрос через общий пул с повторами (экспоненциальная задержка с джиттером, Retry-After).
+
+        Возвращает HttpResult; статусы >= 400 и ошибки сети после исчерпания повторов пробрасываются исключениями.
+        endpoint - фиксированная метка для метрик (для чужих хостов, где путь не ограничен: постеры); по умолчанию - endpoint_label(url).
+        """
+        limiter = self.limiter_for(url); host = limiter.host; endpoint = endpoint or endpoint_label(url)
+        for attempt in range(HTTP_MAX_RETRIES + 1):
+            with METRICS.timer("http_limiter_wait_seconds", host=host): await limiter.acquire()
+            started = time.monotonic(); outcome = 'error'; retry_after = None; status = 'error'
+            try:
+                async with self.session.get(url, timeout=aiohttp.ClientTimeout(total=timeout), cookies=cookies, headers=headers) as response:
+                    body = await response.read(); status = response.status
+                    METRICS.inc("http_response_bytes_total", len(body), host=host)
+                    outcome = 'throttled' if response.status == 429 else 'error' if response.status >= 500 else 'ok'
+                    if outcome == 'ok' and response.status < 400: return HttpResult(response.status, response.charset, body, response.headers)
+                    error = aiohttp.ClientResponseError(response.request_info, response.history, status=response.status, message=response.reason or "", headers=response.headers)
+                    if outcome == 'ok': raise error # Прочие 4xx не повторяем: хост здоров, ошибка в запросе
+                    retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            except (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError) as e: outcome = 'error'; error = e; status = type(e).__name__
+            finally:
+                latency = time.monotonic() - started; await limiter.release(outcome, latency)
+                METRICS.observe("http_request_duration_seconds", latency, host=host, endpoint=endpoint); METRICS.inc("http_requests_total", host=host, endpoint=endpoint, status=status)
+            if attempt == HTTP_MAX_RETRIES: raise error
+            METRICS.inc("http_retries_total", host=host, reason=status)
+            delay = retry_after if retry_after is not None else random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * 2 ** attempt))
+            logging.warning(f"Повтор {attempt + 1}/{HTTP_MAX_RETRIES} через {delay:.1f} сек ({type(error).__name__}: {getattr(error, 'status', error)}): {url}")
+            await asyncio.sleep(delay)
+
+def create_http_engine(use_cache=True, thumbnails=False, thumbnail_backfill=THUMBNAIL_BACKFILL_PER_RUN):
+    """Создает движок с лимитами: TorAPI - (TORAPI_MAX_RPS, MAX_WORKERS_TORAPI), трекеры и хостинги постеров - (TRACKER_MAX_RPS, MAX_WORKERS_ID_FETCH) на хост;
+    с дисковым HTTP-кэшем и кэшем TorAPI, а с thumbnails=True - и с локальными миниатюрами постеров (и догрузкой до thumbnail_backfill сохраненных за обновление)."""
+    return AsyncHttpEngine(host_settings={urlparse(TORAPI_BASE_URL).netloc: (TORAPI_MAX_RPS, MAX_WORKERS_TORAPI)}, default_settings=(TRACKER_MAX_RPS, MAX_WORKERS_ID_FETCH),
+                           http_cache=HttpCache() if use_cache else None, detail_cache=TorApiDetailCache() if use_cache else None, thumbnail_cache=PosterThumbnailCache(backfill_per_run=thumbnail_backfill) if thumbnails else None)
+
+async def fetch_cached(engine, url, timeout, specific_cookies=None, cache_ttl=0, default_charset='windows-1251'):
+    """Загрузка через HTTP-кэш движка. Возвращает (text, cache_key, unchanged); unchanged=True для свежей записи или ответа 304.
+
+    В пределах cache_ttl запрос не отправляется вовсе, после - условный запрос с If-None-Match/If-Modified-Since.
+    """
+    cache = engine.http_cache
+    if cache is None:
+        result = await engine.get(url, timeout, cookies=specific_cookies)
+        return result.body.decode(result.charset or default_charset, errors='replace'), None, False
+    cache_key = cache.make_key(url, dict(COOKIES, **(specific_cookies or {}))); entry = cache.get(cache_key)
+    if entry and time.time() - entry['fetched_at'] < cache_ttl:
+        cache.hits += 1; METRICS.inc("http_cache_requests_total", result="hit"); return entry['body'].decode(entry['charset'] or default_charset, errors='replace'), cache_key, True
+    conditional_headers = {}
+    if entry and entry['etag']: conditional_headers['If-None-Match'] = entry['etag']
+    if entry and entry['last_modified']: conditional_headers['If-Modified-Since'] = entry['last_modified']
+    result = await engine.get(url, timeout, cookies=specific_cookies, headers=conditional_headers or None)
+    if result.status == 304 and entry:
+        cache.mark_validated(cache_key); cache.revalidated += 1; METRICS.inc("http_cache_requests_total", result="revalidated"); logging.debug(f"304 Not Modified: {url}")
+        return entry['body'].decode(entry['charset'] or default_charset, errors='replace'), cache_key, True
+    cache.put(cache_key, url, result.headers.get('ETag'), result.headers.get('Last-Modified'), result.charset, result.body); cache.misses += 1; METRICS.inc("http_cache_requests_total", result="miss")
+    return result.body.decode(result.charset or default_charset, errors='replace'), cache_key, False
+
+async def fetch_html(url, engine, timeout, specific_cookies=None, cache_ttl=0):
+    """Загружает HTML контент страницы через общий движок с учетом специфичных кук."""
+    try: return (await fetch_cached(engine, url, timeout, specific_cookies, cache_ttl))[0]
+    except asyncio.TimeoutError: logging.error(f"Таймаут при запросе {url}"); return None
+    except aiohttp.ClientError as e: logging.error(f"Ошибка сети при загрузке {url}: {e}"); return None
+    except Exception as e: logging.error(f"Непредвиденная ошибка при загрузке {url}: {e}"); return None
+
+def timed_parse(parse_fn, text, parse_kind):
+    """Вызывает parse_fn(text) и записывает время разбора в метрику parse_duration_seconds."""
+    with METRICS.timer("parse_duration_seconds", kind=parse_kind): return parse_fn(text)
+
+async def fetch_and_parse(engine, url, timeout, parse_fn, specific_cookies=None, cache_ttl=0, default_charset='windows-1251', parse_kind='html'):
+    """Загружает страницу и разбирает ее parse_fn. Если ответ не изменился (304/свежий кэш), отдает сохраненный результат без парсинга."""
+    try: text, cache_key, unchanged = await fetch_cached(engine, url, timeout, specific_cookies, cache_ttl, default_charset)
+    except asyncio.TimeoutError: logging.error(f"Таймаут при запросе {url}"); return None
+    except aiohttp.ClientError as e: logging.error(f"Ошибка сети при загрузке {url}: {e}"); return None
     except Exception as e: logging.error(f"Непредвиденная ошибка при загрузке {url}: {e}"); return None
+    if unchanged and (parsed := engine.http_cache.get_parsed(cache_key)) is not None:
+        METRICS.inc("parse_skipped_total", kind=parse_kind); logging.debug(f"Без изменений, разбор пропущен: {url}"); return parsed
+    parsed = await asyncio.to_thread(timed_parse, parse_fn, text, parse_kind) # lxml отпускает GIL при разборе, цикл событий не блокируется
+    if cache_key and parsed is not None: engine.http_cache.set_parsed(cache_key, parsed)
+    return parsed
 
-def get_total_pages(forum_id, base_url, session_obj, source_key):
+async def get_total_pages(forum_id, base_url, engine, source_key):
     """Определяет общее количество страниц в разделе форума."""
     start_page_url = urljoin(base_url, f"viewforum.php?f={forum_id}")
     logging.info(f"[{source_key.upper()}] Определение кол-ва страниц: Загрузка {start_page_url}")
     source_cookies = globals().get(f"COOKIES_{source_key.upper()}")
-    html = fetch_html(start_page_url, session_obj, TRACKER_PAGE_REQUEST_TIMEOUT, specific_cookies=source_cookies)
-    if not html: return 0
+    total_pages = await fetch_and_parse(engine, start_page_url, TRACKER_PAGE_REQUEST_TIMEOUT, lambda html: parse_total_pages(html, source_key), specific_cookies=source_cookies, cache_ttl=SOURCES[source_key].get('cache_ttl', 0), parse_kind='total_pages')
+    return total_pages or 0
+
+# --- Быстрое извлечение ID и пагинации: lxml + заранее скомпилированные XPath ---
+# Каскады селекторов повторяют прежние BeautifulSoup find/select один в один (порядок важен: берется первое совпадение).
+def _xp_has_class(name):
+    """XPath-условие "в атрибуте class есть токен name" (аналог CSS .name / bs4 class_=name)."""
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+_html_parsers = threading.local() # Парсер lxml нельзя делить между потоками, разбор идет в asyncio.to_thread
+XP_RUTRACKER_TOPIC_TABLES = [etree.XPath(p) for p in (
+    "(//table[normalize-space(@class)='vf-table vf-tor forumline forum'])[1]",
+    f"(//table[{_xp_has_class('forumline')} and @id='tor-tbl'])[1]",
+    "(//table[@id='tor-tbl'])[1]",
+    f"(//table[{_xp_has_class('forumline')}])[1]",
+    f"(//table[{_xp_has_class('forum')}])[1]",
+)]
+XP_RUTRACKER_TOPIC_LINKS = [etree.XPath(p) for p in (
+    f".//a[{_xp_has_class('torTopic')} and {_xp_has_class('bold')} and {_xp_has_class('tt-text')} and contains(@href, 't=')]/@href",
+    f".//a[{_xp_has_class('torTopic')} and contains(@href, 't=')]/@href",
+    f".//a[{_xp_has_class('tt-text')} and contains(@href, 't=')]/@href",
+    f".//a[{_xp_has_class('topictitle')} and contains(@href, 't=')]/@href",
+)]
+XP_PORNOLAB_TOPIC_TABLES = [etree.XPath(p) for p in (f"(//table[{_xp_has_class('topic_list')}])[1]", f"(//table[{_xp_has_class('forumline')}])[1]")]
+XP_PORNOLAB_TOPIC_LINKS = [etree.XPath(f".//a[{_xp_has_class('topictitle')} and contains(@href, 't=')]/@href")]
+XP_PAGINATION_CONTAINERS = [etree.XPath(p) for p in (
+    "(//div[@id='pagination'])[1]",
+    f"(//div[{_xp_has_class('nav-top')}])[1]",
+    f"(//td[{_xp_has_class('nav')} and @align='right'])[1]",
+    f"(//td[{_xp_has_class('nav')}])[1]",
+    f"(//p[{_xp_has_class('pagination')}])[1]",
+)]
+XP_ANY_TOPIC_LINK = etree.XPath(f"(//a[{_xp_has_class('topictitle')} or {_xp_has_class('torTopic')}])[1]")
+XP_LINKS = etree.XPath(".//a")
+XP_PG_LINKS = etree.XPath(f".//a[{_xp_has_class('pg')}]")
+TOPIC_ID_RE = re.compile(r'[?&]t=(\d+)')
+START_RE = re.compile(r'[?&]start=(\d+)')
+
+def parse_html_tree(html):
+    """Строит дерево lxml без BeautifulSoup (None для пустого или неразбираемого документа)."""
+    if not html: return None
+    if not hasattr(_html_parsers, 'parser'): _html_parsers.parser = etree.HTMLParser(encoding='utf-8', recover=True, no_network=True, remove_comments=True)
+    try: return etree.fromstring(html.encode('utf-8', errors='replace'), _html_parsers.parser)
+    except etree.XMLSyntaxError: return None
+
+def _first_match(root, xpaths):
+    """Первый непустой результат из каскада XPath (как цепочка "a or b or c")."""
+    for xpath in xpaths:
+        found = xpath(root)
+        if found: return found
+    return []
+
+def _link_text(element):
+    """Аналог bs4 get_text(strip=True): склейка обрезанных текстовых узлов."""
+    return "".join(part.strip() for part in element.itertext())
+
+def parse_total_pages(html, source_key):
+    """Разбирает блок пагинации страницы раздела и возвращает количество страниц."""
     try:
-        soup = BeautifulSoup(html, 'lxml')
-        pagination_container = soup.find('div', id='pagination') or soup.find('div', class_='nav-top') or soup.find('td', class_='nav', align='right') or soup.find('td', class_='nav') or soup.find('p', class_='pagination')
-        if not pagination_container:
-            if soup.select_one('a.topictitle, a.torTopic'): logging.warning(f"[{source_key.upper()}] Пагинация не найдена, но темы есть. Считаем 1 страницу."); return 1
+        root = parse_html_tree(html)
+        if root is None: logging.error(f"[{source_key.upper()}] Пустая страница."); return 0
+        pagination_container = next(iter(_first_match(root, XP_PAGINATION_CONTAINERS)), None)
+        if pagination_container is None:
+            if XP_ANY_TOPIC_LINK(root): logging.warning(f"[{source_key.upper()}] Пагинация не найдена, но темы есть. Считаем 1 страницу."); return 1
             else: logging.error(f"[{source_key.upper()}] Пагинация и темы не найдены."); return 0
-        all_links = pagination_container.find_all('a')
+        all_links = XP_LINKS(pagination_container)
         if not all_links:
-             if soup.select_one('a.topictitle, a.torTopic'): logging.info(f"[{source_key.upper()}] Контейнер пагинации найден, но ссылок нет. Считаем 1 страницу."); return 1
+             if XP_ANY_TOPIC_LINK(root): logging.info(f"[{source_key.upper()}] Контейнер пагинации найден, но ссылок нет. Считаем 1 страницу."); return 1
              else: logging.warning(f"[{source_key.upper()}] Контейнер пагинации найден, но тем и ссылок нет."); return 0
         max_page_num = 1; found_page_number = False
         for link in all_links:
-            link_text = link.get_text(strip=True)
+            link_text = _link_text(link)
             if link_text.isdigit():
                 try: max_page_num = max(max_page_num, int(link_text)); found_page_number = True
                 except ValueError: continue
         if not found_page_number and max_page_num == 1:
-             if soup.select_one('a.topictitle, a.torTopic'): logging.warning(f"[{source_key.upper()}] Номера страниц в пагинации не найдены. Предполагаем 1 страницу."); return 1
+             if XP_ANY_TOPIC_LINK(root): logging.warning(f"[{source_key.upper()}] Номера страниц в пагинации не найдены. Предполагаем 1 страницу."); return 1
              else: logging.warning(f"[{source_key.upper()}] Номера страниц и темы не найдены."); return 0
         logging.info(f"[{source_key.upper()}] Определено страниц по макс. номеру: {max_page_num}")
         last_start = 0
         last_page_link = None
-        if len(pagination_links := pagination_container.find_all('a', class_='pg')) > 0:
+        if len(pagination_links := XP_PG_LINKS(pagination_container)) > 0:
             maybe_last = pagination_links[-1]
-            if maybe_last.get_text(strip=True).isdigit(): last_page_link = maybe_last
-            elif len(pagination_links) > 1 and pagination_links[-2].get_text(strip=True).isdigit(): last_page_link = pagination_links[-2]
-        if last_page_link and last_page_link.has_attr('href'):
-             match = re.search(r'[?&]start=(\d+)', last_page_link['href'])
+            if _link_text(maybe_last).isdigit(): last_page_link = maybe_last
+            elif len(pagination_links) > 1 and _link_text(pagination_links[-2]).isdigit(): last_page_link = pagination_links[-2]
+        if last_page_link is not None and last_page_link.get('href') is not None:
+             match = START_RE.search(last_page_link.get('href'))
              if match: last_start = int(match.group(1))
         total_pages_by_start = (last_start // ITEMS_PER_PAGE_TRACKER) + 1
         final_total_pages = max(max_page_num, total_pages_by_start)
@@ -116,168 +695,506 @@ def get_total_pages(forum_id, base_url, session_obj, source_key):
         return final_total_pages
     except Exception as e: logging.error(f"[{source_key.upper()}] Ошибка парсинга пагинации: {e}"); logging.exception("Traceback:"); return 0
 
-def fetch_and_extract_ids_from_page(page_url, page_num_display, source_key):
+async def fetch_and_extract_ids_from_page(engine, page_url, page_num_display, source_key):
     """Загружает страницу форума и извлекает все ID тем, адаптируясь к источнику."""
-    thread_name = threading.current_thread().name
-    ids_on_page = set(); html = None
-    logging.info(f"[{thread_name}-{source_key.upper()}] Загрузка ID со стр. {page_num_display} ({page_url})...")
+    logging.info(f"[{source_key.upper()}] Загрузка ID со стр. {page_num_display} ({page_url})...")
     try:
-        time.sleep(random.uniform(WORKER_SLEEP_MIN, WORKER_SLEEP_MAX))
         source_cookies = globals().get(f"COOKIES_{source_key.upper()}")
-        html = fetch_html(page_url, session, TRACKER_PAGE_REQUEST_TIMEOUT, specific_cookies=source_cookies)
-        if html:
-            soup = BeautifulSoup(html, 'lxml');
-            topic_table = None
-            topic_links = []
-            if source_key in ['rutracker', 'rutracker_886']:
-                 # Добавляем новые селекторы для поиска таблицы
-                 topic_table = (
-                     soup.find('table', class_='vf-table vf-tor forumline forum') or 
-                     soup.find('table', class_='forumline', id='tor-tbl') or 
-                     soup.find('table', id='tor-tbl') or 
-                     soup.find('table', class_='forumline') or
-                     soup.find('table', class_='forum')  # Добавлен новый селектор
-                 )
-                 if topic_table:
-                     # Расширяем поиск ссылок на темы
-                     topic_links = (
-                         topic_table.select('a.torTopic.bold.tt-text[href*="t="]') or 
-                         topic_table.select('a.torTopic[href*="t="]') or
-                         topic_table.select('a.tt-text[href*="t="]') or  # Добавлен новый селектор
-                         topic_table.select('a.topictitle[href*="t="]')  # Добавлен новый селектор
-                     )
-            elif source_key == 'pornolab':
-                 topic_table = soup.find('table', class_='topic_list') or soup.find('table', class_='forumline')
-                 if topic_table: topic_links = topic_table.select('a.topictitle[href*="t="]')
-            else: logging.error(f"[{thread_name}-{source_key.upper()}] Неизвестный источник '{source_key}'!")
-            if topic_table and topic_links:
-                processed_links = 0
-                for link_tag in topic_links:
-                    href = link_tag.get('href', ''); match = re.search(r'[?&]t=(\d+)', href)
-                    if match: ids_on_page.add(match.group(1)); processed_links += 1
-                logging.info(f"[{thread_name}-{source_key.upper()}] Стр. {page_num_display}: Найдено ссылок с ID: {processed_links} -> Уник. ID: {len(ids_on_page)}")
-            elif not topic_table: logging.warning(f"[{thread_name}-{source_key.upper()}] Не найдена таблица тем на стр. {page_num_display} ({page_url})")
-            else: logging.warning(f"[{thread_name}-{source_key.upper()}] Не найдены ссылки на темы внутри таблицы на стр. {page_num_display}")
-        return ids_on_page
-    except Exception as e: logging.error(f"[{thread_name}-{source_key.upper()}] Критическая ошибка на стр. {page_num_display}: {e}"); logging.exception("Traceback:"); return set()
-
-def fetch_details_from_torapi(endpoint_path):
-    """Запрашивает детали у локального TorAPI."""
-    api_url = f"{TORAPI_BASE_URL}{endpoint_path}"
+        ids_on_page = await fetch_and_parse(engine, page_url, TRACKER_PAGE_REQUEST_TIMEOUT, lambda html: extract_ids_from_html(html, source_key, page_num_display, page_url), specific_cookies=source_cookies, cache_ttl=SOURCES[source_key].get('cache_ttl', 0), parse_kind='listing')
+        return set(ids_on_page or [])
+    except Exception as e: logging.error(f"[{source_key.upper()}] Критическая ошибка на стр. {page_num_display}: {e}"); logging.exception("Traceback:"); return set()
+
+def extract_ids_from_html(html, source_key, page_num_display, page_url):
+    """Извлекает ID тем из HTML страницы раздела. Возвращает отсортированный список (пригоден для кэша разбора)."""
+    ids_on_page = set()
+    root = parse_html_tree(html)
+    if source_key in ['rutracker', 'rutracker_886']: table_xpaths, link_xpaths = XP_RUTRACKER_TOPIC_TABLES, XP_RUTRACKER_TOPIC_LINKS
+    elif source_key == 'pornolab': table_xpaths, link_xpaths = XP_PORNOLAB_TOPIC_TABLES, XP_PORNOLAB_TOPIC_LINKS
+    else: logging.error(f"[{source_key.upper()}] Неизвестный источник '{source_key}'!"); return []
+    topic_table = next(iter(_first_match(root, table_xpaths)), None) if root is not None else None
+    topic_links = _first_match(topic_table, link_xpaths) if topic_table is not None else []
+    if topic_table is not None and topic_links:
+        processed_links = 0
+        for href in topic_links:
+            match = TOPIC_ID_RE.search(href)
+            if match: ids_on_page.add(match.group(1)); processed_links += 1
+        logging.info(f"[{source_key.upper()}] Стр. {page_num_display}: Найдено ссылок с ID: {processed_links} -> Уник. ID: {len(ids_on_page)}")
+    elif topic_table is None: logging.warning(f"[{source_key.upper()}] Не найдена таблица тем на стр. {page_num_display} ({page_url})")
+    else: logging.warning(f"[{source_key.upper()}] Не найдены ссылки на темы внутри таблицы на стр. {page_num_display}")
+    return sorted(ids_on_page, key=int, reverse=True)
+
+async def fetch_details_from_torapi(engine, endpoint_path):
+    """Запрашивает детали у локального TorAPI через общий пул соединений."""
+    api_url = f"{TORAPI_BASE_URL}{endpoint_path}"; body = b""
     try:
-        response = requests.get(api_url, timeout=TORAPI_REQUEST_TIMEOUT); response.raise_for_status(); return response.json()
-    except requests.exceptions.Timeout: logging.error(f"Таймаут TorAPI: {api_url}"); return None
-    except requests.exceptions.RequestException as e: logging.error(f"Ошибка сети TorAPI ({api_url}): {e}"); return None
-    except json.JSONDecodeError as e: logging.error(f"Ошибка JSON от TorAPI ({api_url}): {e} - Ответ: {response.text[:200]}..."); return None
+        result = await engine.get(api_url, TORAPI_REQUEST_TIMEOUT); body = result.body; return json.loads(body.decode(result.charset or 'utf-8'))
+    except asyncio.TimeoutError: logging.error(f"Таймаут TorAPI: {api_url}"); return None
+    except aiohttp.ClientError as e: logging.error(f"Ошибка сети TorAPI ({api_url}): {e}"); return None
+    except json.JSONDecodeError as e: logging.error(f"Ошибка JSON от TorAPI ({api_url}): {e} - Ответ: {body[:200]}..."); return None
     except Exception as e: logging.error(f"Непредв. ошибка TorAPI ({api_url}): {e}"); return None
 
-def worker_torapi_details(task_queue, results_list, results_lock, source_key):
-    """Поток-воркер: берет ID, запрашивает ДЕТАЛИ у TorAPI, добавляет source, обрабатывает поля и кладет результат."""
+async def fetch_topic_details(engine, provider_name, topic_id, source_key, force=False):
+    """Детали темы через кэш TorAPI движка (с TTL для источника) или напрямую, если кэш отключен."""
+    endpoint = f"/api/search/id/{provider_name}?query={topic_id}"
+    if engine.detail_cache is None: return await fetch_details_from_torapi(engine, endpoint)
+    return await engine.detail_cache.get_or_fetch(provider_name, topic_id, TorApiDetailCache.ttl_for_source(source_key), lambda: fetch_details_from_torapi(engine, endpoint), force=force)
+
+def build_topic_record(api_data, topic_id, source_key):
+    """Превращает ответ TorAPI в запись для JSON: добавляет source и обрабатывает поля."""
+    original_title = api_data.get("Name", f"ID:{topic_id}")
+    title = original_title.replace("[Nintendo Switch]", "[NS]").strip() if source_key == 'rutracker' else original_title.strip()
+    link = api_data.get("Url", f"{SOURCES[source_key]['base_url']}viewtopic.php?t={topic_id}")
+    poster_url = api_data.get("Poster", PLACEHOLDER_POSTER) or PLACEHOLDER_POSTER
+    magnet_link = api_data.get("Magnet", "")
+    full_desc_html = "<p><em>(Описание для этого источника не отображается)</em></p>"
+    desc_text = ""
+    if source_key != 'pornolab':
+        desc_text = api_data.get("Description", "")
+        full_desc_html = f"<p>{desc_text.replace(chr(10), '<br>')}</p>" if desc_text else "<p><em>Описание отсутствует.</em></p>"
+    year = api_data.get("Year", "-"); genre = api_data.get("Type", "-"); voice_lang = api_data.get("Voice", "-")
+    text_lang = api_data.get("Lang", "-"); age_rating = api_data.get("Age", "-"); multiplayer_status = api_data.get("Multiplayer", "неизвестно")
+    has_mp = False; type_str = genre.lower(); desc_lower = desc_text.lower()
+    mp_kw = ["мультиплеер", "multiplayer", "сетевая", "online", "кооператив", "co-op", "онлайн"]; no_mp = ["мультиплеер: нет", "multiplayer: no"]
+    if multiplayer_status.lower() != 'нет' and multiplayer_status != "неизвестно": has_mp = True
+    elif multiplayer_status == "неизвестно" and any(kw in desc_lower or kw in type_str for kw in mp_kw) and not any(ph in desc_lower for ph in no_mp): has_mp = True
+    result = {'source': source_key, 'title': title,'link': link,'topic_id': topic_id,'poster_url': poster_url,'full_description_html': full_desc_html,'has_multiplayer': has_mp, 'magnet_link': magnet_link, 'year': year, 'genre': genre, 'voice_lang': voice_lang, 'text_lang': text_lang, 'age_rating': age_rating, 'multiplayer_status': multiplayer_status}
+    if source_key == 'pornolab':
+         seeds_str = api_data.get("Seeds", "0") or "0"; peers_str = api_data.get("Peers", "0") or "0"
+         size_str = api_data.get("Size", "-") or "-"; video_str = api_data.get("Video", "-") or "-"
+         genre_pl = api_data.get("Type", "-") or "-"
+         result['Seeds'] = seeds_str.strip(); result['Peers'] = peers_str.strip()
+         result['Size'] = size_str.replace("\xa0", " ").strip(); result['Video'] = video_str.strip()
+         result['Type'] = genre_pl.strip();
+         if 'genre' in result: del result['genre']
+    return result
+
+async def worker_torapi_details(engine, task_queue, results_queue, source_key, worker_name):
+    """Корутина-воркер: берет ID из asyncio.Queue, запрашивает ДЕТАЛИ у TorAPI и кладет готовую запись в results_queue (ждет, если очередь полна)."""
     provider_name = SOURCES.get(source_key, {}).get("provider_name", source_key)
     while True:
-        topic_id = task_queue.get();
+        topic_id = await task_queue.get()
         if topic_id is None: task_queue.task_done(); break
         try:
-            thread_name = threading.current_thread().name; logging.info(f"[{thread_name}-{source_key.upper()}] Запрос деталей ID: {topic_id}")
-            endpoint = f"/api/search/id/{provider_name}?query={topic_id}"; api_data_list = fetch_details_from_torapi(endpoint)
+            logging.info(f"[{worker_name}-{source_key.upper()}] Запрос деталей ID: {topic_id}")
+            api_data_list = await fetch_topic_details(engine, provider_name, topic_id, source_key)
             if api_data_list and isinstance(api_data_list, list) and len(api_data_list) > 0:
                 api_data = api_data_list[0]
                 if isinstance(api_data, dict):
-                    original_title = api_data.get("Name", f"ID:{topic_id}")
-                    title = original_title.replace("[Nintendo Switch]", "[NS]").strip() if source_key == 'rutracker' else original_title.strip()
-                    link = api_data.get("Url", f"{SOURCES[source_key]['base_url']}viewtopic.php?t={topic_id}")
-                    poster_url = api_data.get("Poster", PLACEHOLDER_POSTER) or PLACEHOLDER_POSTER
-                    magnet_link = api_data.get("Magnet", "")
-                    full_desc_html = "<p><em>(Описание для этого источника не отображается)</em></p>"
-                    desc_text = ""
-                    if source_key != 'pornolab':
-                        desc_text = api_data.get("Description", "")
-                        full_desc_html = f"<p>{desc_text.replace(chr(10), '<br>')}</p>" if desc_text else "<p><em>Описание отсутствует.</em></p>"
-                    year = api_data.get("Year", "-"); genre = api_data.get("Type", "-"); voice_lang = api_data.get("Voice", "-")
-                    text_lang = api_data.get("Lang", "-"); age_rating = api_data.get("Age", "-"); multiplayer_status = api_data.get("Multiplayer", "неизвестно")
-                    has_mp = False; type_str = genre.lower(); desc_lower = desc_text.lower()
-                    mp_kw = ["мультиплеер", "multiplayer", "сетевая", "online", "кооператив", "co-op", "онлайн"]; no_mp = ["мультиплеер: нет", "multiplayer: no"]
-                    if multiplayer_status.lower() != 'нет' and multiplayer_status != "неизвестно": has_mp = True
-                    elif multiplayer_status == "неизвестно" and any(kw in desc_lower or kw in type_str for kw in mp_kw) and not any(ph in desc_lower for ph in no_mp): has_mp = True
-                    result = {'source': source_key, 'title': title,'link': link,'topic_id': topic_id,'poster_url': poster_url,'full_description_html': full_desc_html,'has_multiplayer': has_mp, 'magnet_link': magnet_link, 'year': year, 'genre': genre, 'voice_lang': voice_lang, 'text_lang': text_lang, 'age_rating': age_rating, 'multiplayer_status': multiplayer_status}
-                    if source_key == 'pornolab':
-                         seeds_str = api_data.get("Seeds", "0") or "0"; peers_str = api_data.get("Peers", "0") or "0"
-                         size_str = api_data.get("Size", "-") or "-"; video_str = api_data.get("Video", "-") or "-"
-                         genre_pl = api_data.get("Type", "-") or "-"
-                         result['Seeds'] = seeds_str.strip(); result['Peers'] = peers_str.strip()
-                         result['Size'] = size_str.replace("\xa0", " ").strip(); result['Video'] = video_str.strip()
-                         result['Type'] = genre_pl.strip();
-                         if 'genre' in result: del result['genre']
-                    with results_lock: results_list.append(result)
-                    logging.debug(f"[{thread_name}-{source_key.upper()}] Успешно ID {topic_id}")
-                else: logging.warning(f"[{thread_name}-{source_key.upper()}] Неверный формат элемента ID {topic_id}: {api_data}")
-            elif isinstance(api_data_list, dict) and api_data_list.get(provider_name, {}).get("Result", "").startswith("No matches"): logging.warning(f"[{thread_name}-{source_key.upper()}] TorAPI не нашел ID {topic_id}.")
-            else: logging.warning(f"[{thread_name}-{source_key.upper()}] Пропуск ID {topic_id} (TorAPI data: {str(api_data_list)[:200]}...)")
-        except Exception as e: logging.error(f"[{thread_name}-{source_key.upper()}] Ошибка воркера деталей ID {topic_id}: {e}")
+                    await results_queue.put(build_topic_record(api_data, topic_id, source_key))
+                    logging.debug(f"[{worker_name}-{source_key.upper()}] Успешно ID {topic_id}")
+                else: METRICS.inc("topics_failed_total", source=source_key, reason="invalid"); logging.warning(f"[{worker_name}-{source_key.upper()}] Неверный формат элемента ID {topic_id}: {api_data}")
+            elif isinstance(api_data_list, dict) and api_data_list.get(provider_name, {}).get("Result", "").startswith("No matches"): METRICS.inc("topics_failed_total", source=source_key, reason="not_found"); logging.warning(f"[{worker_name}-{source_key.upper()}] TorAPI не нашел ID {topic_id}.")
+            else: METRICS.inc("topics_failed_total", source=source_key, reason="no_data"); logging.warning(f"[{worker_name}-{source_key.upper()}] Пропуск ID {topic_id} (TorAPI data: {str(api_data_list)[:200]}...)")
+        except Exception as e: METRICS.inc("topics_failed_total", source=source_key, reason="error"); logging.error(f"[{worker_name}-{source_key.upper()}] Ошибка воркера деталей ID {topic_id}: {e}")
         finally: task_queue.task_done()
 
 # --- !!! НОВАЯ ФУНКЦИЯ ДЛЯ ЗАГРУЗКИ И ПАРСИНГА RSS !!! ---
-def fetch_and_parse_rss(rss_url):
-    """Загружает и парсит Atom/RSS ленту, возвращает список словарей."""
+async def fetch_and_parse_rss(engine, rss_url, source_key, forum_id, cache_ttl=0):
+    """Загружает и парсит Atom/RSS ленту через общий движок и HTTP-кэш, возвращает список словарей."""
     logging.info(f"Загрузка RSS: {rss_url}")
-    rss_items = []
+    rss_items = await fetch_and_parse(engine, rss_url, RSS_REQUEST_TIMEOUT, lambda xml_content: parse_rss_xml(xml_content, rss_url, source_key, forum_id), cache_ttl=cache_ttl, default_charset='utf-8', parse_kind='rss')
+    return rss_items or []
+
+def _xml_local_name(tag): return tag.rsplit('}', 1)[-1] # Имя тега без namespace
+
+def rss_entry_to_record(entry, source_key, forum_id):
+    """Превращает элемент <entry> (Atom) или <item> (RSS 2.0) в запись для JSON."""
+    fields = {}; link = None
+    for child in entry:
+        name = _xml_local_name(child.tag)
+        if name == 'link':
+            href = child.attrib.get('href') or (child.text or '').strip()
+            if link is None or child.attrib.get('rel', 'alternate') == 'alternate': link = href
+        elif name == 'author': fields['author'] = (child.findtext('{*}name') or child.text or '').strip()
+        else: fields[name] = (child.text or '').strip()
+    link = link or "#"; match = TOPIC_ID_RE.search(link)
+    published_date_str = fields.get('published') or fields.get('pubDate', ''); updated_date_str = fields.get('updated') or published_date_str
+    return {'source': source_key, 'title': fields.get('title') or "Без названия", 'link': link, 'topic_id': match.group(1) if match else None, 'forum_id': forum_id, 'author': fields.get('author') or "Неизвестен", 'published': published_date_str, 'updated': updated_date_str, 'poster_url': PLACEHOLDER_POSTER, 'has_multiplayer': False, 'magnet_link': '', 'full_description_html': f'<p>Опубликовано: {published_date_str}<br>Обновлено: {updated_date_str}</p>' }
+
+def parse_rss_xml(xml_content, rss_url, source_key='rutracker_rss', forum_id=None):
+    """Потоково разбирает Atom/RSS ленту (XMLPullParser): записи обрабатываются по мере закрытия тегов и сразу освобождаются, дерево целиком не строится."""
+    rss_items = []; pull_parser = ET.XMLPullParser(events=('end',))
     try:
-        response = requests.get(rss_url, headers=HEADERS, timeout=RSS_REQUEST_TIMEOUT)
-        response.raise_for_status()
-        response.encoding = 'utf-8'
-        xml_content = response.text
-        try: root = ET.fromstring(xml_content)
-        except ET.ParseError as e_xml: logging.error(f"Ошибка парсинга XML из {rss_url}: {e_xml}"); logging.error(f"Начало XML: {xml_content[:500]}..."); return []
-        ns = {}
-        if root.tag.startswith('{'): ns['atom'] = root.tag.split('}')[0].strip('{')
-        else: ns['atom'] = 'http://www.w3.org/2005/Atom'
-        logging.debug(f"Используется namespace: {ns}")
-
-        for entry in root.findall('atom:entry', ns):
-            title_tag = entry.find('atom:title', ns); title = title_tag.text if title_tag is not None else "Без названия"
-            link_tag = entry.find('atom:link[@rel="alternate"]', ns) or entry.find('atom:link', ns)
-            link = link_tag.attrib.get('href') if link_tag is not None else "#"
-            published_tag = entry.find('atom:published', ns); updated_tag = entry.find('atom:updated', ns); author_tag = entry.find('atom:author/atom:name', ns)
-            topic_id = None; match = re.search(r'[?&]t=(\d+)', link);
-            if match: topic_id = match.group(1)
-            published_date_str = published_tag.text if published_tag is not None else ""
-            updated_date_str = updated_tag.text if updated_tag is not None else published_date_str
-            item_data = {'source': 'rutracker_rss', 'title': title.strip(), 'link': link, 'topic_id': topic_id, 'author': author_tag.text.strip() if author_tag is not None else "Неизвестен", 'published': published_date_str, 'updated': updated_date_str, 'poster_url': PLACEHOLDER_POSTER, 'has_multiplayer': False, 'magnet_link': '', 'full_description_html': f'<p>Опубликовано: {published_date_str}<br>Обновлено: {updated_date_str}</p>' }
-            rss_items.append(item_data)
-        logging.info(f"Успешно обработано {len(rss_items)} записей из RSS.")
-        return rss_items
-    except requests.exceptions.RequestException as e: logging.error(f"Ошибка сети при загрузке RSS {rss_url}: {e}"); return []
+        for offset in range(0, len(xml_content), RSS_PARSE_CHUNK_SIZE):
+            pull_parser.feed(xml_content[offset:offset + RSS_PARSE_CHUNK_SIZE])
+            for _, element in pull_parser.read_events():
+                if _xml_local_name(element.tag) in ('entry', 'item'): rss_items.append(rss_entry_to_record(element, source_key, forum_id)); element.clear()
+        pull_parser.close()
+    except ET.ParseError as e_xml: logging.error(f"Ошибка парсинга XML из {rss_url} (оставлено записей до ошибки: {len(rss_items)}): {e_xml}"); logging.error(f"Начало XML: {xml_content[:500]}...")
     except Exception as e: logging.error(f"Неожиданная ошибка при обработке RSS {rss_url}: {e}"); logging.exception("Traceback:"); return []
+    logging.info(f"Успешно обработано {len(rss_items)} записей из RSS {rss_url}.")
+    return rss_items
+
+def rss_entry_time(record):
+    """Время обновления записи ленты (ISO 8601 у Atom, RFC 822 у RSS 2.0) для сравнения версий; нераспознанное - минимальное."""
+    value = record.get('updated') or ''
+    try: parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        try: parsed = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError): return datetime.min.replace(tzinfo=timezone.utc)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+async def enrich_rss_entry(engine, source_key, entry, known):
+    """Дополняет запись ленты деталями TorAPI (постер, описание, magnet...), сохраняя поля ленты.
+
+    Для уже сохраненной темы (known) кэш TorAPI обходится: новая версия в ленте значит, что раздача изменилась. Если деталей нет,
+    у сохраненной темы обновляются только поля ленты, чтобы не затереть полученные ранее детали заглушками.
+    """
+    provider_name = SOURCES[source_key].get("provider_name", source_key)
+    api_data_list = await fetch_topic_details(engine, provider_name, entry['topic_id'], source_key, force=known)
+    if isinstance(api_data_list, list) and api_data_list and isinstance(api_data_list[0], dict):
+        return {**build_topic_record(api_data_list[0], entry['topic_id'], source_key), **{field: entry[field] for field in RSS_FEED_FIELDS}}
+    METRICS.inc("topics_failed_total", source=source_key, reason="no_data"); logging.warning(f"[{source_key.upper()}] Нет деталей TorAPI для ID {entry['topic_id']}, сохраняем данные ленты.")
+    return {field: entry[field] for field in ('source', 'topic_id', *RSS_FEED_FIELDS)} if known else entry
+
+async def refresh_rss_source(engine, source_key, output_file_path):
+    """Загружает все ленты источника одновременно и дописывает в хранилище только новые и изменившиеся записи. Возвращает True при успехе.
+
+    Ленты задаются списком "rss_forum_ids" (по умолчанию - "forum_id"). Повторы темы в разных лентах сводятся к версии с самым
+    поздним updated; история прежних прогонов остается в хранилище, JSON-файл и шарды выгружаются только при изменениях.
+    """
+    source_config = SOURCES[source_key]; rss_start_time = time.time()
+    store = get_data_store(); store.import_json_file(output_file_path) # Разовый перенос прежнего rss_data.json: история не теряется
+    forum_ids = source_config.get('rss_forum_ids') or [source_config['forum_id']]
+    feeds = await asyncio.gather(*(fetch_and_parse_rss(engine, source_config['rss_url'].format(forum_id=forum_id), source_key, forum_id, source_config.get('cache_ttl', 0)) for forum_id in forum_ids))
+    if not any(feeds): logging.error("Не удалось получить или обработать данные RSS."); return False
+    latest = {}
+    for entry in itertools.chain.from_iterable(feeds):
+        if entry['topic_id'] is not None and (entry['topic_id'] not in latest or rss_entry_time(entry) > rss_entry_time(latest[entry['topic_id']])): latest[entry['topic_id']] = entry
+    stored = store.get_records(source_key, latest)
+    changed = [entry for topic_id, entry in latest.items() if topic_id not in stored or rss_entry_time(entry) > rss_entry_time(stored[topic_id])]
+    METRICS.inc("topics_found_total", len(latest), source=source_key); METRICS.inc("topics_skipped_total", len(latest) - len(changed), source=source_key)
+    logging.info(f"[{source_key.upper()}] Лент: {len(forum_ids)}, записей: {sum(map(len, feeds))}, уникальных тем: {len(latest)}, новых или обновленных: {len(changed)}")
+    if changed and source_config.get('torapi_enrich'):
+        changed = await asyncio.gather(*(enrich_rss_entry(engine, source_key, entry, entry['topic_id'] in stored) for entry in changed))
+    poster_stage = PosterStage(engine, store, source_key) if engine.thumbnail_cache is not None else None
+    if changed:
+        with METRICS.timer("store_write_seconds", source=source_key): added_count, updated_count = store.upsert_many(changed)
+        METRICS.inc("topics_new_total", added_count, source=source_key); METRICS.inc("topics_updated_total", updated_count, source=source_key)
+        logging.info(f"Добавлено: {added_count}, Обновлено: {updated_count} записей для {output_file_path}.")
+        if poster_stage is not None: poster_stage.submit(changed)
+    posters_localized = await poster_stage.close() if poster_stage is not None else 0
+    with METRICS.timer("export_seconds", source=source_key):
+        data_saved_successfully = await export_store_serving(store, output_file_path) if changed or posters_localized or serving_manifest_outdated(output_file_path, source_key) else True
+    rss_end_time = time.time(); logging.info(f"--- Время обработки RSS: {rss_end_time - rss_start_time:.2f} сек ---")
+    return data_saved_successfully
+
+async def run_rss_source(source_key, output_file_path, use_cache=True, thumbnails=False, thumbnail_backfill=THUMBNAIL_BACKFILL_PER_RUN):
+    """Обновляет один RSS-источник на отдельном экземпляре движка (интерактивный запуск из __main__)."""
+    async with create_http_engine(use_cache=use_cache, thumbnails=thumbnails, thumbnail_backfill=thumbnail_backfill) as engine: return await refresh_rss_source(engine, source_key, output_file_path)
 # --- КОНЕЦ НОВОЙ ФУНКЦИИ ---
 
 
-def update_and_save_data(new_data_list, filename):
-    """Читает существующие данные, добавляет/обновляет новыми, сортирует и сохраняет."""
-    existing_data = []; existing_ids = set()
-    if os.path.exists(filename):
+# --- Поисковый индекс: токены и фасеты записей ---
+def search_tokens(text):
+    """Токены для полнотекстового поиска (русский/английский): нижний регистр, ё -> е, буквы и цифры; однобуквенные слова отбрасываются."""
+    return [token for token in SEARCH_TOKEN_RE.findall(str(text).lower().replace('ё', 'е')) if len(token) > 1 or token.isdigit()]
+
+def record_field(record, field):
+    """Значение поля индекса из записи с учетом SEARCH_FIELD_ALIASES (первое непустое)."""
+    for name in SEARCH_FIELD_ALIASES.get(field, (field,)):
+        value = record.get(name)
+        if value not in (None, ''): return value
+    return None
+
+def record_facets(record):
+    """Пары (фасет, значение) записи: год, жанры (через запятую), языки, мультиплеер. Пустые значения и "-" пропускаются."""
+    for facet in SEARCH_FACET_FIELDS:
+        raw_value = record_field(record, facet)
+        if facet == 'has_multiplayer': yield facet, 'true' if raw_value else 'false'; continue
+        values = str(raw_value).split(',') if facet == 'genre' and raw_value else [raw_value]
+        for value in values:
+            value = str(value).strip() if value is not None else ''
+            if value and value != '-': yield facet, value
+
+def record_seeds(record):
+    """Число сидов записи (поле "Seeds" есть только у pornolab), 0 - если неизвестно."""
+    try: return int(str(record.get('Seeds', 0)).strip() or 0)
+    except ValueError: return 0
+
+def record_search_terms(record):
+    """Все термы записи для индекса: токены текстовых полей и фасеты вида "facet=value" (с токенами не пересекаются)."""
+    terms = set()
+    for field in SEARCH_TEXT_FIELDS: terms.update(search_tokens(record_field(record, field) or ''))
+    terms.update(f"{facet}={value}" for facet, value in record_facets(record))
+    return terms
+
+def record_card(record):
+    """Компактная строка плитки (значения SEARCH_CARD_FIELDS по порядку); полная запись читается из шарда только для модального окна."""
+    return [record_field(record, field) for field in SEARCH_CARD_FIELDS]
+
+def write_search_snapshot(path, positions, titles, years, postings, cards):
+    """Пишет снимок индекса для server.js: постинги - позиции записей в шардах поколения (дельта-кодирование), счетчики фасетов, порядки сортировки и плитки.
+
+    postings - (term, topic_id), отсортированные по term; positions - {topic_id: позиция}; cards - record_card() по позициям.
+    """
+    facet_postings = {}; facet_counts = {}
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{"total_items": %d, "terms": {' % len(titles)); written_terms = 0
+        for term, group in itertools.groupby(postings, key=lambda posting: posting[0]):
+            term_positions = sorted(positions[topic_id] for _, topic_id in group if topic_id in positions)
+            if not term_positions: continue
+            deltas = [term_positions[0]] + [b - a for a, b in zip(term_positions, term_positions[1:])]
+            if '=' in term:
+                facet, value = term.split('=', 1)
+                facet_postings.setdefault(facet, {})[value] = deltas; facet_counts.setdefault(facet, {})[value] = len(term_positions); continue
+            f.write(("," if written_terms else "") + json.dumps(term, ensure_ascii=False) + ":" + json.dumps(deltas, separators=(',', ':'))); written_terms += 1
+        title_order = sorted(range(len(titles)), key=titles.__getitem__); year_order = sorted(range(len(years)), key=years.__getitem__)
+        f.write('}, "facet_postings": ' + json.dumps(facet_postings, ensure_ascii=False, separators=(',', ':')))
+        f.write(', "facets": ' + json.dumps(facet_counts, ensure_ascii=False, separators=(',', ':')))
+        f.write(', "orders": {"title": ' + json.dumps(title_order, separators=(',', ':')) + ', "year": ' + json.dumps(year_order, separators=(',', ':')) + '}')
+        f.write(', "card_fields": ' + json.dumps(SEARCH_CARD_FIELDS) + ', "cards": [' + ','.join(json.dumps(card, ensure_ascii=False, separators=(',', ':')) for card in cards) + ']}')
+    return written_terms
+
+def write_serving_pages(source, records, search_postings, serving_dir=SERVING_DIR, shard_size=SERVING_SHARD_SIZE):
+    """Выгружает записи источника (по возрастанию topic_id) в страницы-шарды для server.js: страница API читает только нужные шарды.
+
+    Шарды нумеруются со старого конца (в файле - от новых к старым), поэтому новые темы меняют только последний шард.
+    Шард с тем же содержимым (хэш в манифесте), что и в предыдущем поколении, не пишется заново, а связывается жесткой ссылкой.
+    Шарды нового поколения лежат в отдельном каталоге <source>/<generation>/, затем атомарно подменяется manifest.json;
+    читатель всегда видит целое поколение. Предыдущее поколение остается для запросов, начатых до подмены, более старые удаляются.
+    Рядом пишется снимок поискового индекса (search.json): постинги из search_postings (term, topic_id) по возрастанию term.
+    """
+    source_dir = os.path.join(serving_dir, source); manifest_path = os.path.join(source_dir, "manifest.json")
+    try:
+        with open(manifest_path, encoding='utf-8') as f: previous = json.load(f)
+        previous_generation = int(previous.get('generation', 0))
+    except (OSError, ValueError, AttributeError): previous = {}; previous_generation = 0
+    previous_hashes = previous.get('shard_hashes', []) if previous.get('shard_order') == SERVING_SHARD_ORDER and previous.get('shard_size') == shard_size else []
+    generation = previous_generation + 1; generation_dir = os.path.join(source_dir, str(generation)); shards = []; shard_hashes = []; reused = 0; total_items = 0; shard = []
+    topic_ids = []; titles = []; years = []; cards = []
+    try:
+        shutil.rmtree(generation_dir, ignore_errors=True); os.makedirs(generation_dir)
+        def flush_shard():
+            nonlocal reused
+            index = len(shards); shard_name = f"{generation}/{index:05d}.json"; shard_path = os.path.join(source_dir, shard_name)
+            payload = json.dumps(shard[::-1], ensure_ascii=False).encode('utf-8'); shard_hash = hashlib.sha1(payload).hexdigest()
+            try:
+                if index >= len(previous_hashes) or previous_hashes[index] != shard_hash: raise FileNotFoundError
+                os.link(os.path.join(source_dir, previous['shards'][index]), shard_path); reused += 1 # Шард не изменился
+            except OSError:
+                with open(shard_path, 'wb') as f: f.write(payload)
+            shards.append(shard_name); shard_hashes.append(shard_hash)
+        for record in records:
+            topic_ids.append(int(record['topic_id']))
+            titles.append(str(record.get('title') or '').casefold()); years.append(int(record['year']) if str(record.get('year', '')).isdigit() else 0); cards.append(record_card(record))
+            shard.append(record); total_items += 1
+            if len(shard) >= shard_size: flush_shard(); shard = []
+        if shard: flush_shard()
+        positions = {topic_id: total_items - 1 - i for i, topic_id in enumerate(topic_ids)} # Позиция 0 - самая новая запись
+        titles.reverse(); years.reverse(); cards.reverse()
+        search_name = f"{generation}/search.json"
+        with METRICS.timer("search_index_write_seconds", source=source):
+            search_terms_count = write_search_snapshot(os.path.join(source_dir, search_name), positions, titles, years, search_postings, cards)
+        manifest = {"source": source, "generation": generation, "shard_size": shard_size, "shard_order": SERVING_SHARD_ORDER, "total_items": total_items,
+                    "shards": shards, "shard_hashes": shard_hashes, "search": search_name, "search_version": SEARCH_INDEX_VERSION, "updated_at": datetime.now(timezone.utc).isoformat(timespec='seconds')}
+        with open(f"{manifest_path}.tmp", 'w', encoding='utf-8') as f: json.dump(manifest, f, ensure_ascii=False, indent=1)
+        os.replace(f"{manifest_path}.tmp", manifest_path)
+    except (OSError, TypeError, ValueError) as e: logging.error(f"Ошибка выгрузки страниц {source} в {source_dir}: {e}"); return False
+    for entry in os.listdir(source_dir): # Удаляем поколения старше предыдущего
+        if entry.isdigit() and int(entry) < previous_generation: shutil.rmtree(os.path.join(source_dir, entry), ignore_errors=True)
+    METRICS.inc("serving_shards_total", len(shards) - reused, source=source, result="written"); METRICS.inc("serving_shards_total", reused, source=source, result="reused")
+    logging.info(f"Страницы для API: {source} - {total_items} записей в {len(shards)} шардах по {shard_size} (записано {len(shards) - reused}, без изменений {reused}), термов в индексе: {search_terms_count} (поколение {generation}).")
+    return True
+
+class DataStore:
+    """Индексированное хранилище записей (SQLite) с ключом (source, topic_id): upsert за O(новых), дешевые проверки наличия, упорядоченное чтение."""
+    def __init__(self, path=DATA_STORE_FILE, migrate=True):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL"); self.conn.execute("PRAGMA synchronous=NORMAL")
+        if not migrate: return # Дополнительное соединение к уже открытому хранилищу (выгрузка в потоке): схема готова
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS topics (source TEXT NOT NULL, topic_id INTEGER NOT NULL, data TEXT NOT NULL, updated_at REAL,
+                             fetched_at REAL NOT NULL DEFAULT 0, seeds INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (source, topic_id)) WITHOUT ROWID""")
+        topic_columns = {row[1] for row in self.conn.execute("PRAGMA table_info(topics)")}
+        if 'fetched_at' not in topic_columns: self.conn.execute("ALTER TABLE topics ADD COLUMN fetched_at REAL NOT NULL DEFAULT 0") # 0 - время запроса деталей неизвестно
+        if 'seeds' not in topic_columns:
+            self.conn.execute("ALTER TABLE topics ADD COLUMN seeds INTEGER NOT NULL DEFAULT 0")
+            self.conn.executemany("UPDATE topics SET seeds = ? WHERE source = ? AND topic_id = ?", [(record_seeds(json.loads(data)), source, topic_id) for source, topic_id, data in self.conn.execute("SELECT source, topic_id, data FROM topics WHERE data LIKE '%\"Seeds\"%'").fetchall()])
+        self.conn.execute("CREATE TABLE IF NOT EXISTS imported_files (filename TEXT PRIMARY KEY, sources TEXT, imported_at REAL)")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS search_terms (source TEXT NOT NULL, term TEXT NOT NULL, topic_id INTEGER NOT NULL,
+                             PRIMARY KEY (source, term, topic_id)) WITHOUT ROWID""")
+        self.conn.commit()
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] < SEARCH_INDEX_VERSION: self.rebuild_search_index()
+
+    def rebuild_search_index(self):
+        """Перестраивает поисковый индекс по всем записям (при первом запуске и после смены правил токенизации)."""
+        with self.conn:
+            self.conn.execute("DELETE FROM search_terms")
+            for source, topic_id, data in self.conn.execute("SELECT source, topic_id, data FROM topics").fetchall(): self._update_search_terms(source, topic_id, set(), record_search_terms(json.loads(data)))
+            self.conn.execute(f"PRAGMA user_version = {SEARCH_INDEX_VERSION}")
+        logging.info(f"Поисковый индекс {self.path} перестроен.")
+
+    def _update_search_terms(self, source, topic_id, old_terms, new_terms):
+        """Применяет к постингам только разницу термов записи (внутри текущей транзакции)."""
+        self.conn.executemany("DELETE FROM search_terms WHERE source = ? AND term = ? AND topic_id = ?", [(source, term, topic_id) for term in old_terms - new_terms])
+        self.conn.executemany("INSERT OR IGNORE INTO search_terms VALUES (?, ?, ?)", [(source, term, topic_id) for term in new_terms - old_terms])
+
+    def iter_search_postings(self, source):
+        """Постинги источника (term, topic_id) по возрастанию term - для снимка индекса."""
+        yield from self.conn.execute("SELECT term, topic_id FROM search_terms WHERE source = ? ORDER BY term", (source,))
+
+    def stale_refresh_candidates(self, source, budget, max_age, exclude=()):
+        """До budget ID записей источника, детали которых запрошены раньше max_age сек назад, по убыванию приоритета обновления.
+
+        Приоритет = давность (log1p(возраст / max_age)) * новизна темы (1..2 по topic_id среди кандидатов) * популярность (1 + log1p(сидов)).
+        """
+        if budget <= 0: return []
+        now = time.time()
+        rows = [row for row in self.conn.execute("SELECT topic_id, fetched_at, seeds FROM topics WHERE source = ? AND fetched_at <= ?", (source, now - max_age)) if str(row[0]) not in exclude]
+        if not rows: return []
+        min_id = min(row[0] for row in rows); id_span = max(row[0] for row in rows) - min_id or 1
+        def priority(row): topic_id, fetched_at, seeds = row; return math.log1p((now - fetched_at) / max_age) * (1 + (topic_id - min_id) / id_span) * (1 + math.log1p(max(seeds, 0)))
+        return [str(row[0]) for row in heapq.nlargest(budget, rows, key=priority)]
+
+    def mark_fetched(self, source, topic_ids):
+        """Отмечает, что детали тем запрошены сейчас (в том числе безуспешно), чтобы они не занимали бюджет обновления каждый прогон."""
+        with self.conn: self.conn.executemany("UPDATE topics SET fetched_at = ? WHERE source = ? AND topic_id = ?", [(time.time(), source, int(tid)) for tid in topic_ids])
+
+    def import_json_file(self, filename):
+        """Однократно переносит существующий JSON-файл источника в хранилище (миграция со старого формата)."""
+        key = os.path.basename(filename)
+        if self.conn.execute("SELECT 1 FROM imported_files WHERE filename = ?", (key,)).fetchone(): return
+        records = []
+        if os.path.exists(filename):
+            try:
+                with open(filename, 'r', encoding='utf-8') as f: records = json.load(f)
+                if not isinstance(records, list): logging.warning(f"{filename} не список."); records = []
+            except Exception as e: logging.error(f"Ошибка чтения {filename}: {e}."); return
+        added, updated = self.upsert_many(records, fetched_at=0) # Когда запрашивались детали из файла - неизвестно: первыми в очереди обновления
+        file_sources = sorted({item['source'] for item in records if isinstance(item, dict) and 'source' in item})
+        self.conn.execute("INSERT OR REPLACE INTO imported_files VALUES (?, ?, ?)", (key, json.dumps(file_sources), time.time())); self.conn.commit()
+        logging.info(f"Импортировано в {self.path}: {added + updated} записей из {filename}.")
+
+    def upsert_many(self, records, fetched_at=None):
+        """Добавляет/обновляет записи одной транзакцией (существующие дополняются как dict.update). Возвращает (added, updated).
+
+        fetched_at - когда получены детали записей (по умолчанию сейчас); по нему выбираются устаревшие записи для обновления.
+        """
+        added_count = 0; updated_count = 0; now = time.time(); fetched_at = now if fetched_at is None else fetched_at
+        with self.conn:
+            for new_item in records:
+                if not isinstance(new_item, dict) or 'topic_id' not in new_item or 'source' not in new_item: continue
+                try: topic_id = int(new_item['topic_id'])
+                except (TypeError, ValueError): continue
+                row = self.conn.execute("SELECT data FROM topics WHERE source = ? AND topic_id = ?", (new_item['source'], topic_id)).fetchone()
+                if row is None: merged = new_item; old_terms = set(); added_count += 1
+                else: merged = json.loads(row[0]); old_terms = record_search_terms(merged); merged.update(new_item); updated_count += 1
+                self.conn.execute("INSERT OR REPLACE INTO topics VALUES (?, ?, ?, ?, ?, ?)", (new_item['source'], topic_id, json.dumps(merged, ensure_ascii=False), now, fetched_at, record_seeds(merged)))
+                self._update_search_terms(new_item['source'], topic_id, old_terms, record_search_terms(merged)) # Индекс обновляется вместе с записью
+        return added_count, updated_count
+
+    def iter_posters(self, source):
+        """(topic_id, poster_url, poster_remote_url) записей источника с удаленным постером или локальной миниатюрой, новые темы сначала."""
+        query = f"""SELECT topic_id, json_extract(data, '$.poster_url') AS url, json_extract(data, '$.poster_remote_url') FROM topics
+                    WHERE source = ? AND (url LIKE 'http://%' OR url LIKE 'https://%' OR url LIKE '{THUMBS_URL_PREFIX}%') ORDER BY topic_id DESC"""
+        for topic_id, url, remote_url in self.conn.execute(query, (source,)): yield str(topic_id), url, remote_url
+
+    def replace_posters(self, source, replacements):
+        """Подменяет poster_url сохраненных записей: [(topic_id, прежний URL, новый URL)].
+
+        Удаленный прежний URL при замене на миниатюру уходит в poster_remote_url; при возврате к удаленному постеру (миниатюра вытеснена
+        и не загрузилась) poster_remote_url убирается. Запись, у которой постер успел смениться, не трогается; время запроса деталей (fetched_at)
+        не меняется. Возвращает число измененных записей.
+        """
+        changed = 0
+        with self.conn:
+            for topic_id, previous_url, new_url in replacements:
+                row = self.conn.execute("SELECT data FROM topics WHERE source = ? AND topic_id = ?", (source, int(topic_id))).fetchone()
+                if row is None or (record := json.loads(row[0])).get('poster_url') != previous_url: continue
+                record['poster_url'] = new_url
+                if not new_url.startswith(THUMBS_URL_PREFIX): record.pop('poster_remote_url', None)
+                elif not previous_url.startswith(THUMBS_URL_PREFIX): record['poster_remote_url'] = previous_url
+                self.conn.execute("UPDATE topics SET data = ?, updated_at = ? WHERE source = ? AND topic_id = ?", (json.dumps(record, ensure_ascii=False), time.time(), source, int(topic_id))); changed += 1
+        return changed
+
+    def known_ids(self, source, topic_ids):
+        """Возвращает подмножество topic_ids, уже сохраненных для источника (запрос по первичному ключу)."""
+        topic_ids = [str(tid) for tid in topic_ids]; known = set()
+        for i in range(0, len(topic_ids), 500):
+            chunk = topic_ids[i:i + 500]
+            rows = self.conn.execute(f"SELECT topic_id FROM topics WHERE source = ? AND topic_id IN ({','.join('?' * len(chunk))})", [source, *map(int, chunk)])
+            known.update(str(row[0]) for row in rows)
+        return known
+
+    def get_records(self, source, topic_ids):
+        """Сохраненные записи источника по списку ID: {topic_id (str): запись}."""
+        topic_ids = [int(tid) for tid in topic_ids]; records = {}
+        for i in range(0, len(topic_ids), 500):
+            chunk = topic_ids[i:i + 500]
+            for topic_id, data in self.conn.execute(f"SELECT topic_id, data FROM topics WHERE source = ? AND topic_id IN ({','.join('?' * len(chunk))})", [source, *chunk]): records[str(topic_id)] = json.loads(data)
+        return records
+
+    def count(self, sources):
+        return self.conn.execute(f"SELECT COUNT(*) FROM topics WHERE source IN ({','.join('?' * len(sources))})", list(sources)).fetchone()[0]
+
+    def iter_records(self, sources, limit=-1, offset=0, ascending=False):
+        """Записи источников по убыванию (ascending=True - по возрастанию) topic_id (с пагинацией), без загрузки всей таблицы в память."""
+        query = f"SELECT data FROM topics WHERE source IN ({','.join('?' * len(sources))}) ORDER BY topic_id {'ASC' if ascending else 'DESC'} LIMIT ? OFFSET ?"
+        for (data,) in self.conn.execute(query, [*sources, limit, offset]): yield json.loads(data)
+
+    def export_sources(self, filename):
+        """Источники, которые попадают в JSON-файл: по SOURCES и по содержимому файла на момент импорта."""
+        key = os.path.basename(filename)
+        file_sources = {source_key for source_key, config in SOURCES.items() if config['output_json'] == key}
+        row = self.conn.execute("SELECT sources FROM imported_files WHERE filename = ?", (key,)).fetchone()
+        if row and row[0]: file_sources.update(json.loads(row[0]))
+        return sorted(file_sources)
+
+    def export_json(self, filename):
+        """Потоково и атомарно выгружает записи файла в JSON-массив по убыванию topic_id (--export-json: server.js без шардов и внешние потребители)."""
+        sources = self.export_sources(filename); tmp_path = f"{filename}.tmp"; written = 0
         try:
-            with open(filename, 'r', encoding='utf-8') as f: existing_data = json.load(f)
-            if isinstance(existing_data, list):
-                for item in existing_data:
-                    if isinstance(item, dict) and 'topic_id' in item and 'source' in item: existing_ids.add(f"{item['source']}-{item['topic_id']}")
-                logging.info(f"Прочитано {len(existing_data)} записей из {filename}.")
-            else: logging.warning(f"{filename} не список."); existing_data = []
-        except Exception as e: logging.error(f"Ошибка чтения {filename}: {e}."); existing_data = []
-    else: logging.info(f"Файл {filename} не найден."); existing_data = []
-    added_count = 0; updated_count = 0
-    current_data_map = {f"{item['source']}-{item['topic_id']}": item for item in existing_data if isinstance(item, dict) and 'topic_id' in item and 'source' in item}
-    for new_item in new_data_list:
-        if not isinstance(new_item, dict) or 'topic_id' not in new_item or 'source' not in new_item: continue
-        unique_key = f"{new_item['source']}-{new_item['topic_id']}"
-        if unique_key not in current_data_map: current_data_map[unique_key] = new_item; added_count += 1
-        else: current_data_map[unique_key].update(new_item); updated_count += 1
-    logging.info(f"Добавлено: {added_count}, Обновлено: {updated_count} записей для {filename}.")
-    final_data = sorted(current_data_map.values(), key=lambda x: int(x.get('topic_id', 0)), reverse=True)
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write("[")
+                for item in self.iter_records(sources):
+                    f.write(",\n" if written else "\n"); f.write(json.dumps(item, ensure_ascii=False)); written += 1
+                f.write("\n]\n")
+            os.replace(tmp_path, filename)
+            logging.info(f"Экспортировано {written} записей в {filename}.")
+        except Exception as e: logging.error(f"Ошибка сохранения {filename}: {e}"); return False
+        return True
+
+    def export_serving(self, filename):
+        """Выгружает источники файла в шарды и снимок поиска для server.js (serving/<source>/) - выгрузка после каждого обновления."""
+        sources = self.export_sources(filename); serving_dir = os.path.join(os.path.dirname(os.path.abspath(filename)), SERVING_DIR)
+        return all(write_serving_pages(source, self.iter_records([source], ascending=True), self.iter_search_postings(source), serving_dir) for source in sources)
+
+    def close(self):
+        self.conn.close()
+
+_data_store = None
+_export_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="Export") # Выгрузки идут вне цикла событий и по одной за раз
+
+def export_store_snapshot(store_path, output_file_path):
+    """Выгрузка шардов через отдельное соединение: одна транзакция чтения (WAL) дает согласованный снимок, пока писатели других источников продолжают запись."""
+    store = DataStore(store_path, migrate=False)
+    try: store.conn.execute("BEGIN"); return store.export_serving(output_file_path)
+    finally: store.conn.rollback(); store.close()
+
+async def export_store_serving(store, output_file_path):
+    """Выгружает шарды источников файла в потоке выгрузки: в режимах --all/--daemon остальные источники не ждут цикл событий, а лимитеры не принимают простой за задержку хоста."""
+    return await asyncio.get_running_loop().run_in_executor(_export_executor, export_store_snapshot, store.path, output_file_path)
+
+def export_json_files(source_keys):
+    """--export-json: выгружает JSON-файлы источников из хранилища (прежний файл сначала импортируется, чтобы не потерять его записи)."""
+    store = get_data_store(); results = []
+    for filename in sorted({os.path.abspath(SOURCES[key]['output_json']) for key in source_keys}):
+        store.import_json_file(filename)
+        with METRICS.timer("export_seconds", source="json"): results.append(store.export_json(filename))
+    return all(results)
+
+def serving_manifest_outdated(output_file_path, source_key):
+    """True, если для источника еще нет шардов или search.json собран по старой версии индекса (тогда выгрузка нужна даже без новых записей)."""
     try:
-        logging.info(f"Сохранение {len(final_data)} записей в {filename}")
-        with open(filename, 'w', encoding='utf-8') as f: json.dump(final_data, f, ensure_ascii=False, indent=4)
-        logging.info(f"Обновленные данные сохранены в {filename}."); return True
-    except Exception as e: logging.error(f"Ошибка сохранения {filename}: {e}"); return False
+        with open(os.path.join(os.path.dirname(os.path.abspath(output_file_path)), SERVING_DIR, source_key, "manifest.json"), encoding='utf-8') as f: return json.load(f).get('search_version', 1) < SEARCH_INDEX_VERSION
+    except (OSError, ValueError, AttributeError, TypeError): return True
+
+def get_data_store():
+    """Общее хранилище записей процесса (открывается при первом обращении)."""
+    global _data_store
+    if _data_store is None: _data_store = DataStore()
+    return _data_store
 
 def start_server_and_open_browser(backend_port):
     """Просто открывает URL бэкенда в браузере."""
@@ -285,19 +1202,400 @@ def start_server_and_open_browser(backend_port):
     try: time.sleep(1); logging.info(f"Открытие {url_to_open}..."); webbrowser.open(url_to_open)
     except Exception as e: logging.error(f"Ошибка открытия браузера: {e}")
 
+def load_crawl_state(state_file=CRAWL_STATE_FILE):
+    """Читает состояние инкрементального обхода {source: {"high_water_mark": int, ...}}."""
+    if not os.path.exists(state_file): return {}
+    try:
+        with open(state_file, 'r', encoding='utf-8') as f: state = json.load(f)
+        return state if isinstance(state, dict) else {}
+    except Exception as e: logging.warning(f"Не удалось прочитать {state_file}: {e}"); return {}
+
+def save_crawl_state(state, state_file=CRAWL_STATE_FILE):
+    """Атомарно сохраняет состояние обхода (через временный файл)."""
+    tmp_path = f"{state_file}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(state, f, ensure_ascii=False, indent=4)
+        os.replace(tmp_path, state_file)
+    except Exception as e: logging.error(f"Ошибка сохранения {state_file}: {e}")
+
+def ask_pages_to_scan(total_pages_available):
+    """Интерактивно спрашивает кол-во страниц. Пустой ввод = инкрементальный режим (возвращает None)."""
+    while True:
+        try:
+            prompt = f"Найдено страниц: {total_pages_available}. Сколько сканировать для НОВЫХ ID (1-{total_pages_available}, Enter - до первых известных тем): "
+            user_input = input(prompt).strip()
+            if not user_input: logging.info("Выбран инкрементальный режим."); return None
+            num_pages_to_scan_user = int(user_input)
+            if 1 <= num_pages_to_scan_user <= total_pages_available: logging.info(f"Будет просканировано страниц: {num_pages_to_scan_user}"); return num_pages_to_scan_user
+            else: print(f"Ошибка: Введите число от 1 до {total_pages_available}.")
+        except ValueError: print("Введите целое число.")
+        except EOFError: logging.warning("Ввод прерван."); sys.exit(0)
+        except KeyboardInterrupt: logging.warning("Операция прервана."); sys.exit(0)
+
+def update_high_water_mark(source_key, max_stored_id):
+    """Поднимает high-water mark источника до максимального сохраненного ID."""
+    if not max_stored_id: return
+    crawl_state = load_crawl_state(); source_state = crawl_state.setdefault(source_key, {})
+    source_state['high_water_mark'] = max(int(source_state.get('high_water_mark', 0)), int(max_stored_id))
+    source_state['last_run'] = datetime.now(timezone.utc).isoformat(timespec='seconds')
+    save_crawl_state(crawl_state); logging.info(f"[{source_key.upper()}] Новый high-water mark: {source_state['high_water_mark']}")
+
+class CrawlPipeline:
+    """Потоковый обход одного источника: страницы -> ограниченная очередь ID -> воркеры TorAPI -> ограниченная очередь записей -> пакетная запись.
+
+    Очереди ограничены, поэтому память не растет с числом страниц: сканер ждет, пока воркеры разберут ID, а воркеры - пока писатель сохранит пакет.
+    """
+    def __init__(self, source_key, store, queue_size=PIPELINE_QUEUE_SIZE, batch_size=PIPELINE_BATCH_SIZE, stop_event=None, poster_stage=None):
+        self.source_key = source_key; self.store = store; self.batch_size = batch_size; self.stop_event = stop_event; self.interrupted = False; self.poster_stage = poster_stage
+        self.ids_queue = asyncio.Queue(maxsize=queue_size); self.results_queue = asyncio.Queue(maxsize=queue_size)
+        self.in_progress_ids = set() # Только ID в работе (поставлены в очередь, но еще не записаны)
+        self.refresh_ids = set() # Сохраненные ранее ID, поставленные на обновление деталей
+        self.max_stored_id = 0; self.pages_scanned = 0; self.ids_found = 0; self.ids_queued = 0; self.added = 0; self.updated = 0; self.refreshed = 0
+
+    def should_stop(self):
+        """True, если запрошена остановка: сканер больше не берет страницы, а уже найденные ID дорабатываются и сохраняются."""
+        if self.stop_event is not None and self.stop_event.is_set():
+            if not self.interrupted: logging.warning(f"[{self.source_key.upper()}] Остановка: новые страницы не запрашиваются, дописываем начатое...")
+            self.interrupted = True
+        return self.interrupted
+
+    async def put_id(self, topic_id):
+        """Ставит ID в очередь деталей; ожидание места прерывается остановкой. Возвращает False, если ID не поставлен (остановка)."""
+        if self.should_stop(): return False
+        try: self.ids_queue.put_nowait(topic_id); return True
+        except asyncio.QueueFull:
+            if self.stop_event is None: await self.ids_queue.put(topic_id); return True
+        put_task = asyncio.ensure_future(self.ids_queue.put(topic_id)); stop_task = asyncio.ensure_future(self.stop_event.wait())
+        try: await asyncio.wait((put_task, stop_task), return_when=asyncio.FIRST_COMPLETED)
+        finally: stop_task.cancel()
+        if put_task.done(): return True
+        put_task.cancel(); self.should_stop(); return False # Отмененный put элемент в очередь не добавляет
+
+    async def submit_page_ids(self, ids_from_page):
+        """Сразу отправляет новым воркерам ID страницы, которых нет в хранилище и в работе. Возвращает множество уже сохраненных ID."""
+        self.pages_scanned += 1; self.ids_found += len(ids_from_page)
+        known_ids = self.store.known_ids(self.source_key, ids_from_page); new_ids = sorted(ids_from_page - known_ids - self.in_progress_ids, key=int, reverse=True) # Новые сначала
+        METRICS.inc("pages_scanned_total", source=self.source_key); METRICS.inc("topics_found_total", len(ids_from_page), source=self.source_key)
+        METRICS.inc("topics_skipped_total", len(ids_from_page) - len(new_ids), source=self.source_key)
+        if known_ids: self.max_stored_id = max(self.max_stored_id, max(int(tid) for tid in known_ids))
+        for index, topic_id in enumerate(new_ids):
+            self.in_progress_ids.add(topic_id) # До ожидания места: другие корутины страниц не поставят тот же ID
+            if not await self.put_id(topic_id): # Остановка: ID страницы, не попавшие в очередь, отбрасываются (отметка не поднимается - подберет следующий прогон)
+                self.in_progress_ids.difference_update(new_ids[index:]); METRICS.inc("topics_dropped_total", len(new_ids) - index, source=self.source_key); break
+            self.ids_queued += 1
+            METRICS.gauge_max("pipeline_queue_depth_max", self.ids_queue.qsize(), source=self.source_key, queue="ids")
+        return known_ids
+
+    async def submit_refresh_ids(self, topic_ids):
+        """Ставит в очередь деталей устаревшие сохраненные записи (после обхода страниц, чтобы новые темы шли первыми)."""
+        for topic_id in topic_ids:
+            if self.should_stop(): break
+            if topic_id in self.in_progress_ids: continue
+            self.in_progress_ids.add(topic_id)
+            if not await self.put_id(topic_id): self.in_progress_ids.discard(topic_id); break
+            self.refresh_ids.add(topic_id)
+
+    def write_batch(self, batch):
+        """Сохраняет пакет записей в хранилище одной транзакцией."""
+        with METRICS.timer("store_write_seconds", source=self.source_key): added, updated = self.store.upsert_many(batch)
+        refreshed = sum(1 for record in batch if str(record['topic_id']) in self.refresh_ids)
+        self.added += added; self.updated += updated; self.refreshed += refreshed
+        METRICS.inc("topics_new_total", added, source=self.source_key); METRICS.inc("topics_updated_total", updated, source=self.source_key); METRICS.inc("topics_refreshed_total", refreshed, source=self.source_key)
+        for record in batch: self.in_progress_ids.discard(str(record['topic_id'])); self.max_stored_id = max(self.max_stored_id, int(record['topic_id']))
+        if self.poster_stage is not None: self.poster_stage.submit(batch) # Постеры - после записи, отдельной стадией
+        logging.info(f"[{self.source_key.upper()}] Записан пакет из {len(batch)} тем (всего новых: {self.added}, обновлено: {self.updated}, в очереди деталей: {self.ids_queue.qsize()})")
+
+    async def writer(self):
+        """Корутина-писатель: копит записи из results_queue и сохраняет их каждые batch_size штук (None - конец потока)."""
+        batch = []
+        while True:
+            METRICS.gauge_max("pipeline_queue_depth_max", self.results_queue.qsize(), source=self.source_key, queue="results")
+            record = await self.results_queue.get()
+            if record is not None: batch.append(record)
+            if batch and (record is None or len(batch) >= self.batch_size):
+                try: self.write_batch(batch)
+                except Exception as e: logging.error(f"[{self.source_key.upper()}] Ошибка записи пакета ({len(batch)} тем): {e}")
+                batch = []
+            self.results_queue.task_done()
+            if record is None: break
+
+class PosterStage:
+    """Стадия миниатюр после писателя: своя очередь и корутины, локальный poster_url дописывается в хранилище пакетами.
+
+    Медленный или недоступный хостинг картинок задерживает только эту стадию: запись не ждет места в очереди, а постеры,
+    не поместившиеся в нее, остаются удаленными до следующего прогона.
+    """
+    def __init__(self, engine, store, source_key, workers=POSTER_WORKERS, queue_size=PIPELINE_QUEUE_SIZE, batch_size=PIPELINE_BATCH_SIZE):
+        self.engine = engine; self.store = store; self.source_key = source_key; self.batch_size = batch_size
+        self.queue = asyncio.Queue(maxsize=queue_size); self.replacements = []; self.localized = 0; self.deferred = 0; self.started_at = time.time()
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(workers)]
+
+    def submit(self, records):
+        """Ставит в очередь записи с удаленным постером, не дожидаясь места: при полной очереди постер откладывается."""
+        for record in records:
+            remote_url = str(record.get('poster_url') or '')
+            if not remote_url.startswith(('http://', 'https://')): continue
+            try: self.queue.put_nowait((str(record['topic_id']), remote_url, remote_url))
+            except asyncio.QueueFull: self.deferred += 1; METRICS.inc("thumbnail_requests_total", result="deferred")
+
+    async def submit_backfill(self):
+        """Догрузка: до backfill_per_run сохраненных записей, у которых постер все еще удаленный или миниатюра вытеснена (без недавно не загрузившихся).
+
+        Вытесненная миниатюра, которую сейчас не загрузить (лимит или недавняя ошибка), сразу заменяется обратно на poster_remote_url.
+        Файлы, на которые ссылаются записи, отмечаются как использованные (cache.touch).
+        """
+        cache = self.engine.thumbnail_cache; queued = 0; reverted = 0; stored_files = cache.stored_files(); referenced = []
+        for topic_id, poster_url, remote_url in self.store.iter_posters(self.source_key):
+            if poster_url.startswith(THUMBS_URL_PREFIX):
+                file_name = poster_url[len(THUMBS_URL_PREFIX):]
+                if file_name in stored_files: referenced.append(file_name); continue
+                if not remote_url: continue # Адрес оригинала неизвестен
+            else: remote_url = poster_url
+            if queued >= cache.backfill_per_run or cache.failed_recently(remote_url):
+                if poster_url != remote_url: self.replacements.append((topic_id, poster_url, remote_url)); reverted += 1
+                continue
+            await self.queue.put((topic_id, poster_url, remote_url)); queued += 1
+        cache.touch(referenced); self.flush()
+        if queued or reverted: logging.info(f"[{self.source_key.upper()}] Догрузка миниатюр сохраненных записей: {queued} (лимит {cache.backfill_per_run}), возвращено к удаленному постеру: {reverted}")
+
+    def flush(self):
+        """Дописывает накопленные замены; при ошибке хранилища пакет отбрасывается (постеры остаются удаленными до догрузки)."""
+        replacements, self.replacements = self.replacements, []
+        if not replacements: return
+        try: self.localized += self.store.replace_posters(self.source_key, replacements)
+        except sqlite3.Error as e: METRICS.inc("thumbnail_requests_total", len(replacements), result="store_failed"); logging.error(f"[{self.source_key.upper()}] Ошибка записи миниатюр ({len(replacements)} шт.) в хранилище: {e}")
+
+    async def worker(self):
+        """Разбирает очередь до метки None: ошибки отдельного постера или записи пакета не останавливают корутину (иначе close() ждал бы места в очереди вечно)."""
+        while True:
+            item = await self.queue.get()
+            if item is None: break
+            topic_id, poster_url, remote_url = item # poster_url - текущий в записи (вытесненная миниатюра или тот же remote_url)
+            try: record = await self.engine.thumbnail_cache.localize(self.engine, {'poster_url': remote_url})
+            except Exception as e: logging.error(f"[{self.source_key.upper()}] Ошибка миниатюры ID {topic_id}: {e}"); continue
+            if record['poster_url'] != poster_url: self.replacements.append((topic_id, poster_url, record['poster_url']))
+            if len(self.replacements) >= self.batch_size: self.flush()
+
+    async def close(self, backfill=True):
+        """Ставит догрузку сохраненных записей (после новых, если backfill), дорабатывает очередь и дописывает остаток. Возвращает число записей с замененным постером."""
+        if backfill: await self.submit_backfill()
+        for _ in self.tasks: await self.queue.put(None)
+        await asyncio.gather(*self.tasks); self.flush()
+        METRICS.observe("stage_duration_seconds", time.time() - self.started_at, source=self.source_key, stage="posters")
+        logging.info(f"[{self.source_key.upper()}] Миниатюры: заменено постеров {self.localized}, отложено {self.deferred}")
+        return self.localized
+
+async def scan_pages_incremental(engine, source_key, pipeline, high_water_mark, max_pages, stop_after_known_pages):
+    """Сканирует страницы форума по порядку (новые темы сверху) и останавливается после N подряд страниц без новых тем.
+
+    Страница считается "известной", если каждый ID на ней уже сохранен или не выше high-water mark источника.
+    """
+    source_config = SOURCES[source_key]; known_pages_in_row = 0
+    for page_index in range(max_pages):
+        if pipeline.should_stop(): break
+        page_url = f"{source_config['base_url']}viewforum.php?f={source_config['forum_id']}&start={page_index * ITEMS_PER_PAGE_TRACKER}"
+        ids_from_page = await fetch_and_extract_ids_from_page(engine, page_url, page_index + 1, source_key)
+        if not ids_from_page: logging.info(f"[{source_key.upper()}] Стр. {page_index + 1} без тем - конец раздела или ошибка. Остановка."); break
+        known_ids = await pipeline.submit_page_ids(ids_from_page)
+        unseen_ids = [tid for tid in ids_from_page - known_ids if int(tid) > high_water_mark]
+        if unseen_ids: known_pages_in_row = 0
+        else:
+            known_pages_in_row += 1
+            if known_pages_in_row >= stop_after_known_pages: logging.info(f"[{source_key.upper()}] Стр. {page_index + 1}: только известные темы ({known_pages_in_row} подряд). Остановка."); break
+    logging.info(f"[{source_key.upper()}] Инкрементальный обход: просканировано страниц {pipeline.pages_scanned}, найдено ID: {pipeline.ids_found}")
+
+async def scan_pages_full(engine, source_key, pipeline, num_pages):
+    """Сканирует первые num_pages страниц раздела несколькими корутинами (их число - потолок окна лимитера трекера)."""
+    source_config = SOURCES[source_key]
+    page_indexes = asyncio.Queue()
+    for page_index in range(num_pages): page_indexes.put_nowait(page_index)
+    logging.info(f"[{source_key.upper()}] Начинаем сбор ID с {num_pages} страниц (темп и окно на хост подстраиваются автоматически)...")
+
+    async def page_worker():
+        while True:
+            if pipeline.should_stop(): return
+            try: page_index = page_indexes.get_nowait()
+            except asyncio.QueueEmpty: return
+            page_url = f"{source_config['base_url']}viewforum.php?f={source_config['forum_id']}&start={page_index * ITEMS_PER_PAGE_TRACKER}"
+            try: await pipeline.submit_page_ids(await fetch_and_extract_ids_from_page(engine, page_url, page_index + 1, source_key))
+            except Exception as exc: logging.error(f"Ошибка при обработке страницы {page_index + 1}: {exc}")
+            if pipeline.pages_scanned % 10 == 0 or pipeline.pages_scanned == num_pages: logging.info(f"--- Сбор ID ({source_key}): обработано {pipeline.pages_scanned}/{num_pages} стр. Найдено ID: {pipeline.ids_found}, новых в работу: {pipeline.ids_queued} ---")
+
+    page_workers = min(num_pages, engine.limiter_for(source_config['base_url']).max_concurrency)
+    await asyncio.gather(*(page_worker() for _ in range(page_workers)))
+
+async def refresh_tracker_source(engine, source_key, output_file_path, num_pages=None, max_pages=INCREMENTAL_MAX_PAGES, stop_after_known_pages=INCREMENTAL_STOP_AFTER_KNOWN_PAGES, stop_event=None, refresh_budget=REFRESH_BUDGET_PER_RUN):
+    """Одно обновление трекера через переданный движок: страницы форума -> новые ID -> детали TorAPI -> пакетное сохранение.
+
+    Стадии работают одновременно (CrawlPipeline): детали запрашиваются, пока еще идут страницы, а записи сохраняются пакетами.
+    num_pages=None включает инкрементальный режим (обход до первых известных страниц). stop_event прерывает обход страниц.
+    После обхода до refresh_budget устаревших записей (старше TTL кэша TorAPI для источника) перезапрашиваются тем же конвейером.
+    """
+    store = get_data_store(); store.import_json_file(output_file_path)
+    crawl_state = load_crawl_state(); high_water_mark = int(crawl_state.get(source_key, {}).get('high_water_mark', 0))
+    logging.info(f"[{source_key.upper()}] High-water mark: {high_water_mark}")
+
+    # --- Запуск стадий: воркеры TorAPI и писатель ждут данных, пока сканер идет по страницам ---
+    crawl_start_time = time.time(); poster_stage = PosterStage(engine, store, source_key) if engine.thumbnail_cache is not None else None
+    pipeline = CrawlPipeline(source_key, store, stop_event=stop_event, poster_stage=poster_stage)
+    torapi_workers = engine.limiter_for(TORAPI_BASE_URL).max_concurrency # Реальную параллельность ограничивает окно лимитера
+    logging.info(f"[{source_key.upper()}] Запуск конвейера: {torapi_workers} корутин TorAPI, запись пакетами по {pipeline.batch_size}")
+    worker_tasks = [asyncio.create_task(worker_torapi_details(engine, pipeline.ids_queue, pipeline.results_queue, source_key, f"TorAPI-{i+1}")) for i in range(torapi_workers)]
+    writer_task = asyncio.create_task(pipeline.writer())
+    try:
+        if num_pages is None: await scan_pages_incremental(engine, source_key, pipeline, high_water_mark, max_pages, stop_after_known_pages)
+        else: await scan_pages_full(engine, source_key, pipeline, num_pages)
+        METRICS.observe("stage_duration_seconds", time.time() - crawl_start_time, source=source_key, stage="scan")
+        logging.info(f"--- [{source_key.upper()}] Сбор ID завершен за {time.time() - crawl_start_time:.2f} сек. Найдено ID: {pipeline.ids_found}, новых: {pipeline.ids_queued} ---")
+        if refresh_budget > 0 and not pipeline.should_stop():
+            refresh_ids = store.stale_refresh_candidates(source_key, refresh_budget, TorApiDetailCache.ttl_for_source(source_key), exclude=pipeline.in_progress_ids)
+            logging.info(f"[{source_key.upper()}] Обновление устаревших записей: {len(refresh_ids)} (бюджет {refresh_budget})")
+            await pipeline.submit_refresh_ids(refresh_ids)
+    finally:
+        # --- Дренаж: воркеры дорабатывают очередь ID, писатель сохраняет остаток (и при ошибке сканера) ---
+        for _ in worker_tasks: await pipeline.ids_queue.put(None)
+        await asyncio.gather(*worker_tasks)
+        await pipeline.results_queue.put(None); await writer_task; pipeline_seconds = time.time() - crawl_start_time
+        posters_localized = await poster_stage.close(backfill=not pipeline.interrupted) if poster_stage is not None else 0 # Миниатюры дорабатывают после записи, в длительность конвейера не входят
+    if pipeline.refreshed: store.mark_fetched(source_key, pipeline.refresh_ids) # Если не вернулась ни одна запись, TorAPI, вероятно, недоступен - повторим в следующий раз
+    METRICS.observe("stage_duration_seconds", pipeline_seconds, source=source_key, stage="pipeline")
+    logging.info(f"--- [{source_key.upper()}] Конвейер завершен за {pipeline_seconds:.2f} сек. Новых тем: {pipeline.added}, обновлено: {pipeline.updated} (по сроку: {pipeline.refreshed} из {len(pipeline.refresh_ids)}) ---")
+
+    if pipeline.ids_found == 0: logging.warning(f"[{source_key.upper()}] Не найдено ни одного ID темы."); return False
+    if pipeline.ids_queued == 0: logging.info(f"[{source_key.upper()}] Нет новых ID для обработки.")
+    elif pipeline.added + pipeline.updated == 0: logging.warning("Не получено новых результатов от TorAPI.")
+    with METRICS.timer("export_seconds", source=source_key): # JSON и шарды для server.js - один раз в конце (и при первом запуске без шардов)
+        data_saved_successfully = await export_store_serving(store, output_file_path) if pipeline.added + pipeline.updated + posters_localized > 0 or serving_manifest_outdated(output_file_path, source_key) else True
+    if data_saved_successfully and not pipeline.interrupted: update_high_water_mark(source_key, pipeline.max_stored_id) # Прерванный обход не поднимает отметку
+    return data_saved_successfully
+
+async def run_tracker_source(source_key, output_file_path, num_pages=None, interactive=False, max_pages=INCREMENTAL_MAX_PAGES, stop_after_known_pages=INCREMENTAL_STOP_AFTER_KNOWN_PAGES, use_cache=True, refresh_budget=REFRESH_BUDGET_PER_RUN, thumbnails=False, thumbnail_backfill=THUMBNAIL_BACKFILL_PER_RUN):
+    """Обновляет один трекер на отдельном экземпляре движка; в интерактивном режиме спрашивает число страниц."""
+    source_config = SOURCES[source_key]
+    async with create_http_engine(use_cache=use_cache, thumbnails=thumbnails, thumbnail_backfill=thumbnail_backfill) as engine:
+        if interactive and num_pages is None:
+            # --- Определение кол-ва страниц и запрос у пользователя ---
+            total_pages_available = await get_total_pages(source_config['forum_id'], source_config['base_url'], engine, source_key)
+            if total_pages_available <= 0: logging.error("Не удалось определить количество страниц. Завершение."); sys.exit(1)
+            num_pages = ask_pages_to_scan(total_pages_available)
+            max_pages = min(max_pages, total_pages_available)
+        return await refresh_tracker_source(engine, source_key, output_file_path, num_pages=num_pages, max_pages=max_pages, stop_after_known_pages=stop_after_known_pages, refresh_budget=refresh_budget)
+
+# --- Планировщик: несколько источников одновременно на общем движке (--all, --daemon) ---
+def install_stop_signal_handlers(stop_event):
+    """SIGINT/SIGTERM запрашивают мягкую остановку (stop_event); повторный сигнал обрабатывается по умолчанию, т.е. прерывает сразу."""
+    loop = asyncio.get_running_loop(); stop_signals = [sig for sig in (getattr(signal, 'SIGINT', None), getattr(signal, 'SIGTERM', None)) if sig is not None]
+    def on_stop_signal(sig):
+        logging.warning(f"Получен сигнал {signal.Signals(sig).name}: завершаем текущие задания (повторный сигнал - немедленный выход)...")
+        stop_event.set()
+        for s in stop_signals: loop.remove_signal_handler(s)
+    try:
+        for sig in stop_signals: loop.add_signal_handler(sig, on_stop_signal, sig)
+    except (NotImplementedError, RuntimeError): logging.debug("Обработчики сигналов недоступны (Windows): остановка по Ctrl+C без дописывания.")
+
+async def refresh_source(engine, source_key, data_dir, stop_event=None, **tracker_options):
+    """Одно обновление любого источника (RSS или трекер) на общем движке. Возвращает True при успехе."""
+    output_file_path = os.path.join(data_dir, SOURCES[source_key]['output_json'])
+    if 'rss_url' in SOURCES[source_key]: return await refresh_rss_source(engine, source_key, output_file_path)
+    return await refresh_tracker_source(engine, source_key, output_file_path, stop_event=stop_event, **tracker_options)
+
+async def source_job_loop(engine, source_key, data_dir, stop_event, daemon, results, metrics_file=None, **tracker_options):
+    """Задание одного источника: обновление, затем (daemon) пауза до следующего запуска по "refresh_interval".
+
+    Следующий запуск начинается только после завершения текущего, поэтому обновления одного источника не пересекаются;
+    затянувшееся обновление сдвигает следующее, а не запускает его параллельно.
+    """
+    refresh_interval = SOURCES[source_key].get('refresh_interval', DEFAULT_REFRESH_INTERVAL)
+    while not stop_event.is_set():
+        job_start_time = time.time()
+        try: results[source_key] = await refresh_source(engine, source_key, data_dir, stop_event=stop_event, **tracker_options)
+        except Exception as e: logging.exception(f"[{source_key.upper()}] Ошибка обновления: {e}"); results[source_key] = False
+        METRICS.inc("source_runs_total", source=source_key, result="ok" if results[source_key] else "error"); METRICS.observe("stage_duration_seconds", time.time() - job_start_time, source=source_key, stage="job")
+        logging.info(f"[{source_key.upper()}] Обновление {'завершено' if results[source_key] else 'завершено с ошибками'} за {time.time() - job_start_time:.2f} сек.")
+        if not daemon: break
+        if metrics_file: METRICS.write(metrics_file) # Для textfile collector - после каждого обновления
+        delay = max(0.0, refresh_interval - (time.time() - job_start_time))
+        logging.info(f"[{source_key.upper()}] Следующее обновление через {delay:.0f} сек.")
+        try: await asyncio.wait_for(stop_event.wait(), timeout=delay)
+        except asyncio.TimeoutError: pass
+
+async def run_sources(source_keys, data_dir, daemon=False, use_cache=True, metrics_file=None, thumbnails=False, thumbnail_backfill=THUMBNAIL_BACKFILL_PER_RUN, **tracker_options):
+    """Обновляет источники одновременно на одном движке: общий пул соединений, общие лимиты на хост и кэши.
+
+    daemon=True повторяет обновления по расписанию до SIGINT/SIGTERM. Возвращает {source_key: успех последнего обновления}.
+    """
+    stop_event = asyncio.Event(); install_stop_signal_handlers(stop_event); results = {}
+    logging.info(f"Запуск {'по расписанию' if daemon else 'однократного обновления'}: {', '.join(source_keys)}")
+    async with create_http_engine(use_cache=use_cache, thumbnails=thumbnails, thumbnail_backfill=thumbnail_backfill) as engine:
+        await asyncio.gather(*(source_job_loop(engine, source_key, data_dir, stop_event, daemon, results, metrics_file, **tracker_options) for source_key in source_keys))
+    return results
+
+def run_with_profile(coro, profile_path=None):
+    """asyncio.run(coro); с profile_path - под cProfile: статистика в файл (для pstats/snakeviz) и топ по cumulative в лог.
+
+    cProfile видит только основной поток: время разбора в asyncio.to_thread смотрите в метрике parse_duration_seconds.
+    """
+    if not profile_path: return asyncio.run(coro)
+    profiler = cProfile.Profile(); profiler.enable()
+    try: return asyncio.run(coro)
+    finally:
+        profiler.disable(); profiler.dump_stats(profile_path)
+        stats_stream = io.StringIO(); pstats.Stats(profiler, stream=stats_stream).sort_stats('cumulative').print_stats(PROFILE_TOP_N)
+        logging.info(f"Профиль сохранен в {profile_path}. Топ-{PROFILE_TOP_N} по cumulative:\n{stats_stream.getvalue()}")
+
 # --- Основной блок выполнения скрипта ---
+def parse_args(argv=None):
+    """Аргументы командной строки. Без --source/--all/--daemon скрипт работает интерактивно (как раньше)."""
+    arg_parser = argparse.ArgumentParser(description="Сбор раздач с трекеров через TorAPI.")
+    arg_parser.add_argument("--source", choices=list(SOURCES.keys()), action="append", help="Источник для обновления (без вопросов в консоли). Можно указать несколько раз.")
+    arg_parser.add_argument("--all", action="store_true", help="Обновить все источники одновременно на общем движке.")
+    arg_parser.add_argument("--daemon", action="store_true", help="Работать постоянно: обновлять источники (по умолчанию все) по их \"refresh_interval\" до SIGINT/SIGTERM.")
+    arg_parser.add_argument("--data-dir", default=None, help="Каталог для JSON-файлов, хранилища и кэшей (по умолчанию - каталог скрипта).")
+    arg_parser.add_argument("--pages", type=int, default=None, help="Сканировать ровно N первых страниц (полный режим). По умолчанию - инкрементальный режим.")
+    arg_parser.add_argument("--max-pages", type=int, default=INCREMENTAL_MAX_PAGES, help="Потолок страниц в инкрементальном режиме.")
+    arg_parser.add_argument("--stop-after-known", type=int, default=INCREMENTAL_STOP_AFTER_KNOWN_PAGES, help="Остановиться после N подряд страниц только с известными темами.")
+    arg_parser.add_argument("--refresh-budget", type=int, default=REFRESH_BUDGET_PER_RUN, help="Сколько устаревших сохраненных записей перезапросить у TorAPI за обновление источника (0 - не обновлять).")
+    arg_parser.add_argument("--no-cache", action="store_true", help="Не использовать дисковые кэши (http_cache.sqlite, torapi_cache.sqlite).")
+    arg_parser.add_argument("--thumbnails", action="store_true", help=f"Сохранять постеры новых и обновленных записей локально ({THUMBS_DIR}, с Pillow - уменьшенными) и ссылаться на них в poster_url.")
+    arg_parser.add_argument("--thumbnail-backfill", type=int, default=THUMBNAIL_BACKFILL_PER_RUN, help="С --thumbnails: сколько сохраненных записей с удаленным постером догружать за обновление источника (0 - только новые и обновленные).")
+    arg_parser.add_argument("--export-json", action="store_true", help="Выгрузить JSON-файлы источников (data.json и др.) из хранилища. С --source/--all - после обновления, без них - только выгрузка всех источников.")
+    arg_parser.add_argument("--no-browser", action="store_true", help="Не открывать браузер после обновления.")
+    arg_parser.add_argument("--metrics-file", default=None, help="Записать метрики прогона: *.json - JSON-снимок, иначе текстовый формат Prometheus (*.prom). В режиме --daemon обновляется после каждого задания.")
+    arg_parser.add_argument("--profile", default=None, metavar="PATH", help="Запустить под cProfile и сохранить статистику в PATH.")
+    return arg_parser.parse_args(argv)
+
 if __name__ == "__main__":
+    args = parse_args()
     main_start_time = time.time()
     logging.info(f"--- Старт Парсера v2.8 (Мульти-источник + RSS, API: {TORAPI_BASE_URL}) ---")
-    script_dir = os.path.dirname(os.path.abspath(__file__)); os.chdir(script_dir);
-    logging.info(f"Рабочая директория: {script_dir}")
+    script_dir = os.path.dirname(os.path.abspath(__file__)); data_dir = os.path.abspath(args.data_dir or script_dir)
+    metrics_file = os.path.abspath(args.metrics_file) if args.metrics_file else None; profile_path = os.path.abspath(args.profile) if args.profile else None
+    os.makedirs(data_dir, exist_ok=True); os.chdir(data_dir) # Хранилище, кэши и crawl_state.json лежат рядом с JSON-файлами
+    logging.info(f"Рабочая директория: {data_dir}")
 
-    # --- Выбор источника ---
+    # --- Выбор источников: из аргументов или интерактивно ---
     source_keys = list(SOURCES.keys())
+    chosen_source_keys = source_keys if args.all or (args.daemon and not args.source) else list(dict.fromkeys(args.source or []))
+    if args.export_json and not chosen_source_keys: # Только выгрузка, без обхода
+        exported = export_json_files(source_keys); logging.info("Скрипт парсера завершил работу."); sys.exit(0 if exported else 1)
+    interactive = not chosen_source_keys and sys.stdin.isatty()
+    if not chosen_source_keys and not interactive: logging.error("Не указан --source/--all/--daemon, а ввод недоступен (запуск без терминала). Завершение."); sys.exit(2)
+
+    if not interactive:
+        # --- Без вопросов: выбранные источники одновременно на одном движке, с --daemon - по расписанию ---
+        results = run_with_profile(run_sources(chosen_source_keys, data_dir, daemon=args.daemon, use_cache=not args.no_cache, metrics_file=metrics_file, thumbnails=args.thumbnails, thumbnail_backfill=args.thumbnail_backfill, num_pages=args.pages, max_pages=args.max_pages, stop_after_known_pages=args.stop_after_known, refresh_budget=args.refresh_budget), profile_path)
+        failed_sources = [key for key in chosen_source_keys if not results.get(key)]
+        if args.export_json and not export_json_files(chosen_source_keys): failed_sources.append("export-json")
+        if failed_sources: logging.warning(f"Источники с ошибками: {', '.join(failed_sources)}")
+        main_end_time = time.time(); logging.info(f"--- ОБЩЕЕ ВРЕМЯ РАБОТЫ: {main_end_time - main_start_time:.2f} сек ---")
+        METRICS.log_summary()
+        if metrics_file: METRICS.write(metrics_file)
+        logging.info("Скрипт парсера завершил работу."); sys.exit(1 if failed_sources else 0)
+
     print("\nДоступные источники:")
     for i, key in enumerate(source_keys): print(f"{i+1}. {key.capitalize().replace('_', ' ')}")
     chosen_source_key = None
-    while True:
+    while chosen_source_key is None:
         try:
             user_input = input(f"Выберите номер источника для обновления (1-{len(source_keys)}): ")
             choice_idx = int(user_input) - 1
@@ -306,114 +1604,25 @@ if __name__ == "__main__":
         except ValueError: print("Введите число.")
         except (EOFError, KeyboardInterrupt): logging.warning("Ввод прерван."); sys.exit(0)
     chosen_source_config = SOURCES[chosen_source_key]
-    output_file_path = os.path.join(script_dir, chosen_source_config['output_json'])
+    output_file_path = os.path.join(data_dir, chosen_source_config['output_json'])
     logging.info(f"Выбран источник: {chosen_source_key.capitalize().replace('_', ' ')} -> {output_file_path}")
 
     # --- Логика в зависимости от выбранного источника ---
-    data_saved_successfully = False
-
-    if chosen_source_key == "rutracker_rss":
-        # --- Обработка RSS ---
-        rss_start_time = time.time()
-        rss_url = chosen_source_config['rss_url'].format(forum_id=chosen_source_config['forum_id'])
-        rss_results = fetch_and_parse_rss(rss_url)
-        if rss_results:
-            try: # Для RSS просто перезаписываем файл
-                logging.info(f"Сохранение {len(rss_results)} записей RSS в {output_file_path}")
-                with open(output_file_path, 'w', encoding='utf-8') as f: json.dump(rss_results, f, ensure_ascii=False, indent=4)
-                logging.info("Данные RSS сохранены."); data_saved_successfully = True
-            except Exception as e: logging.error(f"Ошибка сохранения RSS {output_file_path}: {e}")
-        else: logging.error("Не удалось получить или обработать данные RSS.")
-        rss_end_time = time.time(); logging.info(f"--- Время обработки RSS: {rss_end_time - rss_start_time:.2f} сек ---")
-
+    if chosen_source_key == "rutracker_rss": data_saved_successfully = run_with_profile(run_rss_source(chosen_source_key, output_file_path, use_cache=not args.no_cache, thumbnails=args.thumbnails, thumbnail_backfill=args.thumbnail_backfill), profile_path)
     else: # Логика для обычных трекеров (Rutracker, Pornolab)
-        # --- Определение кол-ва страниц ---
-        total_pages_available = get_total_pages(chosen_source_config['forum_id'], chosen_source_config['base_url'], session, chosen_source_key)
-        if total_pages_available <= 0: logging.error("Не удалось определить количество страниц. Завершение."); sys.exit(1)
-
-        # --- Запрос у пользователя кол-ва страниц для сканирования ---
-        num_pages_to_scan_user = 0
-        while True:
-            try:
-                prompt = f"Найдено страниц: {total_pages_available}. Сколько сканировать для НОВЫХ ID (1-{total_pages_available}): "
-                user_input = input(prompt)
-                num_pages_to_scan_user = int(user_input)
-                if 1 <= num_pages_to_scan_user <= total_pages_available: logging.info(f"Будет просканировано страниц: {num_pages_to_scan_user}"); break
-                else: print(f"Ошибка: Введите число от 1 до {total_pages_available}.")
-            except ValueError: print("Введите целое число.")
-            except EOFError: logging.warning("Ввод прерван."); sys.exit(0)
-            except KeyboardInterrupt: logging.warning("Операция прервана."); sys.exit(0)
-
-        # --- Фаза 1: Параллельный сбор ID с трекера ---
-        id_fetch_start_time = time.time()
-        all_topic_ids = set()
-        page_urls_to_scan = [f"{chosen_source_config['base_url']}viewforum.php?f={chosen_source_config['forum_id']}&start={s}" for s in range(0, num_pages_to_scan_user * ITEMS_PER_PAGE_TRACKER, ITEMS_PER_PAGE_TRACKER)]
-        logging.info(f"[{chosen_source_key.upper()}] Начинаем сбор ID с {len(page_urls_to_scan)} страниц (Потоков: {MAX_WORKERS_ID_FETCH})...")
-        processed_pages_count = 0
-        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS_ID_FETCH, thread_name_prefix="ID_Fetcher") as executor:
-            future_to_url = {executor.submit(fetch_and_extract_ids_from_page, url, i+1, chosen_source_key): url for i, url in enumerate(page_urls_to_scan)}
-            for future in concurrent.futures.as_completed(future_to_url):
-                url = future_to_url[future]; processed_pages_count += 1
-                try: ids_from_page = future.result(); all_topic_ids.update(ids_from_page)
-                except Exception as exc: logging.error(f"Ошибка при получении результата для URL {url}: {exc}")
-                finally:
-                     if processed_pages_count % 10 == 0 or processed_pages_count == len(page_urls_to_scan): logging.info(f"--- Сбор ID ({chosen_source_key}): обработано {processed_pages_count}/{len(page_urls_to_scan)} стр. Найдено уник. ID: {len(all_topic_ids)} ---")
-        id_fetch_end_time = time.time(); logging.info(f"--- [{chosen_source_key.upper()}] Сбор ID завершен за {id_fetch_end_time - id_fetch_start_time:.2f} сек. Собрано уникальных ID: {len(all_topic_ids)} ---")
-        total_unique_ids = len(all_topic_ids)
-        if total_unique_ids == 0: logging.warning(f"[{chosen_source_key.upper()}] Не найдено ни одного ID темы. Завершение."); sys.exit(0)
-
-        # --- Получаем существующие ID из соответствующего data.json ---
-        existing_ids_in_file = set() # Теперь это set ключей "source-id"
-        if os.path.exists(output_file_path):
-            try:
-                with open(output_file_path, 'r', encoding='utf-8') as f: existing_data_list = json.load(f)
-                if isinstance(existing_data_list, list):
-                    for item in existing_data_list:
-                         if isinstance(item, dict) and 'topic_id' in item and item.get('source') == chosen_source_key:
-                             existing_ids_in_file.add(f"{item['source']}-{item['topic_id']}")
-                logging.info(f"Найдено {len(existing_ids_in_file)} существующих записей для {chosen_source_key} в {output_file_path}.")
-            except Exception as e: logging.warning(f"Не удалось прочитать {output_file_path}: {e}")
-
-        # --- Определяем ID для запроса к TorAPI (новые для этого источника) ---
-        ids_to_request_torapi = []
-        for topic_id in all_topic_ids:
-            unique_key = f"{chosen_source_key}-{topic_id}" # Используем ключ источника
-            if unique_key not in existing_ids_in_file:
-                ids_to_request_torapi.append(topic_id)
-        ids_to_request_torapi = sorted(ids_to_request_torapi, key=int, reverse=True) # Новые сначала
-
-        total_tasks_final = len(ids_to_request_torapi)
-        logging.info(f"--- [{chosen_source_key.upper()}] Всего НОВЫХ ID для запроса к TorAPI: {total_tasks_final} ---")
-
-        if total_tasks_final == 0:
-            logging.info(f"[{chosen_source_key.upper()}] Нет новых ID для обработки.");
-            data_saved_successfully = True # Считаем успешным, если обновлять нечего
-        else:
-            # --- Фаза 2: ЗАПРОС ДЕТАЛЕЙ К TORAPI только для НОВЫХ ID ---
-            torapi_start_time = time.time()
-            task_queue = Queue(maxsize=total_tasks_final + MAX_WORKERS_TORAPI); results_list = []; results_lock = threading.Lock()
-            for topic_id in ids_to_request_torapi: task_queue.put(topic_id)
-            for _ in range(MAX_WORKERS_TORAPI): task_queue.put(None)
-            logging.info(f"[{chosen_source_key.upper()}] Запуск {MAX_WORKERS_TORAPI} потоков для запроса деталей {total_tasks_final} новых тем к TorAPI...")
-            threads_torapi = []
-            for i in range(MAX_WORKERS_TORAPI):
-                thread = threading.Thread(target=worker_torapi_details, args=(task_queue, results_list, results_lock, chosen_source_key), name=f"TorAPI-{i+1}")
-                thread.start(); threads_torapi.append(thread)
-            task_queue.join(); logging.info(f"--- [{chosen_source_key.upper()}] Очередь запросов к TorAPI обработана ---")
-            logging.info(f"Собрано НОВЫХ результатов от TorAPI для {chosen_source_key}: {len(results_list)}")
-
-            # --- Фаза 3: ОБНОВЛЕНИЕ И СОХРАНЕНИЕ ---
-            if results_list: data_saved_successfully = update_and_save_data(results_list, output_file_path) # Используем нужный файл
-            else: logging.warning("Не получено новых результатов от TorAPI."); data_saved_successfully = True
-            torapi_end_time = time.time(); logging.info(f"--- [{chosen_source_key.upper()}] Время запросов к TorAPI: {torapi_end_time - torapi_start_time:.2f} сек ---")
+        data_saved_successfully = run_with_profile(run_tracker_source(chosen_source_key, output_file_path, num_pages=args.pages, interactive=True, max_pages=args.max_pages, stop_after_known_pages=args.stop_after_known, use_cache=not args.no_cache, refresh_budget=args.refresh_budget, thumbnails=args.thumbnails, thumbnail_backfill=args.thumbnail_backfill), profile_path)
 
     main_end_time = time.time(); logging.info(f"--- ОБЩЕЕ ВРЕМЯ РАБОТЫ: {main_end_time - main_start_time:.2f} сек ---")
+    METRICS.log_summary()
+    if metrics_file: METRICS.write(metrics_file)
 
-    # --- Открываем браузер только если выбран соответствующий источник и все успешно ---
-    if data_saved_successfully and chosen_source_config.get('open_browser', False):
+    # --- Открываем браузер только в интерактивном запуске, если выбран соответствующий источник и все успешно ---
+    if args.no_browser:
+        logging.info("Открытие браузера отключено (--no-browser).")
+    elif data_saved_successfully and chosen_source_config.get('open_browser', False):
         start_server_and_open_browser(BACKEND_SERVER_PORT)
     elif not data_saved_successfully:
         logging.warning("Браузер не будет открыт из-за ошибок.")
     else:
         logging.info(f"Источник '{chosen_source_key}' не требует открытия браузера.")
-    logging.info("Скрипт парсера завершил работу.")
\ No newline at end of file
+    logging.info("Скрипт парсера завершил работу.")
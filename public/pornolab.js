@@ -72,8 +72,8 @@
                  div.dataset.downloadUrl = downloadUrl;
 
                  if (item.has_multiplayer === true) { const indicator = document.createElement('span'); indicator.classList.add('multiplayer-indicator'); indicator.title = "Есть мультиплеер"; div.appendChild(indicator); }
-                 const img = document.createElement('img'); img.src = item.poster_url || "https://via.placeholder.com/210x140.png?text=NA"; img.alt = item.title || "Постер"; img.loading = 'lazy';
-                 img.onerror = function() { if (this.src.includes('Error')) return; this.onerror=null; this.src='https://via.placeholder.com/210x140.png?text=Error'; };
+                 const img = document.createElement('img'); img.src = item.poster_url || '/placeholder.svg'; img.alt = item.title || "Постер"; img.loading = 'lazy';
+                 img.onerror = function() { if (item.poster_remote_url && this.src !== item.poster_remote_url) { this.src = item.poster_remote_url; return; } this.onerror=null; this.src='/placeholder.svg'; }; // Миниатюра вытеснена - исходный постер
                  div.appendChild(img);
 
                  // --- !!! СОЗДАЕМ БЛОК ДЕТАЛЕЙ С ПРАВИЛЬНЫМИ КЛЮЧАМИ !!! ---
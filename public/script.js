@@ -47,8 +47,7 @@ document.addEventListener('DOMContentLoaded', () => {
     let currentSource = 'rutracker';
     
     // --- Переменные для фильтрации и сортировки ---
-    let allData = []; // Полный набор данных (без пагинации)
-    let filteredData = []; // Отфильтрованные данные
+    let currentSearchQuery = ''; // Текст поиска
     let currentSortOption = 'title_asc'; // Текущая опция сортировки
     let currentFilters = { // Текущие фильтры
         year: '',
@@ -68,6 +67,9 @@ document.addEventListener('DOMContentLoaded', () => {
     const RIGHT_STICK_Y_AXIS_INDEX = 3;
     const RUTRACKER_DOWNLOAD_BASE_URL = "https://rutracker.org/forum/";
     const TOPICS_API_URL = "/api/topics";
+    const SEARCH_API_URL = "/api/search";
+    const FACETS_API_URL = "/api/facets";
+    const TOPIC_API_URL = "/api/topic";
     const YOUTUBE_API_URL = "/youtube-search";
 
     // --- Загрузка данных с БЭКЕНДА ---
@@ -115,8 +117,8 @@ document.addEventListener('DOMContentLoaded', () => {
                  const div = document.createElement('div'); div.classList.add('poster-item');
                  div.dataset.globalIndex = globalIndex;
                  if (item.has_multiplayer === true) { const indicator = document.createElement('span'); indicator.classList.add('multiplayer-indicator'); indicator.title = "Есть мультиплеер"; div.appendChild(indicator); }
-                 const img = document.createElement('img'); img.src = item.poster_url || "https://via.placeholder.com/160x240.png?text=NA"; img.alt = item.title || ""; img.loading = 'lazy';
-                 img.onerror = function() { if (this.src.includes('Error')) return; this.onerror=null; this.src='https://via.placeholder.com/160x240.png?text=Error'; };
+                 const img = document.createElement('img'); img.src = item.poster_url || '/placeholder.svg'; img.alt = item.title || ""; img.loading = 'lazy';
+                 img.onerror = function() { if (item.poster_remote_url && this.src !== item.poster_remote_url) { this.src = item.poster_remote_url; return; } this.onerror=null; this.src='/placeholder.svg'; }; // Миниатюра вытеснена - исходный постер
                  const titleDiv = document.createElement('div'); titleDiv.classList.add('title'); titleDiv.textContent = item.title || "No title"; titleDiv.title = item.title || "";
                  div.appendChild(img); div.appendChild(titleDiv);
                  if (typeof openModal === 'function') { div.addEventListener('click', (event) => { console.log(`Item global index ${globalIndex} clicked.`); currentGridFocusIndex = indexOnPage; openModal(globalIndex); }); }
@@ -276,14 +278,21 @@ document.addEventListener('DOMContentLoaded', () => {
     // --- Открытие модального окна ---
     async function openModal(globalIndex) {
         console.log(`Open modal for global index: ${globalIndex}`);
-        const item = allPostersData[globalIndex]; // Получаем данные из общего массива
+        let item = allPostersData[globalIndex]; // Получаем данные из общего массива
         if (!item || isModalOpen || !modalOverlay /*...*/) { console.error("Cannot open modal."); return; }
+        if (isFilterMode && !item.full_description_html) { // Выдача поиска содержит только плитки - полную запись загружаем при открытии
+            try {
+                const response = await fetch(`${TOPIC_API_URL}?source=${item.source || currentSource}&id=${item.topic_id}`);
+                if (response.ok) { item = allPostersData[globalIndex] = { ...item, ...(await response.json()) }; }
+            } catch (error) { console.error("Error loading topic details:", error); }
+            if (isModalOpen) return; // Пока шла загрузка, окно уже открыто повторным нажатием
+        }
         const gridIndexBeforeOpen = currentGridFocusIndex; // Запоминаем
         // Снимаем подсветку, но не сбрасываем индекс сетки
         if (currentPaginationFocusIndex !== -1 && paginationButtons?.[currentPaginationFocusIndex]) { paginationButtons[currentPaginationFocusIndex].classList.remove('pagination-focused'); }
         currentPaginationFocusIndex = -1;
 
-        modalTitle.textContent = item.title || "No Title"; modalPoster.src = item.poster_url || "..."; modalLink.href = item.link || "#";
+        modalTitle.textContent = item.title || "No Title"; modalPoster.src = item.poster_remote_url || item.poster_url || "/placeholder.svg"; modalLink.href = item.link || "#";
         try { modalFullDescription.innerHTML = item.full_description_html || '<p><em>...</em></p>'; } catch (e) { /*...*/ }
         if (modalYear) modalYear.textContent = item.year || '-'; else console.warn("#modal-year not found");
         if (modalGenre) modalGenre.textContent = item.genre || '-'; else console.warn("#modal-genre not found");
@@ -567,73 +576,33 @@ document.addEventListener('DOMContentLoaded', () => {
 
     // --- Функции для фильтрации и сортировки ---
     
-    // Загрузка всех данных (без пагинации)
-    function loadAllData() {
-        console.log("Loading all data for filtering and sorting...");
-        if(posterGrid) posterGrid.innerHTML = '<p>Загрузка данных...</p>';
-        
-        fetch(`${TOPICS_API_URL}?source=${currentSource}&page=1&limit=1000`)
+    // Загрузка счетчиков фасетов с сервера (готовы в индексе parser.py, весь набор данных не нужен)
+    function loadFacets() {
+        fetch(`${FACETS_API_URL}?source=${currentSource}`)
             .then(response => {
                 if (!response.ok) { throw new Error(`API error ${response.status}`); }
                 return response.json();
             })
-            .then(apiResponse => {
-                if (!apiResponse || !Array.isArray(apiResponse.items)) { 
-                    throw new Error("Invalid data format from API."); 
-                }
-                
-                allData = apiResponse.items;
-                console.log(`Loaded ${allData.length} items for filtering and sorting.`);
-                
-                // Заполняем опции фильтров
-                populateFilterOptions();
-                
-                // Применяем фильтры и сортировку
-                applyFiltersAndSort();
-                
-                // Переключаем режим фильтрации
-                isFilterMode = true;
-            })
-            .catch(error => {
-                console.error("Error loading all data:", error);
-                if(posterGrid) posterGrid.innerHTML = `<p style="color:red;">Ошибка загрузки данных: ${error.message}</p>`;
-                // Возвращаемся к обычному режиму
-                loadPageData(1, currentSource);
-            });
+            .then(apiResponse => populateFilterOptions(apiResponse.facets || {}))
+            .catch(error => console.warn("Facets are not available:", error));
     }
     
     // Заполнение опций фильтров
-    function populateFilterOptions() {
+    function populateFilterOptions(facets) {
         console.log("Populating filter options...");
-        
-        // Получаем уникальные значения для каждого фильтра
-        const years = new Set();
-        const genres = new Set();
-        const voices = new Set();
-        const texts = new Set();
-        
-        allData.forEach(item => {
-            if (item.year) years.add(item.year);
-            if (item.genre) {
-                // Разбиваем жанры по запятой, если они в одной строке
-                const genreList = item.genre.split(',').map(g => g.trim());
-                genreList.forEach(g => genres.add(g));
-            }
-            if (item.voice_lang) voices.add(item.voice_lang);
-            if (item.text_lang) texts.add(item.text_lang);
-        });
+        const valuesOf = facet => Object.keys(facets[facet] || {});
         
         // Заполняем выпадающие списки
-        fillSelectOptions('year-filter', Array.from(years).sort((a, b) => b - a)); // По убыванию
-        fillSelectOptions('genre-filter', Array.from(genres).sort());
-        fillSelectOptions('voice-filter', Array.from(voices).sort());
-        fillSelectOptions('text-filter', Array.from(texts).sort());
+        fillSelectOptions('year-filter', valuesOf('year').sort((a, b) => b - a), facets.year); // По убыванию
+        fillSelectOptions('genre-filter', valuesOf('genre').sort(), facets.genre);
+        fillSelectOptions('voice-filter', valuesOf('voice_lang').sort(), facets.voice_lang);
+        fillSelectOptions('text-filter', valuesOf('text_lang').sort(), facets.text_lang);
         
-        console.log(`Filter options populated: ${years.size} years, ${genres.size} genres, ${voices.size} voices, ${texts.size} text languages.`);
+        console.log(`Filter options populated: ${valuesOf('year').length} years, ${valuesOf('genre').length} genres, ${valuesOf('voice_lang').length} voices, ${valuesOf('text_lang').length} text languages.`);
     }
     
     // Вспомогательная функция для заполнения select
-    function fillSelectOptions(selectId, options) {
+    function fillSelectOptions(selectId, options, counts = {}) {
         const select = document.getElementById(selectId);
         if (!select) {
             console.warn(`Select element with id "${selectId}" not found.`);
@@ -649,95 +618,54 @@ document.addEventListener('DOMContentLoaded', () => {
         options.forEach(option => {
             const optElement = document.createElement('option');
             optElement.value = option;
-            optElement.textContent = option;
+            optElement.textContent = counts[option] ? `${option} (${counts[option]})` : option;
             select.appendChild(optElement);
         });
     }
     
-    // Применение фильтров и сортировки
-    function applyFiltersAndSort() {
-        console.log("Applying filters and sorting...");
-        console.log("Current filters:", currentFilters);
-        console.log("Current sort option:", currentSortOption);
-        
-        // Применяем фильтры
-        filteredData = allData.filter(item => {
-            // Проверяем каждый фильтр
-            if (currentFilters.year && item.year !== currentFilters.year) return false;
-            
-            if (currentFilters.genre && item.genre) {
-                // Проверяем, содержит ли строка жанров выбранный жанр
-                if (!item.genre.includes(currentFilters.genre)) return false;
-            } else if (currentFilters.genre) {
-                return false;
-            }
-            
-            if (currentFilters.voice && item.voice_lang !== currentFilters.voice) return false;
-            if (currentFilters.text && item.text_lang !== currentFilters.text) return false;
-            
-            if (currentFilters.multiplayer === 'true' && !item.has_multiplayer) return false;
-            if (currentFilters.multiplayer === 'false' && item.has_multiplayer) return false;
-            
-            return true;
-        });
-        
-        console.log(`Filtered data: ${filteredData.length} items.`);
-        
-        // Применяем сортировку
-        sortData(filteredData, currentSortOption);
-        
-        // Обновляем пагинацию
-        totalPages = Math.ceil(filteredData.length / ITEMS_PER_PAGE);
-        currentPage = 1;
-        
-        // Отображаем первую страницу отфильтрованных данных
-        const startIndex = 0;
-        const endIndex = Math.min(ITEMS_PER_PAGE, filteredData.length);
-        displayCurrentPageItems(filteredData.slice(startIndex, endIndex));
-        generatePaginationControls();
-    }
-    
-    // Функция сортировки данных
-    function sortData(data, sortOption) {
-        console.log(`Sorting data by option: ${sortOption}`);
+    // Поиск, фильтры и сортировка выполняются на сервере (/api/search), клиент получает только страницу
+    function loadSearchPage(page = 1) {
+        const params = new URLSearchParams({ source: currentSource, page, limit: ITEMS_PER_PAGE, sort: currentSortOption });
+        if (currentSearchQuery) params.set('q', currentSearchQuery);
+        Object.entries(currentFilters).forEach(([key, value]) => { if (value) params.set(key, value); });
+        console.log(`Searching: ${SEARCH_API_URL}?${params}`);
+        if(posterGrid) posterGrid.innerHTML = '<p>Загрузка данных...</p>';
         
-        switch (sortOption) {
-            case 'title_asc':
-                data.sort((a, b) => (a.title || '').localeCompare(b.title || ''));
-                break;
-            case 'title_desc':
-                data.sort((a, b) => (b.title || '').localeCompare(a.title || ''));
-                break;
-            case 'year_asc':
-                data.sort((a, b) => {
-                    const yearA = a.year ? parseInt(a.year) : 0;
-                    const yearB = b.year ? parseInt(b.year) : 0;
-                    return yearA - yearB;
-                });
-                break;
-            case 'year_desc':
-                data.sort((a, b) => {
-                    const yearA = a.year ? parseInt(a.year) : 0;
-                    const yearB = b.year ? parseInt(b.year) : 0;
-                    return yearB - yearA;
-                });
-                break;
-        }
+        fetch(`${SEARCH_API_URL}?${params}`)
+            .then(response => {
+                if (!response.ok) { throw new Error(`API error ${response.status}`); }
+                return response.json();
+            })
+            .then(apiResponse => {
+                if (!apiResponse || !Array.isArray(apiResponse.items)) { 
+                    throw new Error("Invalid data format from API."); 
+                }
+                console.log(`Search: ${apiResponse.totalItems} items, ${apiResponse.tookMs} ms on server.`);
+                if (searchInput) searchInput.title = apiResponse.truncated ? 'Последнее слово запроса слишком общее: найдены не все совпадения, уточните запрос' : '';
+                if (apiResponse.truncated) console.warn("Search: prefix of the last word matches too many terms, results are incomplete.");
+                
+                // Сохраняем элементы страницы по их глобальным индексам (для модального окна)
+                const startIndex = (apiResponse.currentPage - 1) * ITEMS_PER_PAGE;
+                allPostersData = [];
+                apiResponse.items.forEach((item, i) => { allPostersData[startIndex + i] = item; });
+                
+                totalPages = apiResponse.totalPages || 1;
+                currentPage = apiResponse.currentPage || 1;
+                isFilterMode = true;
+                displayCurrentPageItems(apiResponse.items);
+                generatePaginationControls();
+            })
+            .catch(error => {
+                console.error("Error loading search results:", error);
+                if(posterGrid) posterGrid.innerHTML = `<p style="color:red;">Ошибка поиска: ${error.message}</p>`;
+            });
     }
     
     // Модифицированная функция смены страницы для режима фильтрации
     function changeFilteredPage(newPageNumber) {
         if (newPageNumber < 1 || newPageNumber > totalPages || newPageNumber === currentPage) return;
         console.log(`Changing filtered page to ${newPageNumber}`);
-        
-        currentPage = newPageNumber;
-        
-        // Используем отфильтрованные данные вместо загрузки с сервера
-        const startIndex = (currentPage - 1) * ITEMS_PER_PAGE;
-        const endIndex = Math.min(startIndex + ITEMS_PER_PAGE, filteredData.length);
-        displayCurrentPageItems(filteredData.slice(startIndex, endIndex));
-        generatePaginationControls();
-        
+        loadSearchPage(newPageNumber);
         window.scrollTo({ top: 0, behavior: 'smooth' });
     }
     
@@ -748,6 +676,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const voiceFilter = document.getElementById('voice-filter');
     const textFilter = document.getElementById('text-filter');
     const multiplayerFilter = document.getElementById('multiplayer-filter');
+    const searchInput = document.getElementById('search-input');
     const applyFiltersBtn = document.getElementById('apply-filters-btn');
     const resetFiltersBtn = document.getElementById('reset-filters-btn');
     
@@ -793,17 +722,16 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     }
     
+    if (searchInput && applyFiltersBtn) {
+        searchInput.addEventListener('keydown', (e) => { if (e.key === 'Enter') { e.preventDefault(); applyFiltersBtn.click(); } });
+    }
+    
     if (applyFiltersBtn) {
         applyFiltersBtn.addEventListener('click', () => {
             console.log("Apply filters button clicked.");
             
-            // Если мы еще не в режиме фильтрации, загружаем все данные
-            if (!isFilterMode) {
-                loadAllData();
-            } else {
-                // Иначе просто применяем фильтры к уже загруженным данным
-                applyFiltersAndSort();
-            }
+            if (searchInput) currentSearchQuery = searchInput.value.trim();
+            loadSearchPage(1);
             
             // Закрываем боковую панель после применения фильтров
             if (typeof window.toggleSidePanel === 'function') {
@@ -818,6 +746,7 @@ document.addEventListener('DOMContentLoaded', () => {
             
             // Сбрасываем все фильтры
             if (sortSelect) sortSelect.value = 'title_asc';
+            if (searchInput) searchInput.value = '';
             if (yearFilter) yearFilter.value = '';
             if (genreFilter) genreFilter.value = '';
             if (voiceFilter) voiceFilter.value = '';
@@ -825,6 +754,7 @@ document.addEventListener('DOMContentLoaded', () => {
             if (multiplayerFilter) multiplayerFilter.value = '';
             
             currentSortOption = 'title_asc';
+            currentSearchQuery = '';
             currentFilters = {
                 year: '',
                 genre: '',
@@ -833,13 +763,9 @@ document.addEventListener('DOMContentLoaded', () => {
                 multiplayer: ''
             };
             
-            // Если мы в режиме фильтрации, применяем сброшенные фильтры
-            if (isFilterMode) {
-                applyFiltersAndSort();
-            } else {
-                // Иначе возвращаемся к обычному режиму
-                loadPageData(1, currentSource);
-            }
+            // Возвращаемся к обычному постраничному режиму
+            isFilterMode = false;
+            loadPageData(1, currentSource);
             
             // Закрываем боковую панель после сброса фильтров
             if (typeof window.toggleSidePanel === 'function') {
@@ -860,6 +786,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
     // --- НАЧИНАЕМ ЗАГРУЗКУ ДАННЫХ ПРИ СТАРТЕ ---
     loadPageData(1, currentSource); // Загружаем первую страницу для источника по умолчанию
+    loadFacets(); // Опции фильтров - из готовых счетчиков индекса
 
     console.log("Main script initialization finished.");
 
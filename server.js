@@ -13,17 +13,65 @@ const DATA_JSON_PATH = path.join(__dirname, 'data.json'); // ��� Rutracker
 const PORNOLAB_DATA_JSON_PATH = path.join(__dirname, 'pornolab_data.json'); // ��� Pornolab ���
 const RSS_DATA_JSON_PATH = path.join(__dirname, 'rss_data.json'); // !!! ���� � RSS ������ !!!
 const PUBLIC_FOLDER_PATH = path.join(__dirname, 'public');
+const SERVING_DIR = path.join(__dirname, 'serving'); // Страницы-шарды от parser.py: serving/<source>/manifest.json
 
 if (!YOUTUBE_API_KEY) { console.warn("!!! YOUTUBE_API_KEY �� ������ � .env !!!"); }
 
 // --- Middleware ---
 app.use(cors());
 app.use((req, res, next) => { console.log(`[${new Date().toISOString()}] ${req.method} ${req.url}`); next(); });
+app.use('/thumbs', express.static(path.join(PUBLIC_FOLDER_PATH, 'thumbs'), { immutable: true, maxAge: '365d' })); // Имена миниатюр - sha256 содержимого, файл по имени не меняется
 app.use(express.static(PUBLIC_FOLDER_PATH));
 console.log(`Static files served from: ${PUBLIC_FOLDER_PATH}`);
 
 // --- ������� ��� ������ � ��������� ������ ---
+// Разобранные шарды (LRU): имя шарда содержит поколение, поэтому кэш не устаревает
+const SHARD_CACHE_SIZE = 64;
+const shardCache = new Map();
+async function readShard(sourceDir, shardName) {
+    const shardPath = path.join(sourceDir, shardName);
+    // В кэше хранится промис: параллельные запросы одного шарда читают файл один раз
+    let shardItems = shardCache.get(shardPath);
+    if (shardItems) { shardCache.delete(shardPath); }
+    else { shardItems = fs.readFile(shardPath, 'utf-8').then(JSON.parse); shardItems.catch(() => shardCache.delete(shardPath)); }
+    shardCache.set(shardPath, shardItems);
+    if (shardCache.size > SHARD_CACHE_SIZE) { shardCache.delete(shardCache.keys().next().value); }
+    return shardItems;
+}
+
+async function readManifest(source) {
+    if (!/^[a-z0-9_]+$/.test(source)) { throw Object.assign(new Error(`Invalid source "${source}"`), { status: 400 }); }
+    const sourceDir = path.join(SERVING_DIR, source);
+    return { sourceDir, manifest: JSON.parse(await fs.readFile(path.join(sourceDir, 'manifest.json'), 'utf-8')) };
+}
+
+// Шард и индекс в нем для позиции (0 - самая новая запись). shard_order "oldest_first": шард 0 - самые старые темы, внутри шарда - от новых к старым
+function shardSlot(manifest, position) {
+    const { total_items: totalItems, shard_size: shardSize } = manifest;
+    if (manifest.shard_order !== 'oldest_first') { return [Math.floor(position / shardSize), position % shardSize]; } // Манифест старого формата
+    const ascending = totalItems - 1 - position; const shard = Math.floor(ascending / shardSize);
+    return [shard, Math.min(shardSize, totalItems - shard * shardSize) - 1 - ascending % shardSize];
+}
+
+// Страница из шардов parser.py: читаем manifest и только шарды, которые пересекают [skip, skip + limit)
+async function getShardedPage(source, page, limit) {
+    const { sourceDir, manifest } = await readManifest(source);
+    const { total_items: totalItems, shards } = manifest;
+    const skip = (page - 1) * limit;
+    const items = [];
+    for (let position = Math.max(skip, 0); position < Math.min(totalItems, skip + limit); position++) {
+        const [shard, index] = shardSlot(manifest, position);
+        items.push((await readShard(sourceDir, shards[shard]))[index]);
+    }
+    console.log(`Sending ${items.length} of ${totalItems} items for page ${page} (Shards: ${source}, generation ${manifest.generation})`);
+    return { totalPages: Math.ceil(totalItems / limit), currentPage: page, itemsPerPage: limit, totalItems, items };
+}
+
 async function getPaginatedData(filePath, page, limit, sourceFilter = null) {
+    if (sourceFilter) {
+        try { return await getShardedPage(sourceFilter, page, limit); }
+        catch (error) { console.warn(`Shards for "${sourceFilter}" unavailable (${error.code || error.message}), falling back to ${path.basename(filePath)}`); }
+    }
     console.log(`Reading data from: ${filePath}`);
     let allItems = [];
     try {
@@ -50,6 +98,165 @@ async function getPaginatedData(filePath, page, limit, sourceFilter = null) {
     return { totalPages, currentPage: page, itemsPerPage: limit, totalItems, items: paginatedItems };
 }
 
+// --- Поиск по индексу parser.py (serving/<source>/<generation>/search.json) ---
+const SEARCH_PREFIX_EXPANSION_LIMIT = 50; // Сколько термов может раскрыть префикс последнего слова запроса (сверх - ответ помечается truncated)
+const SEARCH_PREFIX_MIN_LENGTH = 2; // Более короткое последнее слово (одна цифра) ищется целиком: "2" не раскрывается в годы и все числа
+const SEARCH_FILTER_FACETS = [['year', 'year'], ['genre', 'genre'], ['voice', 'voice_lang'], ['text', 'text_lang'], ['multiplayer', 'has_multiplayer']];
+const EMPTY_POSTINGS = new Int32Array(0);
+const searchIndexes = new Map(); // source -> индекс текущего поколения
+
+// Та же токенизация, что search_tokens() в parser.py: нижний регистр, ё -> е, буквы и цифры, без однобуквенных слов
+function searchTokens(text) {
+    return String(text).toLowerCase().replace(/ё/g, 'е').split(/[^\p{L}\p{N}]+/u).filter(token => token.length > 1 || /^\p{N}+$/u.test(token));
+}
+
+async function loadSearchIndex(source) {
+    const { sourceDir, manifest } = await readManifest(source);
+    const cached = searchIndexes.get(source);
+    if (cached && cached.generation === manifest.generation) { return cached; }
+    if (!manifest.search) { throw Object.assign(new Error(`No search index for "${source}"`), { status: 404 }); }
+    const startedAt = Date.now();
+    const raw = JSON.parse(await fs.readFile(path.join(sourceDir, manifest.search), 'utf-8'));
+    const index = { generation: manifest.generation, sourceDir, manifest, totalItems: raw.total_items, terms: raw.terms, sortedTerms: Object.keys(raw.terms).sort(),
+                    facetPostings: raw.facet_postings, facets: raw.facets, orders: raw.orders, cardFields: raw.card_fields, cards: raw.cards, positionsById: null, decoded: new Map() };
+    searchIndexes.set(source, index);
+    console.log(`Search index loaded: ${source}, generation ${index.generation}, ${index.sortedTerms.length} terms in ${Date.now() - startedAt} ms`);
+    return index;
+}
+
+// Постинги хранятся дельтами; раскодируем при первом обращении и запоминаем
+function ownValue(object, key) { return object && Object.hasOwn(object, key) ? object[key] : undefined; }
+function decodePostings(index, key, deltas) {
+    if (!Array.isArray(deltas)) { return EMPTY_POSTINGS; }
+    let positions = index.decoded.get(key);
+    if (!positions) {
+        positions = new Int32Array(deltas.length);
+        let current = 0;
+        for (let i = 0; i < deltas.length; i++) { current += deltas[i]; positions[i] = current; }
+        index.decoded.set(key, positions);
+    }
+    return positions;
+}
+
+// Постинги всех термов с префиксом; stats.truncated - раскрыты не все термы (найдено не все, totalItems занижен)
+function prefixPostings(index, prefix, stats) {
+    if (prefix.length < SEARCH_PREFIX_MIN_LENGTH) { return decodePostings(index, prefix, ownValue(index.terms, prefix)); }
+    const terms = index.sortedTerms;
+    let lo = 0, hi = terms.length;
+    while (lo < hi) { const mid = (lo + hi) >> 1; if (terms[mid] < prefix) { lo = mid + 1; } else { hi = mid; } }
+    const lists = []; let i = lo;
+    for (; i < terms.length && terms[i].startsWith(prefix) && lists.length < SEARCH_PREFIX_EXPANSION_LIMIT; i++) { lists.push(decodePostings(index, terms[i], ownValue(index.terms, terms[i]))); }
+    if (i < terms.length && terms[i].startsWith(prefix)) { stats.truncated = true; }
+    if (lists.length <= 1) { return lists[0] || EMPTY_POSTINGS; }
+    // Объединение нескольких термов: отметки в битовой карте, затем сбор по возрастанию позиций
+    const marks = new Uint8Array(index.totalItems); let count = 0;
+    for (const list of lists) { for (let i = 0; i < list.length; i++) { if (!marks[list[i]]) { marks[list[i]] = 1; count++; } } }
+    const positions = new Int32Array(count);
+    for (let i = 0, n = 0; n < count; i++) { if (marks[i]) { positions[n++] = i; } }
+    return positions;
+}
+
+function intersectPostings(lists) {
+    lists.sort((a, b) => a.length - b.length);
+    let result = lists[0];
+    for (let k = 1; k < lists.length && result.length > 0; k++) {
+        const other = lists[k]; const next = new Int32Array(result.length); let n = 0, j = 0;
+        for (let i = 0; i < result.length; i++) {
+            while (j < other.length && other[j] < result[i]) { j++; }
+            if (j < other.length && other[j] === result[i]) { next[n++] = result[i]; }
+        }
+        result = next.subarray(0, n);
+    }
+    return result;
+}
+
+// Плитка сетки из снимка индекса: страница выдачи не читает шарды (полная запись - /api/topic при открытии модального окна)
+function cardAt(index, position) {
+    const row = index.cards[position]; const card = { source: index.manifest.source };
+    index.cardFields.forEach((field, i) => { if (row[i] !== null) { card[field] = row[i]; } });
+    return card;
+}
+
+async function recordAt(index, position) {
+    const [shard, indexInShard] = shardSlot(index.manifest, position);
+    return (await readShard(index.sourceDir, index.manifest.shards[shard]))[indexInShard];
+}
+
+// Окно [skip, skip + limit) из найденных позиций; сортировка - по готовым порядкам из индекса (без сортировки на каждый запрос)
+function pageOfPositions(index, hits, sort, skip, limit) {
+    const [sortField, direction] = (sort || '').split('_');
+    const order = ownValue(index.orders, sortField);
+    if (!order) {
+        if (hits) { return Array.from(hits.subarray(skip, skip + limit)); }
+        const positions = [];
+        for (let i = skip; i < Math.min(index.totalItems, skip + limit); i++) { positions.push(i); }
+        return positions;
+    }
+    let marks = null;
+    if (hits) { marks = new Uint8Array(index.totalItems); for (let i = 0; i < hits.length; i++) { marks[hits[i]] = 1; } }
+    const positions = []; let matched = 0;
+    for (let k = 0; k < order.length && positions.length < limit; k++) {
+        const position = order[direction === 'desc' ? order.length - 1 - k : k];
+        if (marks && !marks[position]) { continue; }
+        if (matched++ >= skip) { positions.push(position); }
+    }
+    return positions;
+}
+
+async function searchTopics(source, query, page, limit) {
+    const startedAt = process.hrtime.bigint();
+    const index = await loadSearchIndex(source);
+    const lists = []; const stats = { truncated: false };
+    const tokens = searchTokens(query.q || '');
+    tokens.forEach((token, i) => lists.push(i === tokens.length - 1 ? prefixPostings(index, token, stats) : decodePostings(index, token, ownValue(index.terms, token))));
+    for (const [param, facet] of SEARCH_FILTER_FACETS) {
+        if (query[param]) { lists.push(decodePostings(index, `${facet}=${query[param]}`, ownValue(ownValue(index.facetPostings, facet), query[param]))); }
+    }
+    const hits = lists.length ? intersectPostings(lists) : null; // null - без условий, все записи
+    const totalItems = hits ? hits.length : index.totalItems;
+    const skip = Math.max(0, (page - 1) * limit);
+    const pagePositions = pageOfPositions(index, hits, query.sort, skip, limit);
+    const items = index.cards ? pagePositions.map(position => cardAt(index, position)) : await Promise.all(pagePositions.map(position => recordAt(index, position))); // Снимок без плиток (старое поколение) - из шардов
+    const tookMs = Number(process.hrtime.bigint() - startedAt) / 1e6;
+    console.log(`Search "${query.q || ''}" in ${source}: ${totalItems} hits${stats.truncated ? ' (prefix truncated)' : ''}, ${tokens.length} tokens, ${tookMs.toFixed(2)} ms`);
+    return { totalPages: Math.ceil(totalItems / limit), currentPage: page, itemsPerPage: limit, totalItems, truncated: stats.truncated, items, tookMs };
+}
+
+app.get('/api/search', async (req, res) => {
+    const source = req.query.source || 'rutracker';
+    const page = parseInt(req.query.page) || 1;
+    const limit = Math.min(parseInt(req.query.limit) || 50, 1000);
+    try { res.json(await searchTopics(source, req.query, page, limit)); }
+    catch (error) { res.status(error.status || (error.code === 'ENOENT' ? 404 : 500)).json({ error: error.message }); }
+});
+
+// Полная запись по topic_id (для модального окна выдачи поиска): позиция по плиткам индекса, затем один шард
+async function getTopicRecord(source, topicId) {
+    const index = await loadSearchIndex(source);
+    if (!index.positionsById) {
+        index.positionsById = new Map();
+        const idColumn = index.cards ? index.cardFields.indexOf('topic_id') : -1;
+        if (idColumn >= 0) { index.cards.forEach((row, position) => index.positionsById.set(String(row[idColumn]), position)); }
+    }
+    const position = index.positionsById.get(String(topicId));
+    if (position === undefined) { throw Object.assign(new Error(`Topic ${topicId} not found in "${source}"`), { status: 404 }); }
+    return recordAt(index, position);
+}
+
+app.get('/api/topic', async (req, res) => {
+    const source = req.query.source || 'rutracker';
+    try { res.json(await getTopicRecord(source, req.query.id)); }
+    catch (error) { res.status(error.status || (error.code === 'ENOENT' ? 404 : 500)).json({ error: error.message }); }
+});
+
+app.get('/api/facets', async (req, res) => {
+    const source = req.query.source || 'rutracker';
+    try {
+        const index = await loadSearchIndex(source);
+        res.json({ source, generation: index.generation, totalItems: index.totalItems, facets: index.facets });
+    } catch (error) { res.status(error.status || (error.code === 'ENOENT' ? 404 : 500)).json({ error: error.message }); }
+});
+
 // --- API �������� ��� ��� Rutracker ---
 app.get('/api/topics', async (req, res) => {
     const page = parseInt(req.query.page) || 1;
@@ -0,0 +1,29 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import parser # noqa: E402
+
+PORNOLAB_API_DATA = {"Name": "Some Clip", "Type": "Amateur, Solo", "Year": "2020", "Seeds": "3"}
+
+
+def test_pornolab_type_is_indexed_as_genre():
+    record = parser.build_topic_record(PORNOLAB_API_DATA, 1, 'pornolab')
+    assert 'genre' not in record and record['Type'] == "Amateur, Solo"
+    terms = parser.record_search_terms(record)
+    assert {"amateur", "solo", "genre=Amateur", "genre=Solo"} <= terms
+    assert parser.record_card(record)[parser.SEARCH_CARD_FIELDS.index("genre")] == "Amateur, Solo"
+
+
+def test_pornolab_genre_facet_in_serving_snapshot(tmp_path):
+    store = parser.DataStore(str(tmp_path / "store.sqlite"))
+    try:
+        store.upsert_many([parser.build_topic_record(PORNOLAB_API_DATA, 1, 'pornolab'), parser.build_topic_record({**PORNOLAB_API_DATA, "Type": "Solo"}, 2, 'pornolab')])
+        assert store.export_serving(str(tmp_path / "pornolab_data.json"))
+    finally: store.close()
+    source_dir = tmp_path / parser.SERVING_DIR / "pornolab"
+    manifest = json.loads((source_dir / "manifest.json").read_text(encoding='utf-8'))
+    snapshot = json.loads((source_dir / manifest["search"]).read_text(encoding='utf-8'))
+    assert snapshot["facets"]["genre"] == {"Amateur": 1, "Solo": 2}
+    assert "solo" in snapshot["terms"]